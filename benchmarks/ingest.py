@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SYNOPSIS
+
+    python benchmarks/ingest.py [-h] [--files FILES] [--skip-per-row]
+
+
+DESCRIPTION
+
+    Compare the set-based database ingest of dedupe.db.insert_files against
+    the query-per-file ingest it replaced. Each is timed on an empty database
+    and again on a rescan of the same files, where every file is already
+    recorded.
+
+"""
+
+import argparse
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import dedupe.db
+from dedupe.db import FileInformation
+
+# keep the progress bars and per-run messages out of the results
+logging.getLogger('dedupe').setLevel(logging.WARNING)
+
+
+class SyntheticFile(object):
+    __slots__ = ('path', 'size', 'signature', 'hash', 'first_block')
+
+    def __init__(self, i):
+        self.path = '/synthetic/d{0}/f{1}'.format(i // 100, i)
+        self.size = i % 5000
+        self.signature = (self.size, i * 1000, i * 1000, i, 1)
+        self.hash = None
+        self.first_block = None
+
+
+def synthetic_filesizes(file_count):
+    filesizes = collections.defaultdict(list)
+    for i in range(file_count):
+        file = SyntheticFile(i)
+        filesizes[file.size].append(file)
+    return filesizes
+
+
+def insert_files_per_row(filesizes, into):
+    # the ingest as it was before it became set-based: a query per file to
+    # see whether it is already recorded, committing every 2000 files
+    session = dedupe.db.connect(into)
+
+    i = 0
+    for filesize, files_matching_size in filesizes.items():
+        for file in files_matching_size:
+            record = session.query(FileInformation)\
+                            .filter_by(path=file.path)\
+                            .first()
+
+            if record is None:
+                record = FileInformation(path=file.path)
+                record.signature = file.signature
+                session.add(record)
+
+            elif record.signature != file.signature:
+                record.signature = file.signature
+                record.checksum = None
+                record.first_block = None
+
+            if i % 2000 == 0:
+                session.commit()
+            i += 1
+
+    session.commit()
+    return session
+
+
+def time_ingest(insert, file_count, directory):
+    db_filepath = os.path.join(directory, '{}.db'.format(insert.__name__))
+    filesizes = synthetic_filesizes(file_count)
+
+    timings = []
+    for _ in ('initial', 'rescan'):
+        start = time.perf_counter()
+        insert(filesizes, into=db_filepath)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def main(args):
+    ingests = [('set-based', dedupe.db.insert_files)]
+    if not args.skip_per_row:
+        ingests.insert(0, ('query per file', insert_files_per_row))
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('{0: <18}{1: >10}{2: >18}{3: >18}'.format(
+            'ingest', 'files', 'initial files/sec', 'rescan files/sec'))
+        for name, insert in ingests:
+            initial, rescan = time_ingest(insert, args.files, directory)
+            print('{0: <18}{1: >10}{2: >18.0f}{3: >18.0f}'.format(
+                name, args.files, args.files / initial, args.files / rescan))
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Compare database ingest strategies.')
+    parser.add_argument('--files', type=int, default=50000,
+                        help='synthetic files to ingest (default: 50000)')
+    parser.add_argument('--skip-per-row', action='store_true', default=False,
+                        help='only time the set-based ingest')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(get_arguments())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SYNOPSIS
+
+    python benchmarks/memory.py [-h] [--files FILES] [PATH]
+
+
+DESCRIPTION
+
+    Report the peak resident set size after the walk stage and after the
+    partition stage. Each measurement runs in a fresh interpreter, since peak
+    RSS never goes back down. If no PATH is given, a synthetic tree of small
+    files, nearly all sharing their size with another, is generated by
+    benchmarks/synthetic.py in a temporary directory.
+
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import synthetic
+
+STAGES = ('baseline', 'walk', 'partition')
+
+
+def measure(stage, root):
+    import logging
+    logging.getLogger('dedupe').setLevel(logging.WARNING)
+
+    import dedupe.duplicates
+    import dedupe.filesystem
+    import dedupe.utils
+
+    if stage != 'baseline':
+        filesizes = dedupe.filesystem.find_file_sizes(within=root)
+
+    if stage == 'partition':
+        candidates = dedupe.utils.filter_singletons(filesizes)
+        dedupe.duplicates.repartition(candidates)
+
+    # kilobytes on linux
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main(args):
+    root = args.path
+    if root is None:
+        root = synthetic.generate(tempfile.mkdtemp(), synthetic.TreeSpec(
+            small_files=args.files, small_size=4096, huge_files=0,
+            hardlinks=0))
+
+    try:
+        print('{0: <12}{1: >16}'.format('stage', 'peak RSS (MiB)'))
+        for stage in STAGES:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 '--measure', stage, root],
+                stderr=subprocess.DEVNULL)
+            print('{0: <12}{1: >16.1f}'.format(stage, int(output) / 1024))
+
+    finally:
+        if args.path is None:
+            shutil.rmtree(root)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Measure peak memory of the walk and partition stages.')
+    parser.add_argument('--files', type=int, default=200000,
+                        help='files in the synthetic tree (default: 200000)')
+    parser.add_argument('--measure', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('path', metavar='PATH', nargs='?',
+                        help='measure an existing tree instead of a'
+                             ' synthetic one')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    if args.measure:
+        measure(args.measure, args.path)
+    else:
+        main(args)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SYNOPSIS
+
+    python benchmarks/read.py [-h] [--total SIZE] [--cold]
+
+
+DESCRIPTION
+
+    Measure hashing throughput of each read strategy in dedupe.readers,
+    across several classes of file size. Files are generated in a temporary
+    directory. Unless --cold is given, files are read once beforehand so that
+    the page cache is warm, isolating the cost of the read path itself from
+    that of the device.
+
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import humanfriendly
+import xxhash
+
+from dedupe.readers import ChunkedReader
+from dedupe.readers import MmapReader
+from dedupe.readers import ReadintoReader
+
+SIZE_CLASSES = (4 * 1024, 256 * 1024, 4 * 1024 * 1024, 128 * 1024 * 1024)
+
+
+def generate_files(directory, size, total):
+    block = os.urandom(min(size, 1024 * 1024))
+    paths = []
+    for i in range(max(total // size, 1)):
+        path = os.path.join(directory, '{0}-{1}'.format(size, i))
+        with open(path, 'wb') as f:
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(block[:size % len(block)])
+        paths.append(path)
+    return paths
+
+
+def time_reader(reader, paths):
+    start = time.perf_counter()
+    for path in paths:
+        reader.update(xxhash.xxh64(), path)
+    return time.perf_counter() - start
+
+
+def main(args):
+    readers = [
+        ('chunked 4 KiB', ChunkedReader(buffer_size=4096,
+                                        drop_cache=args.cold)),
+        ('readinto 1 MiB', ReadintoReader(drop_cache=args.cold)),
+        ('mmap', MmapReader(drop_cache=args.cold, threshold=0)),
+    ]
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('{0: <12}{1: <16}{2: >8}{3: >12}'.format(
+            'file size', 'reader', 'files', 'MiB/sec'))
+        for size in SIZE_CLASSES:
+            paths = generate_files(directory, size, args.total)
+            total_bytes = size * len(paths)
+
+            for name, reader in readers:
+                if not args.cold:
+                    time_reader(reader, paths)
+                elapsed = time_reader(reader, paths)
+                print('{0: <12}{1: <16}{2: >8}{3: >12.1f}'.format(
+                    humanfriendly.format_size(size, binary=True), name,
+                    len(paths), total_bytes / elapsed / 1024 / 1024))
+
+            for path in paths:
+                os.remove(path)
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Measure hashing throughput of each read strategy.')
+    parser.add_argument('--total', type=humanfriendly.parse_size,
+                        default=512 * 1024 * 1024,
+                        help='bytes to generate per size class'
+                             ' (default: 512 MiB)')
+    parser.add_argument('--cold', action='store_true', default=False,
+                        help='evict files from the page cache after each'
+                             ' read, rather than warming it beforehand')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(get_arguments())
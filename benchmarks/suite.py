@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SYNOPSIS
+
+    python benchmarks/suite.py [-h] [-o RESULTS_FILE] [-j JOBS]
+                               [--seed SEED] [--small-files N]
+                               [--huge-files N] [--huge-size SIZE]
+                               [--keep-tree] [--startup-runs N] [PATH]
+
+
+DESCRIPTION
+
+    Time each stage of the pipeline separately against a synthetic tree
+    generated by benchmarks/synthetic.py, or against an existing tree if
+    PATH is given. The stages are the walk, the database ingest, the
+    checksum repartitioning, the checksum update and the report.
+
+    For each stage, the wall-clock time, files and bytes processed per
+    second, and peak resident set size so far are printed, and appended as
+    one JSON line to the results file along with the commit being measured,
+    so that runs can be compared across commits.
+
+    The cold start of dedupe.py is measured too, as the best of several
+    runs of --help, of a scan of a tree of a few files with --no-db, and of
+    the same scan with a database.
+
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+import dedupe.db
+import dedupe.duplicates
+import dedupe.filesystem
+import dedupe.report
+import dedupe.utils
+
+import synthetic
+
+# keep progress messages out of the results
+logging.getLogger('dedupe').setLevel(logging.WARNING)
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.stages = []
+
+    def measure(self, name, function, files=None, byte_count=None):
+        # files and byte_count may be functions of the stage's result
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+
+        if callable(files):
+            files = files(result)
+        if callable(byte_count):
+            byte_count = byte_count(result)
+
+        self.stages.append({
+            'stage': name,
+            'seconds': elapsed,
+            'files': files,
+            'bytes': byte_count,
+            'files_per_second': files / elapsed if files else None,
+            'bytes_per_second': byte_count / elapsed if byte_count else None,
+            # kilobytes on linux, bytes on macos
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+        return result
+
+
+def _count(partitions):
+    return sum(len(files) for files in partitions.values())
+
+
+def _size(partitions):
+    return sum(f.size for files in partitions.values() for f in files)
+
+
+def run(root, db_filepath, jobs):
+    timer = StageTimer()
+
+    filesizes = timer.measure(
+        'find_file_sizes',
+        lambda: dedupe.filesystem.find_file_sizes(within=root, jobs=jobs),
+        files=_count, byte_count=_size)
+    file_count = _count(filesizes)
+
+    db = timer.measure(
+        'insert_files',
+        lambda: dedupe.db.insert_files(filesizes, into=db_filepath,
+                                       prune_within=[root]),
+        files=file_count)
+
+    candidates = dedupe.utils.filter_singletons(filesizes)
+    statistics = dedupe.duplicates.PrefilterStatistics()
+    partitions = timer.measure(
+        'repartition',
+        lambda: dedupe.duplicates.repartition(candidates,
+                                              statistics=statistics,
+                                              jobs=jobs),
+        files=_count(candidates),
+        byte_count=lambda _: statistics.bytes_read)
+
+    timer.measure(
+        'update_with_checksums',
+        lambda: dedupe.db.update_with_checksums(candidates, db),
+        files=_count(candidates))
+
+    duplicates = dedupe.utils.filter_singletons(partitions)
+
+    def report():
+        output = io.StringIO()
+        ranked = dedupe.report.ranked_duplicates(db, within=[root])
+        dedupe.report.write_all(ranked, [
+            dedupe.report.TextReport(output, statistics),
+            dedupe.report.RemovalScript(io.StringIO()),
+            dedupe.report.HardlinkScript(io.StringIO()),
+        ])
+        return output.getvalue()
+
+    timer.measure('report', report, files=_count(duplicates),
+                  byte_count=lambda output: len(output))
+
+    return timer.stages
+
+
+STARTUP_FILES = 20
+
+
+def cold_start(directory, runs):
+    # dedupe.py is run as it would be from a script, on a tree small enough
+    # that the time is spent starting up rather than scanning
+    root = os.path.join(directory, 'startup')
+    os.makedirs(root)
+    for i in range(STARTUP_FILES):
+        with open(os.path.join(root, str(i)), 'w') as f:
+            f.write(str(i % 4))
+
+    script = os.path.join(REPOSITORY, 'dedupe.py')
+    commands = [
+        ('help', ['--help']),
+        ('no_db', ['--no-db', root]),
+        ('db', ['--db', os.path.join(directory, 'startup.db'), root]),
+    ]
+
+    startup = []
+    for name, arguments in commands:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script] + arguments, check=True,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+
+        startup.append({'command': name, 'runs': runs,
+                        'best_seconds': min(times),
+                        'median_seconds': sorted(times)[len(times) // 2]})
+    return startup
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    directory = tempfile.mkdtemp()
+    root = args.path
+    spec = None
+    if root is None:
+        spec = synthetic.TreeSpec(seed=args.seed,
+                                  small_files=args.small_files,
+                                  huge_files=args.huge_files,
+                                  huge_size=args.huge_size)
+        root = synthetic.generate(os.path.join(directory, 'tree'), spec)
+
+    try:
+        stages = run(root, os.path.join(directory, 'dedupe.db'), args.jobs)
+        startup = cold_start(directory, args.startup_runs)
+
+    finally:
+        if args.keep_tree and args.path is None:
+            print('Synthetic tree kept at {}'.format(root))
+            os.remove(os.path.join(directory, 'dedupe.db'))
+        else:
+            shutil.rmtree(directory)
+
+    print('{0: <24}{1: >10}{2: >14}{3: >14}{4: >12}'.format(
+        'stage', 'seconds', 'files/sec', 'MiB/sec', 'peak RSS'))
+    for stage in stages:
+        print('{0: <24}{1: >10.3f}{2: >14}{3: >14}{4: >12}'.format(
+            stage['stage'], stage['seconds'],
+            '{:.0f}'.format(stage['files_per_second'])
+            if stage['files_per_second'] else '-',
+            '{:.1f}'.format(stage['bytes_per_second'] / 1024 / 1024)
+            if stage['bytes_per_second'] else '-',
+            stage['peak_rss']))
+
+    print()
+    print('{0: <24}{1: >10}{2: >10}'.format('cold start', 'best', 'median'))
+    for command in startup:
+        print('{0: <24}{1: >10.3f}{2: >10.3f}'.format(
+            command['command'], command['best_seconds'],
+            command['median_seconds']))
+
+    if args.results_filepath:
+        with open(args.results_filepath, 'a') as results:
+            results.write(json.dumps({
+                'commit': _commit(),
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'jobs': args.jobs,
+                'tree': spec.as_dict() if spec else args.path,
+                'stages': stages,
+                'startup': startup,
+            }) + '\n')
+
+
+def get_arguments():
+    defaults = synthetic.TreeSpec()
+    parser = argparse.ArgumentParser(
+        description='Time each stage of the pipeline.')
+    parser.add_argument('-o', '--output', dest='results_filepath',
+                        default='benchmark_results.jsonl',
+                        help='append results to this JSON lines file'
+                             ' (default: benchmark_results.jsonl)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='walk and hashing workers (default: 1)')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--small-files', type=int,
+                        default=defaults.small_files)
+    parser.add_argument('--huge-files', type=int, default=defaults.huge_files)
+    parser.add_argument('--huge-size', type=synthetic.humanfriendly.parse_size,
+                        default=defaults.huge_size)
+    parser.add_argument('--keep-tree', action='store_true', default=False,
+                        help="don't remove the synthetic tree afterwards")
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='how many times to start dedupe.py when'
+                             ' measuring its cold start (default: 5)')
+    parser.add_argument('path', metavar='PATH', nargs='?',
+                        help='benchmark an existing tree instead of a'
+                             ' synthetic one')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(get_arguments())
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SYNOPSIS
+
+    python benchmarks/synthetic.py [-h] [--seed SEED] [--small-files N]
+                                   [--small-size SIZE]
+                                   [--huge-files N] [--huge-size SIZE]
+                                   [--depth DEPTH] [--fanout FANOUT]
+                                   [--duplicate-ratio RATIO]
+                                   [--same-size-ratio RATIO]
+                                   [--hardlinks N]
+                                   PATH
+
+
+DESCRIPTION
+
+    Generate a reproducible tree of files for benchmarking. The same seed
+    and parameters always produce the same tree: the same paths, sizes and
+    contents.
+
+    Files are spread across a nested tree of directories. A fraction of them
+    are copies of an earlier file, and another fraction share an earlier
+    file's size but differ from it in their first block, their last block or
+    somewhere in between. A few hard links are made to random files.
+
+"""
+
+import argparse
+import os
+import random
+
+import humanfriendly
+
+SMALL_FILE_MAX_SIZE = 64 * 1024
+
+
+class TreeSpec(object):
+    def __init__(self, seed=0, small_files=10000,
+                 small_size=SMALL_FILE_MAX_SIZE, huge_files=2,
+                 huge_size=64 * 1024 * 1024, depth=4, fanout=4,
+                 duplicate_ratio=0.2, same_size_ratio=0.1, hardlinks=100):
+        self.seed = seed
+        self.small_files = small_files
+        self.small_size = small_size
+        self.huge_files = huge_files
+        self.huge_size = huge_size
+        self.depth = depth
+        self.fanout = fanout
+        self.duplicate_ratio = duplicate_ratio
+        self.same_size_ratio = same_size_ratio
+        self.hardlinks = hardlinks
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def _directories(root, depth, fanout):
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for directory in level:
+            for i in range(fanout):
+                next_level.append(os.path.join(directory, 'd{}'.format(i)))
+        directories.extend(next_level)
+        level = next_level
+    return directories
+
+
+def _write(path, contents):
+    with open(path, 'wb') as f:
+        f.write(contents)
+
+
+def _write_huge(path, size, rng, variant=None):
+    # written a megabyte at a time, from a pattern that repeats, so that
+    # generating the file is quick. variant changes one byte in the middle,
+    # which no prefilter stage will notice.
+    chunk = rng.randbytes(min(size, 1024 * 1024))
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            f.write(chunk[:size - written])
+            written += len(chunk)
+
+        if variant is not None:
+            f.seek(size // 2)
+            f.write(bytes([variant]))
+
+
+def _contents(recipe):
+    # files are described by recipes rather than kept in memory, and their
+    # contents regenerated whenever they are copied
+    size, seed, altered_position = recipe
+    contents = random.Random(seed).randbytes(size)
+    if altered_position is None:
+        return contents
+
+    altered = bytearray(contents)
+    altered[altered_position] ^= 0xFF
+    return bytes(altered)
+
+
+def generate(root, spec):
+    rng = random.Random(spec.seed)
+    directories = _directories(root, spec.depth, spec.fanout)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    recipes = []
+    paths = []
+    for i in range(spec.small_files):
+        path = os.path.join(rng.choice(directories), 'f{}'.format(i))
+        roll = rng.random()
+
+        if recipes and roll < spec.duplicate_ratio:
+            recipe = rng.choice(recipes)
+
+        elif recipes and roll < spec.duplicate_ratio + spec.same_size_ratio:
+            # same size, different contents, differing in one of the places
+            # the prefilter stages look
+            size, seed, _ = rng.choice(recipes)
+            position = rng.choice((0, size - 1, size // 2)) if size else None
+            recipe = size, seed, position
+
+        else:
+            recipe = (rng.randint(0, spec.small_size), rng.getrandbits(64),
+                      None)
+
+        _write(path, _contents(recipe))
+        recipes.append(recipe)
+        paths.append(path)
+
+    # each huge file is either a copy of the first or differs from it in the
+    # middle
+    for i in range(spec.huge_files):
+        path = os.path.join(rng.choice(directories), 'huge{}'.format(i))
+        variant = None if i % 2 == 0 else i % 256
+        _write_huge(path, spec.huge_size, random.Random(spec.seed), variant)
+
+    for i in range(spec.hardlinks if paths else 0):
+        target = os.path.join(rng.choice(directories), 'link{}'.format(i))
+        os.link(rng.choice(paths), target)
+
+    return root
+
+
+def get_arguments():
+    defaults = TreeSpec()
+    parser = argparse.ArgumentParser(
+        description='Generate a reproducible tree of files.')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--small-files', type=int,
+                        default=defaults.small_files)
+    parser.add_argument('--small-size', type=humanfriendly.parse_size,
+                        default=defaults.small_size)
+    parser.add_argument('--huge-files', type=int,
+                        default=defaults.huge_files)
+    parser.add_argument('--huge-size', type=humanfriendly.parse_size,
+                        default=defaults.huge_size)
+    parser.add_argument('--depth', type=int, default=defaults.depth)
+    parser.add_argument('--fanout', type=int, default=defaults.fanout)
+    parser.add_argument('--duplicate-ratio', type=float,
+                        default=defaults.duplicate_ratio)
+    parser.add_argument('--same-size-ratio', type=float,
+                        default=defaults.same_size_ratio)
+    parser.add_argument('--hardlinks', type=int, default=defaults.hardlinks)
+    parser.add_argument('path', metavar='PATH',
+                        help='directory in which to generate the tree')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    path = args.path
+    del args.path
+    generate(path, TreeSpec(**vars(args)))
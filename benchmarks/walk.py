@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SYNOPSIS
+
+    python benchmarks/walk.py [-h] [-r REPEAT] [-j JOBS [JOBS ...]]
+                              [--files FILES] [PATH]
+
+
+DESCRIPTION
+
+    Compare the os.walk-based FileFinder against the os.scandir-based
+    ScandirFinder. If no PATH is given, a synthetic tree of small files is
+    generated by benchmarks/synthetic.py in a temporary directory and removed
+    afterwards.
+
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from dedupe.filesystem import FileFinder
+from dedupe.filesystem import ScandirFinder
+
+import synthetic
+
+
+def time_finder(make_finder, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        found = make_finder().find()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    file_count = sum(len(files) for files in found.values())
+    return file_count, best
+
+
+def main(args):
+    root = args.path
+    if root is None:
+        root = synthetic.generate(tempfile.mkdtemp(), synthetic.TreeSpec(
+            small_files=args.files, small_size=1024, huge_files=0,
+            hardlinks=0))
+
+    try:
+        finders = [('os.walk', lambda: FileFinder(within=root))]
+        for jobs in args.jobs:
+            finders.append(('os.scandir, {} jobs'.format(jobs),
+                            lambda jobs=jobs: ScandirFinder(within=root,
+                                                            jobs=jobs)))
+
+        print('{0: <24}{1: >10}{2: >12}{3: >14}'.format(
+            'walker', 'files', 'seconds', 'files/sec'))
+        for name, make_finder in finders:
+            file_count, elapsed = time_finder(make_finder, args.repeat)
+            print('{0: <24}{1: >10}{2: >12.3f}{3: >14.0f}'.format(
+                name, file_count, elapsed, file_count / elapsed))
+
+    finally:
+        if args.path is None:
+            shutil.rmtree(root)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Compare directory walkers.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per walker, of which the fastest is kept'
+                             ' (default: 3)')
+    parser.add_argument('-j', '--jobs', type=int, nargs='+',
+                        default=[1, 4, 16],
+                        help='worker counts to try (default: 1 4 16)')
+    parser.add_argument('--files', type=int, default=20000,
+                        help='files in the synthetic tree (default: 20000)')
+    parser.add_argument('path', metavar='PATH', nargs='?',
+                        help='walk an existing tree instead of a synthetic'
+                             ' one')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(get_arguments())
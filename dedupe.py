@@ -4,8 +4,26 @@
 SYNOPSIS
 
     python dedupe.py [-h] [-v] [-d DATABASE_FILE] [-o REPORT_FILEPATH]
+                     [-f {csv,jsonl,text}]
                      [-s REMOVAL_SCRIPT] [-l HARDLINK_SCRIPT]
-                     PATH [PATH ...]
+                     [--apply {hardlink,reflink}] [--journal JOURNAL_FILE]
+                     [--rollback]
+                     [--min-size SIZE] [--max-size SIZE]
+                     [--include PATTERN] [--exclude PATTERN]
+                     [--one-file-system]
+                     [-j JOBS] [--processes] [--device-jobs PATH=JOBS]
+                     [--hash {blake2b,blake3,xxh3_128,xxh64}]
+                     [--verify ALGORITHM] [--tree-hash CHUNK_SIZE]
+                     [--read-strategy {chunked,readinto,mmap}]
+                     [--read-buffer SIZE] [--keep-cache]
+                     [--stats STATS_FILE] [--profile PROFILE_DIRECTORY]
+                     [--resume] [--checkpoint-interval SECONDS]
+                     [--memory-limit SIZE] [--target-savings SIZE]
+                     [--no-db] [--check] [--watch] [--report-only]
+                     [--shard NAME] [--merge]
+                     [--write-snapshot DIRECTORY]
+                     [--read-snapshot DIRECTORY]
+                     [PATH ...]
 
 
 DESCRIPTION
@@ -21,11 +39,163 @@ ARGUMENTS
                                    (default: $cwd/dedupe.py.db)
     -o, --output-to-file           write duplicate file consumption analysis to
                                     file (default: stdout)
+    -f, --format                   format of the analysis: text, CSV with a
+                                    row per path, or JSON Lines with an
+                                    object per set of identical files
+                                    (default: text)
     -s, --create-remove-script     create script for removing duplicate files
                                     (default: no script)
     -l, --create-hardlink-script   create script to remove duplicate files and 
                                     convert them to hard links. Linux only.
                                     (default: no script)
+    --apply                        replace each duplicate with a hard link to
+                                    the preserved file, or with a reflinked
+                                    clone of it on filesystems such as btrfs
+                                    and xfs. files changed since they were
+                                    hashed are left alone.
+                                    (default: replace nothing)
+    --journal                      where --apply records each replacement, so
+                                    that an interrupted run can be resumed
+                                    and a finished one rolled back
+                                    (default: DATABASE_FILE.journal)
+    --rollback                     give every file replaced according to the
+                                    journal its own copy again, with its
+                                    original permissions and times, and exit
+    --min-size                     skip files smaller than the given size,
+                                    e.g. 1 to skip empty files
+                                    (default: no minimum)
+    --max-size                     skip files larger than the given size
+                                    (default: no maximum)
+    --include                      only keep files matching a glob pattern.
+                                    patterns with a slash are matched against
+                                    the whole path, as with find -path, and
+                                    others against the name.
+                                    may be given more than once
+                                    (default: every file)
+    --exclude                      skip files and directories matching a glob
+                                    pattern, such as .git or *.pyc, without
+                                    descending into those directories. may be
+                                    given more than once
+                                    (default: skip nothing)
+    --one-file-system              don't descend into directories on other
+                                    file systems than the PATH they're beneath
+                                    (default: cross mount points)
+    -j, --jobs                     number of directory scanning and hashing
+                                    workers
+                                    (default: 1)
+    --processes                    hash in worker processes rather than
+                                    threads (default: threads)
+    --device-jobs                  how many workers may hash files on the
+                                    device PATH is on at once, such as 1 for
+                                    a spinning disk behind a network file
+                                    system. may be given more than once
+                                    (default: 1 for disks that sysfs says
+                                    spin, and as many as --jobs for others)
+    --hash                         the algorithm files are checksummed with:
+                                    xxh64, the faster and wider xxh3_128, or
+                                    the cryptographic blake2b or blake3.
+                                    checksums from earlier scans are only
+                                    reused if computed by the same algorithm
+                                    (default: xxh64)
+    --verify                       read files found to share a checksum once
+                                    more with a second algorithm, such as
+                                    blake3, and report them as duplicates only
+                                    if they agree. files verified by an
+                                    earlier scan and unchanged since aren't
+                                    read again (default: no verification)
+    --tree-hash                    hash files larger than the given size as
+                                    trees of chunks of that size, reading
+                                    as many chunks of a file at once as there
+                                    are --jobs. the digests of the chunks are
+                                    kept, and later scans compare large files
+                                    with them a few chunks at a time, so that
+                                    a file is read only as far as it matches
+                                    another (default: hash files whole)
+    --read-strategy                how files are read for hashing: chunked
+                                    reads, readinto a reused buffer, or mmap
+                                    for large files (default: readinto)
+    --read-buffer                  size of each read when hashing
+                                    (default: 1 MiB)
+    --keep-cache                   leave hashed files in the page cache
+                                    (default: evict them once hashed)
+    --stats                        write the wall and CPU time of each stage,
+                                    and the files and bytes it read, dropped
+                                    and wrote, to a JSON file
+                                    (default: no statistics)
+    --profile                      run each stage under cProfile and write
+                                    <stage>.prof files to a directory
+                                    (default: no profiling)
+    --resume                       carry on from where an interrupted scan of
+                                    the same database left off, rather than
+                                    walking every directory again. checksums
+                                    saved by an interrupted scan are reused
+                                    either way.
+                                    (default: start a new scan)
+    --checkpoint-interval          seconds between saves of the progress of
+                                    a scan (default: 30)
+    --memory-limit                 keep files in the database rather than in
+                                    memory, reading them back a few sizes at
+                                    a time, so that memory use stays roughly
+                                    within the given size regardless of how
+                                    many files there are
+                                    (default: no limit)
+    --target-savings               hash the sizes that could free the most
+                                    space first, report (and --apply)
+                                    duplicates as soon as they're found, and
+                                    stop hashing once they would free the
+                                    given size (default: hash everything)
+    --no-db                        scan, hash and report entirely in
+                                    memory, without reading or writing the
+                                    database, for quick scans of small trees
+    --check                        report which files beneath PATH already
+                                    have a copy in the database, and where.
+                                    only PATH is walked, and only files whose
+                                    size is in the database are hashed, along
+                                    with the database's files of that size
+                                    whose checksums it lacks
+    --watch                        once the scan is done, keep the database
+                                    current as files beneath PATH are
+                                    created, changed, renamed and removed,
+                                    until interrupted. only those files are
+                                    looked at again, and only those that
+                                    share their size with another are hashed.
+                                    meanwhile, --report-only on the same
+                                    database reports the current duplicates.
+                                    Linux only (default: exit after the scan)
+    --report-only                  report on the duplicates already in the
+                                    database, beneath PATH if any are given,
+                                    without scanning
+                                    (default: scan PATH)
+    --shard                        scan PATH into the database as a shard
+                                    named NAME, one of several scanned on
+                                    different hosts, and hash the files of
+                                    the sizes the last --merge asked for
+                                    (default: an ordinary database)
+    --merge                        report on the duplicates across the
+                                    shards given as PATH, with paths
+                                    prefixed by their shard's name. only
+                                    sizes held by more than one shard are
+                                    looked at beyond what each shard found
+                                    itself. those whose files each shard must
+                                    hash in full are written to the shard, to
+                                    be hashed by its next --shard scan, and
+                                    their files are left out until then.
+                                    shards must be scanned with the same
+                                    --hash and --tree-hash as they're merged
+                                    with
+    --write-snapshot               once the scan and report are done, write
+                                    the files of the database to a directory
+                                    as columns of a table that a later
+                                    --read-snapshot maps into memory. only an
+                                    earlier snapshot is replaced. requires
+                                    numpy (default: no snapshot)
+    --read-snapshot                with --report-only, report on the
+                                    duplicates in a snapshot, grouping and
+                                    ranking them with a sort over whole
+                                    columns rather than a query per set.
+                                    files scanned since the snapshot was
+                                    written aren't reported
+                                    (default: report from the database)
 
 
 AUTHOR
@@ -39,6 +209,7 @@ DEPENDENCIES
     xxhash
     humanfriendly
     progressbar2
+    blake3 (optional, for --hash or --verify blake3)
     
 
 LICENSE
@@ -51,6 +222,7 @@ import dedupe.utils
 logger = dedupe.setup_logger(name=__name__, verbosity=True)
 
 import argparse
+import contextlib
 from datetime import datetime
 import sys
 import os
@@ -62,129 +234,494 @@ __author__ = "Doug McGeehan"
 __version__ = "0.1.0"
 __license__ = "GNU GPLv3"
 
+# the database, checkpoint and out-of-core modules pull in SQLAlchemy, which
+# takes longer to import than a small scan takes to run. they're imported
+# where they're needed, so that --no-db and --help don't wait on them.
+import dedupe.apply
 import dedupe.filesystem
-import dedupe.db
 import dedupe.duplicates
+import dedupe.hashing
+import dedupe.readers
+import dedupe.report
+import dedupe.scheduler
+import dedupe.stats
 
 
 def main(args):
+    instrumentation = dedupe.stats.Instrumentation(
+        profile_directory=args.profile_directory)
+
+    if args.rollback:
+        logger.info('Rolling back the replacements in {}'.format(
+            args.journal))
+        with instrumentation.stage('rollback') as counters:
+            dedupe.apply.rollback(args.journal, jobs=args.jobs,
+                                  counters=counters)
+        logger.info('{0} files restored, {1} failed'.format(
+            counters['restored'], counters['failed']))
+
+        if args.stats_filepath:
+            instrumentation.write(args.stats_filepath)
+        return
+
+    reader = dedupe.readers.READERS[args.read_strategy](
+        buffer_size=args.read_buffer, drop_cache=not args.keep_cache)
+    verification = None
+    if args.verify:
+        verification = dedupe.hashing.ALGORITHMS[args.verify]()
+    algorithm = dedupe.hashing.ALGORITHMS[args.hash]()
+    if args.tree_hash:
+        algorithm = dedupe.hashing.TreeHash(algorithm, args.tree_hash,
+                                            jobs=args.jobs)
+    device_limits = dedupe.scheduler.DeviceLimits(args.device_jobs)
+    prefilter_statistics = dedupe.duplicates.PrefilterStatistics(
+        reader=reader, algorithm=algorithm, verification=verification,
+        device_limits=device_limits)
+
+    if args.check:
+        check_incoming(args, instrumentation, prefilter_statistics)
+
+        if args.stats_filepath:
+            instrumentation.write(args.stats_filepath)
+        return
+
+    if args.report_only or args.merge:
+        prefilter_statistics = None
+
+    # directories are watched before they're scanned, so that changes made
+    # during the scan aren't missed
+    watcher = None
+    if args.watch:
+        watcher = start_watching(args, prefilter_statistics)
+
+    with contextlib.ExitStack() as stack:
+        writers = open_writers(args, stack, prefilter_statistics,
+                               counters=instrumentation.counters)
+
+        if args.report_only:
+            logger.info('Reporting on the existing database without'
+                        ' scanning')
+
+        elif args.merge:
+            logger.info('Merging {} shards'.format(len(args.paths)))
+            with instrumentation.stage('merge') as counters:
+                potential_savings_total = merge_shards(args, algorithm,
+                                                       writers, counters)
+
+        elif args.memory_limit:
+            find_duplicates_out_of_core(args, instrumentation,
+                                        prefilter_statistics)
+
+        elif args.no_db:
+            potential_savings_total = find_duplicates_in_memory(
+                args, instrumentation, prefilter_statistics, writers)
+
+        elif args.target_savings:
+            # sets of identical files are written out as they're found,
+            # rather than once every file has been hashed
+            potential_savings_total = find_duplicates(
+                args, instrumentation, prefilter_statistics, writers=writers)
+
+        else:
+            find_duplicates(args, instrumentation, prefilter_statistics)
+
+        # the first and last blocks of every file are digested, and sizes a
+        # merge found this shard shares with others are hashed, once the
+        # scan has brought the shard up to date
+        if args.shard:
+            logger.info('Hashing the sizes requested by the last merge')
+            with instrumentation.stage('requests') as counters:
+                answer_requests(args, prefilter_statistics, counters)
+
+        # every digest is in the database by now, and sets of identical
+        # files are streamed from there, largest savings first
+        if not (args.target_savings or args.no_db or args.merge):
+            logger.info('Writing report of duplicates by deduplication'
+                        ' savings')
+            with instrumentation.stage('report'):
+                if args.read_snapshot:
+                    potential_savings_total = report_from_snapshot(args,
+                                                                   writers)
+                else:
+                    potential_savings_total = report_from_db(args, writers)
+
+    if args.write_snapshot:
+        logger.info('Writing a snapshot of the database to {}'.format(
+            args.write_snapshot))
+        with instrumentation.stage('snapshot') as counters:
+            write_snapshot(args, counters)
+
+    if args.apply:
+        counters = instrumentation.counters
+        logger.info('{0} duplicates replaced, {1} changed since they were'
+                    ' hashed, {2} failed'.format(
+                        counters['replaced'], counters['skipped_changed'],
+                        counters['failed']))
+
+    if args.stats_filepath:
+        instrumentation.write(args.stats_filepath)
+
+    print('='*80)
+    print('# {} in total potential savings'.format(
+        humanfriendly.format_size(
+            potential_savings_total,
+            binary=True)
+    ))
+
+    if watcher is not None:
+        watch(watcher)
+
+
+def walk_filter(args):
+    return dedupe.filesystem.WalkFilter(
+        min_size=args.min_size, max_size=args.max_size,
+        include=args.include, exclude=args.exclude,
+        one_file_system=args.one_file_system)
+
+
+def start_watching(args, prefilter_statistics):
+    import dedupe.watch
+    return dedupe.watch.Watcher(
+        within=args.paths, into=args.db, statistics=prefilter_statistics,
+        walk_filter=walk_filter(args), jobs=args.jobs)
+
+
+def watch(watcher):
+    logger.info('Watching {} directories for changes'.format(
+        watcher.counters['directories_watched']))
+    try:
+        watcher.run()
+
+    except KeyboardInterrupt:
+        logger.info('Stopped watching after {0} events'.format(
+            watcher.counters['events']))
+
+    finally:
+        watcher.close()
+
+
+def check_incoming(args, instrumentation, prefilter_statistics):
+    # only the incoming directories are walked. the archive is whatever the
+    # database already holds.
+    import dedupe.check
+    import dedupe.db
+
+    logger.info('Walking incoming directories and collecting filenames and'
+                ' sizes')
+    with instrumentation.stage('walk') as counters:
+        filesizes = dedupe.filesystem.find_file_sizes(
+            within=args.paths, jobs=args.jobs, counters=counters,
+            walk_filter=walk_filter(args))
+
+    logger.info('Looking up incoming files in {}'.format(args.db))
+    with instrumentation.stage('check') as counters, \
+            contextlib.ExitStack() as stack:
+        if args.report_filepath:
+            output = stack.enter_context(open(args.report_filepath, 'w',
+                                              newline=''))
+        else:
+            output = sys.stdout
+
+        db = dedupe.db.connect(args.db)
+        matches = dedupe.check.find_matches(
+            filesizes, db, within=args.paths,
+            statistics=prefilter_statistics, jobs=args.jobs,
+            use_processes=args.processes, counters=counters)
+        writer = dedupe.check.MATCH_FORMATS[args.report_format](output)
+        matched, matched_size = dedupe.check.write_matches(matches, writer)
+
+        _count_prefilter_stages(prefilter_statistics, counters)
+
+    logger.info('{0} incoming files ({1}) already in the archive, out of'
+                ' {2} of the same size as some of its {3} files'.format(
+                    matched,
+                    humanfriendly.format_size(matched_size, binary=True),
+                    counters['incoming_candidates'],
+                    counters['archive_candidates']))
+
+
+def answer_requests(args, prefilter_statistics, counters):
+    import dedupe.db
+    import dedupe.shards
+
+    db = dedupe.db.connect(args.db)
+    dedupe.db.set_shard_name(db, args.shard)
+    dedupe.shards.digest_blocks(db, statistics=prefilter_statistics,
+                                jobs=args.jobs, counters=counters)
+    dedupe.shards.answer_requests(db, statistics=prefilter_statistics,
+                                  jobs=args.jobs, counters=counters)
+    db.close()
+
+
+def merge_shards(args, algorithm, writers, counters):
+    import dedupe.shards
+
+    duplicates = dedupe.utils.filter_singletons(dedupe.shards.merge(
+        args.paths, algorithm=algorithm, counters=counters))
+    for files in duplicates.values():
+        files.sort(key=lambda f: f.path)
+    ranked = dedupe.report.rank_by_savings(duplicates)
+    return dedupe.report.write_all(ranked, writers)
+
+
+def report_from_db(args, writers):
+    import dedupe.db
+
+    db = dedupe.db.connect(args.db)
+    ranked = dedupe.report.ranked_duplicates(db, within=args.paths)
+    return dedupe.report.write_all(ranked, writers)
+
+
+def report_from_snapshot(args, writers):
+    import dedupe.table
+
+    table = dedupe.table.FileTable.load(args.read_snapshot)
+    ranked = dedupe.table.ranked_duplicates(table, within=args.paths)
+    return dedupe.report.write_all(ranked, writers)
+
+
+def write_snapshot(args, counters):
+    import dedupe.db
+    import dedupe.table
+
+    table = dedupe.table.FileTable.from_db(dedupe.db.connect(args.db))
+    table.save(args.write_snapshot)
+    counters['files'] += len(table)
+
+
+def open_writers(args, stack, prefilter_statistics, counters=None):
+    # if a file was specified to write the report to, then write it there.
+    # otherwise, write it to standard output.
+    if args.report_filepath:
+        output = stack.enter_context(open(args.report_filepath, 'w',
+                                          newline=''))
+
+    else:
+        output = sys.stdout
+
+    writers = [dedupe.report.REPORT_FORMATS[args.report_format](
+        output, prefilter_statistics=prefilter_statistics)]
+
+    # if the user specified a removal script, then create a script that will
+    # preserve one file (the first file) and delete all duplicates
+    if args.removal_script:
+        writers.append(dedupe.report.RemovalScript(
+            stack.enter_context(open(args.removal_script, 'w'))))
+
+    # if the user specified a symlink script, then create a script that will
+    # remove duplicates of a file and create a hard link
+    if args.hardlink_script:
+        writers.append(dedupe.report.HardlinkScript(
+            stack.enter_context(open(args.hardlink_script, 'w'))))
+
+    # replace duplicates here and now, rather than leave it to a script
+    if args.apply:
+        journal = dedupe.apply.Journal(args.journal)
+        stack.callback(journal.close)
+        writers.append(dedupe.apply.Deduplicator(
+            args.apply, journal, jobs=args.jobs, counters=counters))
+
+    return writers
+
+
+def find_duplicates(args, instrumentation, prefilter_statistics,
+                    writers=None):
+    import dedupe.checkpoint
+    import dedupe.db
+
+    # progress is saved as the scan goes, so that an interrupted scan can be
+    # resumed
+    algorithm = prefilter_statistics.algorithm
+    checkpoint = dedupe.checkpoint.Checkpoint(
+        into=args.db, resume=args.resume,
+        interval=args.checkpoint_interval, algorithm=algorithm)
+
     # partition files under the specified directories by their file sizes
     logger.info('Walking directory and collecting filenames and sizes')
-    filesizes = dedupe.filesystem.find_file_sizes(within=args.paths)
+    with instrumentation.stage('walk') as counters:
+        filesizes = dedupe.filesystem.find_file_sizes(
+            within=args.paths, jobs=args.jobs, counters=counters,
+            checkpoint=checkpoint, walk_filter=walk_filter(args))
 
     # store dictionary in a sqlite db
     logger.info('Inserting files into database')
-    db = dedupe.db.insert_files(filesizes, into=args.db)
+    with instrumentation.stage('insert') as counters:
+        db = dedupe.db.insert_files(filesizes, into=args.db,
+                                    prune_within=args.paths,
+                                    counters=counters,
+                                    checkpoint=checkpoint,
+                                    algorithm=algorithm)
 
     # remove singleton partitions (files that have a unique file size)
     logger.info('Filtering out singleton size-partitions')
-    potential_duplicates = dedupe.utils.filter_singletons(filesizes)
+    with instrumentation.stage('size_filter') as counters:
+        potential_duplicates = dedupe.utils.filter_singletons(
+            filesizes, counters=counters)
+
+        # the sizes that could free the most space are hashed first, so
+        # that hashing can stop once enough duplicates have been found
+        if args.target_savings:
+            potential_duplicates = \
+                dedupe.duplicates.rank_by_potential_savings(
+                    potential_duplicates)
 
     # for each partition, check for duplicates within
     # # add checksums to the database
     # src.db.update_with_checksums(duplicate_partitions, db)
     logger.info('Finding duplicates within size-partitions by checksum')
-    duplicate_partitions = dedupe.duplicates.repartition(
-        filesize_partitions=potential_duplicates)
+    potential_savings_total = 0
+    with instrumentation.stage('repartition') as counters:
+        def found(potential_savings, partition):
+            nonlocal potential_savings_total
+            potential_savings_total += potential_savings
+            for writer in writers:
+                writer.write(potential_savings, partition)
+
+        duplicate_partitions = dedupe.duplicates.repartition(
+            filesize_partitions=potential_duplicates,
+            statistics=prefilter_statistics,
+            jobs=args.jobs, use_processes=args.processes,
+            checkpoint=checkpoint, target_savings=args.target_savings,
+            found=found if writers is not None else None)
 
-    # add checksums to the database
+        _count_prefilter_stages(prefilter_statistics, counters)
+
+    # add checksums and first-block digests to the database, including those
+    # of files that were eliminated before being fully hashed
     logger.info('Adding checksums to database')
-    dedupe.db.update_with_checksums(duplicate_partitions, db)
+    with instrumentation.stage('update_checksums') as counters:
+        dedupe.db.update_with_checksums(potential_duplicates, db,
+                                        counters=counters,
+                                        algorithm=algorithm)
+
+    # everything the walk found is now in the database, so there's nothing
+    # left to resume
+    checkpoint.clear()
+    logger.debug('{} checkpoints saved'.format(checkpoint.checkpoints))
 
     # filter out singleton partitions (again)
     logger.info('Filtering out singleton checksum-partitions')
-    only_duplicates = dedupe.utils.filter_singletons(duplicate_partitions)
+    with instrumentation.stage('checksum_filter') as counters:
+        dedupe.utils.filter_singletons(duplicate_partitions,
+                                       counters=counters)
 
-    logger.info('Sorting redundant files by deduplication file savings')
-    partitions_sorted_by_size_reduction = []
-    for checksum, files in only_duplicates.items():
-        redundant_file_count = len(files)-1
-        redundant_occupied_size = files[0].size * redundant_file_count
-        partitions_sorted_by_size_reduction.append((redundant_occupied_size,
-                                                    files))
+    if writers is not None:
+        for writer in writers:
+            writer.close(potential_savings_total)
+    return potential_savings_total
 
-    partitions_sorted_by_size_reduction.sort(key=lambda x: x[0], reverse=True)
 
-    logger.info('Finalizing analysis')
+def find_duplicates_in_memory(args, instrumentation, prefilter_statistics,
+                              writers):
+    # nothing is read from or written to the database, for quick one-off
+    # scans of small trees
+    logger.info('Walking directory and collecting filenames and sizes')
+    with instrumentation.stage('walk') as counters:
+        filesizes = dedupe.filesystem.find_file_sizes(
+            within=args.paths, jobs=args.jobs, counters=counters,
+            walk_filter=walk_filter(args))
 
-    # if a file was specified to write the report to, then write it there.
-    # otherwise, write it to standard output.
-    if args.report_filepath:
-        output = open(args.report_filepath, 'w')
+    logger.info('Filtering out singleton size-partitions')
+    with instrumentation.stage('size_filter') as counters:
+        potential_duplicates = dedupe.utils.filter_singletons(
+            filesizes, counters=counters)
 
-    else:
-        output = sys.stdout
+        if args.target_savings:
+            potential_duplicates = \
+                dedupe.duplicates.rank_by_potential_savings(
+                    potential_duplicates)
 
+    logger.info('Finding duplicates within size-partitions by checksum')
     potential_savings_total = 0
-    for potential_savings, partition in partitions_sorted_by_size_reduction:
-        potential_savings_total += potential_savings
-        print('# {} in potential savings'.format(
-            humanfriendly.format_size(potential_savings, binary=True)),
-            file=output)
-        for f in partition:
-            print('{0.size: >13}\t{0.hash}\t{0.path}'.format(f),
-                  file=output)
+    with instrumentation.stage('repartition') as counters:
+        def found(potential_savings, partition):
+            nonlocal potential_savings_total
+            potential_savings_total += potential_savings
+            for writer in writers:
+                writer.write(potential_savings, partition)
 
-    print('# {} in total potential savings'.format(
-        humanfriendly.format_size(potential_savings_total, binary=True)),
-        file=output
-    )
+        duplicate_partitions = dedupe.duplicates.repartition(
+            filesize_partitions=potential_duplicates,
+            statistics=prefilter_statistics,
+            jobs=args.jobs, use_processes=args.processes,
+            target_savings=args.target_savings,
+            found=found if args.target_savings else None)
 
-    # if the user specified a removal script, then create a script that will
-    # preserve one file (the first file) and delete all duplicates
-    if args.removal_script:
-        with open(args.removal_script, 'w') as script:
-            cumulative_potential_savings = 0
-            for potential_savings, partition in\
-                    partitions_sorted_by_size_reduction:
+        _count_prefilter_stages(prefilter_statistics, counters)
 
-                cumulative_potential_savings += potential_savings
+    if args.target_savings:
+        for writer in writers:
+            writer.close(potential_savings_total)
+        return potential_savings_total
 
-                script.write('#'*120 + '\n')
-                script.write('# {} in potential savings\n'.format(
-                    humanfriendly.format_size(potential_savings, binary=True)))
-                script.write('# {} in cumulative savings\n'.format(
-                    humanfriendly.format_size(cumulative_potential_savings,
-                                              binary=True)))
+    logger.info('Filtering out singleton checksum-partitions')
+    with instrumentation.stage('checksum_filter') as counters:
+        duplicates = dedupe.utils.filter_singletons(duplicate_partitions,
+                                                    counters=counters)
 
-                for f in partition:
-                    script.write('# rm "{0.path}"\n'.format(f))
-                    
-                script.write('\n')
+    # the first file by path is preserved, as in reports from the database
+    logger.info('Writing report of duplicates by deduplication savings')
+    with instrumentation.stage('report'):
+        for files in duplicates.values():
+            for f in files:
+                f.sort_paths()
+            files.sort(key=lambda f: f.path)
+        ranked = dedupe.report.rank_by_savings(duplicates)
+        return dedupe.report.write_all(ranked, writers)
 
-    # if the user specified a symlink script, then create a script that will
-    # remove duplicates of a file and create a hard link
-    if args.hardlink_script:
-        with open(args.hardlink_script, 'w') as script:
-            cumulative_potential_savings = 0
-            for potential_savings, partition in\
-                    partitions_sorted_by_size_reduction:
-
-                cumulative_potential_savings += potential_savings
-
-                preserved_file = partition.pop(0)
-                script.write('#' * 80 + '\n')
-                script.write('# Preserving {}\n'.format(preserved_file.path))
-                script.write('# {} in potential savings\n'.format(
-                    humanfriendly.format_size(potential_savings, binary=True)))
-                script.write('# {} in cumulative savings\n'.format(
-                    humanfriendly.format_size(cumulative_potential_savings,
-                                              binary=True)))
-
-                for f in partition:
-                    # remove destination file and create hard link
-                    script.write('ln --force "{preserved}"'
-                                 '"{duplicate}"\n'.format(
-                        preserved=preserved_file.path,
-                        duplicate=f.path
-                    ))
 
-    print('='*80)
-    print('# {} in total potential savings'.format(
-        humanfriendly.format_size(
-            potential_savings_total,
-            binary=True)
-    ))
+def find_duplicates_out_of_core(args, instrumentation, prefilter_statistics):
+    # files are left in the database as they're found, and read back a few
+    # sizes at a time, so that memory use is bounded by args.memory_limit
+    # rather than by the number of files
+    import dedupe.checkpoint
+    import dedupe.db
+    import dedupe.external
+
+    max_files = dedupe.external.files_within(args.memory_limit)
+    checkpoint = dedupe.checkpoint.Checkpoint(
+        into=args.db, resume=args.resume,
+        interval=args.checkpoint_interval, max_unsaved=max_files,
+        memory_limit=args.memory_limit,
+        algorithm=prefilter_statistics.algorithm)
+
+    logger.info('Walking directory and saving filenames and sizes')
+    with instrumentation.stage('walk') as counters:
+        dedupe.external.spill_file_sizes(within=args.paths, jobs=args.jobs,
+                                         checkpoint=checkpoint,
+                                         counters=counters,
+                                         walk_filter=walk_filter(args))
+
+    logger.info('Merging files into database')
+    with instrumentation.stage('insert') as counters:
+        db = dedupe.db.insert_files(None, into=args.db,
+                                    prune_within=args.paths,
+                                    counters=counters,
+                                    checkpoint=checkpoint)
+
+    # digests are saved as they're computed, so there's no need to update
+    # the database with them afterwards
+    logger.info('Finding duplicates within size-partitions by checksum,'
+                ' {} files at a time'.format(max_files))
+    with instrumentation.stage('repartition') as counters:
+        dedupe.external.repartition(
+            db, max_files, statistics=prefilter_statistics,
+            jobs=args.jobs, use_processes=args.processes,
+            checkpoint=checkpoint, counters=counters)
+        _count_prefilter_stages(prefilter_statistics, counters)
+
+    checkpoint.clear()
+    logger.debug('{} checkpoints saved'.format(checkpoint.checkpoints))
+
+
+def _count_prefilter_stages(prefilter_statistics, counters):
+    for stage in prefilter_statistics.stages:
+        for counter in ('files_examined', 'files_eliminated',
+                        'files_read', 'bytes_read', 'bytes_avoided'):
+            counters['{0}.{1}'.format(stage.name.replace(' ', '_'),
+                                      counter)] += getattr(stage, counter)
+        counters['files_read'] += stage.files_read
+        counters['bytes_read'] += stage.bytes_read
 
 
 def existing_abspath(path):
@@ -194,6 +731,39 @@ def existing_abspath(path):
         raise ValueError('Path not found: {}'.format(os.path.abspath(path)))
 
 
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            'Expected a positive integer, but received {}'.format(value))
+    return value
+
+
+def byte_size(value):
+    try:
+        size = humanfriendly.parse_size(value)
+    except humanfriendly.InvalidSize as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+    if size < 1:
+        raise argparse.ArgumentTypeError(
+            'Expected a positive size, but received {}'.format(value))
+    return size
+
+
+def device_jobs(value):
+    # PATH=JOBS, as the device PATH is on and its number of workers
+    path, separator, jobs = value.rpartition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(
+            'Expected PATH=JOBS, but received {}'.format(value))
+    try:
+        device = os.stat(path).st_dev
+    except OSError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return device, positive_int(jobs)
+
+
 def get_arguments():
     parser = argparse.ArgumentParser(
         description="Description printed to command-line if -h is called."
@@ -209,6 +779,11 @@ def get_arguments():
     parser.add_argument('-o', '--output-to-file', dest='report_filepath',
                         help='write duplicate file consumption analysis to'
                              ' file (default: stdout)')
+    parser.add_argument('-f', '--format', dest='report_format',
+                        default='text',
+                        choices=sorted(dedupe.report.REPORT_FORMATS),
+                        help='format of the duplicate file analysis'
+                             ' (default: text)')
     parser.add_argument('-s', '--create-remove-script', dest='removal_script',
                         help='create script for removing duplicate files'
                              ' (default: no script)')
@@ -216,13 +791,241 @@ def get_arguments():
                         help='create script to remove duplicate files and '
                              'convert them to hard links. Linux only. '
                              '(default: no script)')
-    # TODO: only remove duplicates up to a point where a certain amount of
-    # space is available from removal
-    parser.add_argument('paths', metavar='PATH', nargs='+',
+    parser.add_argument('--apply', choices=sorted(dedupe.apply.METHODS),
+                        help='replace each duplicate with a hard link to, or'
+                             ' a reflinked clone of, the file preserved in'
+                             ' its place (default: replace nothing)')
+    parser.add_argument('--journal', metavar='JOURNAL_FILE',
+                        help='record replacements made by --apply here, so'
+                             ' that they can be resumed or rolled back'
+                             ' (default: DATABASE_FILE.journal)')
+    parser.add_argument('--rollback', action='store_true', default=False,
+                        help='undo the replacements recorded in the journal'
+                             ' and exit')
+    parser.add_argument('--min-size', metavar='SIZE', type=byte_size,
+                        help='skip files smaller than SIZE'
+                             ' (default: no minimum)')
+    parser.add_argument('--max-size', metavar='SIZE', type=byte_size,
+                        help='skip files larger than SIZE'
+                             ' (default: no maximum)')
+    parser.add_argument('--include', metavar='PATTERN', action='append',
+                        help='only keep files matching the glob PATTERN,'
+                             ' which may be given more than once'
+                             ' (default: every file)')
+    parser.add_argument('--exclude', metavar='PATTERN', action='append',
+                        help="skip files and directories matching the glob"
+                             " PATTERN, and don't descend into those"
+                             " directories. may be given more than once"
+                             " (default: skip nothing)")
+    parser.add_argument('--one-file-system', action='store_true',
+                        default=False,
+                        help="don't descend into directories on other file"
+                             " systems (default: cross mount points)")
+    parser.add_argument('-j', '--jobs', type=positive_int, default=1,
+                        help='number of directory scanning and hashing'
+                             ' workers'
+                             ' (default: 1)')
+    parser.add_argument('--processes', action='store_true', default=False,
+                        help='hash in worker processes rather than threads'
+                             ' (default: threads)')
+    parser.add_argument('--device-jobs', metavar='PATH=JOBS', type=device_jobs,
+                        action='append', default=[],
+                        help='how many workers may hash files on the device'
+                             ' PATH is on at once. may be given more than'
+                             ' once (default: 1 for spinning disks, and'
+                             ' --jobs for others)')
+    parser.add_argument('--hash', default='xxh64',
+                        choices=sorted(dedupe.hashing.ALGORITHMS),
+                        help='the algorithm files are checksummed with.'
+                             ' checksums from earlier scans are only reused'
+                             ' if they were computed by the same one'
+                             ' (default: xxh64)')
+    parser.add_argument('--verify', metavar='ALGORITHM',
+                        choices=sorted(dedupe.hashing.ALGORITHMS),
+                        help='read files found to share a checksum once'
+                             ' more, with a second algorithm such as blake3,'
+                             ' before they are reported as duplicates.'
+                             ' files verified by an earlier scan and'
+                             " unchanged since aren't read again"
+                             ' (default: no verification)')
+    parser.add_argument('--tree-hash', metavar='CHUNK_SIZE', type=byte_size,
+                        help='hash files larger than CHUNK_SIZE as trees of'
+                             ' CHUNK_SIZE chunks, --jobs chunks at a time,'
+                             ' and keep the digests of the chunks'
+                             ' (default: hash files whole)')
+    parser.add_argument('--read-strategy', default='readinto',
+                        choices=sorted(dedupe.readers.READERS),
+                        help='how files are read for hashing: chunked reads,'
+                             ' readinto a reused buffer, or mmap for large'
+                             ' files (default: readinto)')
+    parser.add_argument('--read-buffer', metavar='SIZE', type=byte_size,
+                        default=dedupe.readers.DEFAULT_BUFFER_SIZE,
+                        help='size of each read when hashing'
+                             ' (default: 1 MiB)')
+    parser.add_argument('--keep-cache', action='store_true', default=False,
+                        help='leave hashed files in the page cache'
+                             ' (default: evict them once hashed)')
+    parser.add_argument('--stats', metavar='STATS_FILE',
+                        dest='stats_filepath',
+                        help='write the time spent in each stage and what it'
+                             ' read, dropped and wrote to this file as JSON'
+                             ' (default: no statistics)')
+    parser.add_argument('--profile', metavar='PROFILE_DIRECTORY',
+                        dest='profile_directory',
+                        help='profile each stage, writing <stage>.prof files'
+                             ' to this directory (default: no profiling)')
+    parser.add_argument('--memory-limit', metavar='SIZE', type=byte_size,
+                        help='keep files in the database rather than in'
+                             ' memory, reading them back a few sizes at a'
+                             ' time, so that memory use stays roughly'
+                             ' within SIZE (default: no limit)')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='carry on from where an interrupted scan of the'
+                             ' same database left off'
+                             ' (default: start a new scan)')
+    parser.add_argument('--checkpoint-interval', metavar='SECONDS',
+                        type=positive_int,
+                        default=None,
+                        help='how often to save the progress of a scan'
+                             ' (default: 30)')
+    parser.add_argument('--target-savings', metavar='SIZE', type=byte_size,
+                        help='hash the sizes that could free the most'
+                             ' space first, report duplicates as they are'
+                             ' found, and stop once they would free SIZE'
+                             ' (default: hash everything)')
+    parser.add_argument('--no-db', action='store_true', default=False,
+                        help='scan, hash and report entirely in memory,'
+                             ' without reading or writing the database')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='report which files beneath PATH the database'
+                             ' already holds copies of, without adding them'
+                             ' to it')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='once the scan is done, keep the database'
+                             ' current as files beneath PATH change, until'
+                             ' interrupted. Linux only'
+                             ' (default: exit after the scan)')
+    parser.add_argument('--report-only', action='store_true', default=False,
+                        help='report on the duplicates already in the'
+                             ' database, beneath PATH if given, without'
+                             ' scanning (default: scan PATH)')
+    parser.add_argument('--shard', metavar='NAME',
+                        help='scan PATH into the database as the shard NAME,'
+                             ' and hash the sizes the last --merge asked'
+                             ' for (default: an ordinary database)')
+    parser.add_argument('--merge', action='store_true', default=False,
+                        help='report on the duplicates across the shards'
+                             ' given as PATH (default: scan PATH)')
+    parser.add_argument('--write-snapshot', metavar='DIRECTORY',
+                        help='write the files of the database to DIRECTORY'
+                             ' as a table that --read-snapshot maps into'
+                             ' memory. an existing DIRECTORY is only'
+                             ' replaced if it is an earlier snapshot.'
+                             ' requires numpy (default: no snapshot)')
+    parser.add_argument('--read-snapshot', metavar='DIRECTORY',
+                        help='with --report-only, report on the duplicates'
+                             ' in the snapshot in DIRECTORY rather than in'
+                             ' the database'
+                             ' (default: report from the database)')
+    parser.add_argument('paths', metavar='PATH', nargs='*',
                         type=existing_abspath,
                         help='the path to which files will be checked')
 
     args = parser.parse_args()
+    if not args.paths and not (args.report_only or args.rollback):
+        parser.error('at least one PATH is required unless --report-only'
+                     ' or --rollback is given')
+    if args.target_savings and (args.memory_limit or args.report_only):
+        parser.error('--target-savings cannot be combined with'
+                     ' --memory-limit or --report-only')
+    if args.no_db and (args.memory_limit or args.report_only
+                       or args.resume):
+        parser.error('--no-db cannot be combined with --memory-limit,'
+                     ' --report-only or --resume')
+    for name in (args.hash, args.verify):
+        try:
+            if name is not None:
+                dedupe.hashing.ALGORITHMS[name]().new()
+        except ImportError as e:
+            parser.error('--hash or --verify {0} requires a module that'
+                         ' is not installed: {1}'.format(name, e))
+    if args.check:
+        if not os.path.exists(args.db):
+            parser.error('--check looks files up in an existing database,'
+                         ' and {} does not exist'.format(args.db))
+        for option, given in (('--report-only', args.report_only),
+                              ('--no-db', args.no_db),
+                              ('--memory-limit', args.memory_limit),
+                              ('--target-savings', args.target_savings),
+                              ('--resume', args.resume),
+                              ('--apply', args.apply),
+                              ('--removal-script', args.removal_script),
+                              ('--hardlink-script', args.hardlink_script)):
+            if given:
+                parser.error('--check cannot be combined with {}'.format(
+                    option))
+    if args.watch:
+        if not sys.platform.startswith('linux'):
+            parser.error('--watch relies on inotify, which only Linux has')
+        for option, given in (('--report-only', args.report_only),
+                              ('--no-db', args.no_db),
+                              ('--check', args.check),
+                              ('--memory-limit', args.memory_limit),
+                              ('--target-savings', args.target_savings),
+                              ('--apply', args.apply)):
+            if given:
+                parser.error('--watch cannot be combined with {}'.format(
+                    option))
+    if args.shard:
+        for option, given in (('--report-only', args.report_only),
+                              ('--no-db', args.no_db),
+                              ('--check', args.check),
+                              ('--watch', args.watch),
+                              ('--merge', args.merge)):
+            if given:
+                parser.error('--shard cannot be combined with {}'.format(
+                    option))
+    if args.merge:
+        # the paths reported are on other hosts
+        for option, given in (('--report-only', args.report_only),
+                              ('--no-db', args.no_db),
+                              ('--check', args.check),
+                              ('--watch', args.watch),
+                              ('--memory-limit', args.memory_limit),
+                              ('--target-savings', args.target_savings),
+                              ('--resume', args.resume),
+                              ('--apply', args.apply),
+                              ('--removal-script', args.removal_script),
+                              ('--hardlink-script', args.hardlink_script),
+                              ('--write-snapshot', args.write_snapshot)):
+            if given:
+                parser.error('--merge cannot be combined with {}'.format(
+                    option))
+        for path in args.paths:
+            if not os.path.isfile(path):
+                parser.error('{} is not a shard'.format(path))
+    if args.write_snapshot or args.read_snapshot:
+        try:
+            import numpy
+        except ImportError as e:
+            parser.error('--write-snapshot and --read-snapshot require'
+                         ' numpy, which is not installed: {}'.format(e))
+    if args.write_snapshot and (args.no_db or args.check):
+        parser.error('--write-snapshot cannot be combined with --no-db or'
+                     ' --check')
+    if args.write_snapshot:
+        from dedupe.table import is_snapshot
+        if os.path.lexists(args.write_snapshot) \
+                and not is_snapshot(args.write_snapshot):
+            parser.error('{} exists, and is not a snapshot to replace'.format(
+                args.write_snapshot))
+    if args.read_snapshot:
+        if not args.report_only:
+            parser.error('--read-snapshot is only read by --report-only')
+        if not os.path.isdir(args.read_snapshot):
+            parser.error('no snapshot in {}'.format(args.read_snapshot))
+    if args.journal is None:
+        args.journal = args.db + '.journal'
     return args
 
 
@@ -0,0 +1,247 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# _IOW(0x94, 9, int) from linux/fs.h: makes the destination file share the
+# source's extents, on filesystems that support it such as btrfs and xfs
+FICLONE = 0x40049409
+
+
+class Journal(object):
+    # a JSON line for each replacement, written before it is made and again
+    # once it is done. replacements already done are skipped when a run is
+    # resumed with the same journal, and rollback() undoes them.
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        for entry in read_journal(path):
+            if entry['status'] == 'done':
+                self.done.add(entry['path'])
+            elif entry['status'] == 'rolled_back':
+                self.done.discard(entry['path'])
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def record(self, **entry):
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def read_journal(path):
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as journal:
+        return [json.loads(line) for line in journal if line.strip()]
+
+
+def _temporary_path(path):
+    # beside the path being replaced, so that it can be renamed over it
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{0}.dedupe-{1}'.format(
+        name, uuid.uuid4().hex[:8]))
+
+
+def _hardlink(preserved_path, path, stat):
+    temporary_path = _temporary_path(path)
+    os.link(preserved_path, temporary_path)
+    try:
+        os.replace(temporary_path, path)
+    except OSError:
+        os.remove(temporary_path)
+        raise
+
+
+def _reflink(preserved_path, path, stat):
+    import fcntl
+
+    temporary_path = _temporary_path(path)
+    try:
+        with open(preserved_path, 'rb') as source, \
+                open(temporary_path, 'xb') as destination:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+        # the clone is a file of its own, and keeps the replaced file's
+        # permissions, ownership and times
+        _restore_metadata(temporary_path, stat)
+        os.replace(temporary_path, path)
+
+    except OSError:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def _restore_metadata(path, stat):
+    os.chmod(path, stat['mode'])
+    try:
+        os.chown(path, stat['uid'], stat['gid'])
+    except PermissionError:
+        pass
+    os.utime(path, ns=(stat['atime_ns'], stat['mtime_ns']))
+
+
+METHODS = {
+    'hardlink': _hardlink,
+    'reflink': _reflink,
+}
+
+
+def _unchanged(file, stat):
+    # the file is still the one that was hashed
+    return (stat.st_size == file.size and stat.st_mtime_ns == file.mtime
+            and stat.st_ino == file.inode and stat.st_dev == file.device)
+
+
+class Deduplicator(object):
+    # replaces each duplicate with a hard link to, or a reflinked clone of,
+    # the preserved file of its set, in place of writing a script to do so.
+    # takes sets of identical files like the report writers in
+    # dedupe.report, and replaces them across a pool of threads.
+    def __init__(self, method, journal, jobs=1, counters=None):
+        self.method = method
+        self.replace = METHODS[method]
+        self.journal = journal
+        if counters is None:
+            counters = collections.Counter()
+        self.counters = counters
+
+        self.max_in_flight = jobs * 4
+        self.in_flight = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs)
+
+    def write(self, potential_savings, partition):
+        preserved_file = partition[0]
+        for f in partition[1:]:
+            for path in f.paths:
+                if path in self.journal.done:
+                    self.counters['already_replaced'] += 1
+                    continue
+
+                self.in_flight.append(self.executor.submit(
+                    self._replace, preserved_file, f, path))
+                if len(self.in_flight) >= self.max_in_flight:
+                    self.counters[self.in_flight.popleft().result()] += 1
+
+    def close(self, potential_savings_total):
+        while self.in_flight:
+            self.counters[self.in_flight.popleft().result()] += 1
+        self.executor.shutdown()
+
+    def _replace(self, preserved_file, file, path):
+        # runs in a worker thread, and returns what is to be counted
+        try:
+            preserved_stat = os.lstat(preserved_file.path)
+            stat = os.lstat(path)
+        except FileNotFoundError:
+            return 'skipped_missing'
+
+        # either may have changed since it was hashed, and its contents with
+        # it
+        if not (_unchanged(preserved_file, preserved_stat)
+                and _unchanged(file, stat)):
+            logger.warning('Skipping "{}", changed since it was'
+                           ' hashed'.format(path))
+            return 'skipped_changed'
+
+        # the inode too, so that paths that were hard links of one another
+        # are restored as such
+        original = {'mode': stat.st_mode & 0o7777, 'uid': stat.st_uid,
+                    'gid': stat.st_gid, 'atime_ns': stat.st_atime_ns,
+                    'mtime_ns': stat.st_mtime_ns, 'device': stat.st_dev,
+                    'inode': stat.st_ino}
+        self.journal.record(status='started', method=self.method, path=path,
+                            preserved=preserved_file.path, stat=original)
+        try:
+            self.replace(preserved_file.path, path, original)
+
+        except OSError as e:
+            logger.warning('Failed to replace "{0}": {1}'.format(path, e))
+            self.journal.record(status='failed', method=self.method,
+                                path=path, error=str(e))
+            return 'failed'
+
+        self.journal.record(status='done', method=self.method, path=path,
+                            preserved=preserved_file.path, stat=original)
+        return 'replaced'
+
+
+def _restore(entries):
+    # gives the first path a copy of the contents of its own, with its
+    # original permissions, ownership and times, and makes the paths that
+    # were hard links of it before they were replaced hard links of it again
+    path = entries[0]['path']
+    temporary_path = _temporary_path(path)
+    try:
+        shutil.copyfile(path, temporary_path)
+        _restore_metadata(temporary_path, entries[0]['stat'])
+        os.replace(temporary_path, path)
+
+    except OSError as e:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        logger.warning('Failed to restore "{0}": {1}'.format(path, e))
+        return ['failed'] * len(entries)
+
+    outcomes = ['restored']
+    for entry in entries[1:]:
+        try:
+            _hardlink(path, entry['path'], entry['stat'])
+        except OSError as e:
+            logger.warning('Failed to restore "{0}": {1}'.format(
+                entry['path'], e))
+            outcomes.append('failed')
+        else:
+            outcomes.append('restored')
+    return outcomes
+
+
+def rollback(journal_path, jobs=1, counters=None):
+    # undoes every replacement recorded as done, most recent first. the
+    # paths of each inode that was replaced are restored together, as one
+    # inode again. journals from before inodes were recorded have an inode
+    # for each path.
+    if counters is None:
+        counters = collections.Counter()
+
+    entries = collections.OrderedDict()
+    for entry in read_journal(journal_path):
+        if entry['status'] == 'done':
+            entries[entry['path']] = entry
+        elif entry['status'] == 'rolled_back':
+            entries.pop(entry['path'], None)
+
+    inodes = collections.OrderedDict()
+    for entry in reversed(entries.values()):
+        stat = entry['stat']
+        key = (stat['device'], stat['inode']) if 'inode' in stat \
+            else entry['path']
+        inodes.setdefault(key, []).append(entry)
+    inodes = list(inodes.values())
+
+    journal = Journal(journal_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for inode_entries, outcomes in zip(inodes,
+                                           executor.map(_restore, inodes)):
+            for entry, outcome in zip(inode_entries, outcomes):
+                counters[outcome] += 1
+                if outcome == 'restored':
+                    journal.record(status='rolled_back', path=entry['path'])
+    journal.close()
+
+    return counters
@@ -0,0 +1,172 @@
+import collections
+import csv
+import itertools
+import json
+import logging
+import os
+
+import humanfriendly
+
+import dedupe.db
+import dedupe.duplicates
+import dedupe.filesystem
+
+logger = logging.getLogger(__name__)
+
+
+def _archive_files(rows, algorithm, counters):
+    # files of the archive of one size. those changed since they were indexed
+    # are taken as they are now, without their stale digests, and those
+    # since removed are left out.
+    unchanged = []
+
+    def file_of_row(row):
+        path, bytesize, mtime, ctime, inode, device, blocks, checksum, \
+            first_block, last_block, chunks, row_algorithm, verified = row
+        try:
+            stat = os.stat(path)
+        except OSError:
+            counters['archive_missing'] += 1
+            return None
+
+        file = dedupe.filesystem.File(path, stat)
+        if file.signature == (bytesize, mtime, ctime, inode, device):
+            if row_algorithm == algorithm.name_for(bytesize):
+                file.hash = checksum
+                file.first_block = first_block
+                file.last_block = last_block
+                file.chunks = chunks
+                file.verified = verified
+            unchanged.append(file)
+        else:
+            counters['archive_changed'] += 1
+        return file
+
+    files = dedupe.filesystem.files_of_rows(rows, file_of_row)
+    return files, unchanged
+
+
+def find_matches(filesizes, db, within=None, statistics=None, jobs=1,
+                 use_processes=False, counters=None):
+    # yields each incoming file that the archive already holds a copy of,
+    # along with those copies. only sizes shared with the archive are
+    # hashed, and files of the archive only when their checksums aren't in
+    # the database already, so the cost grows with the incoming files
+    # rather than with the archive. the archive's new checksums are saved.
+    if statistics is None:
+        statistics = dedupe.duplicates.PrefilterStatistics()
+    if counters is None:
+        counters = collections.Counter()
+    algorithm = statistics.algorithm
+
+    sizes = sorted(filesizes)
+    for i in range(0, len(sizes), dedupe.db.SIZES_PER_QUERY):
+        rows = dedupe.db.files_of_sizes(
+            db, sizes[i:i + dedupe.db.SIZES_PER_QUERY], outside=within)
+        partitions = {}
+        archived = set()
+        unchanged = []
+        for bytesize, rows_of_size in itertools.groupby(
+                rows, key=lambda row: row[1]):
+            archive_files, unchanged_files = _archive_files(
+                rows_of_size, algorithm, counters)
+            if not archive_files:
+                continue
+
+            archived.update(id(file) for file in archive_files)
+            unchanged.extend(unchanged_files)
+            partitions[bytesize] = filesizes[bytesize] + archive_files
+            counters['incoming_candidates'] += len(filesizes[bytesize])
+            counters['archive_candidates'] += len(archive_files)
+
+        repartitioned = dedupe.duplicates.repartition(
+            partitions, statistics=statistics, jobs=jobs,
+            use_processes=use_processes)
+
+        # digests of archive files that haven't changed are kept, so that
+        # the next check needn't compute them again
+        dedupe.db.save_digests(unchanged, db, algorithm)
+        db.commit()
+
+        for files in repartitioned.values():
+            archive_files = [f for f in files if id(f) in archived]
+            if not archive_files:
+                continue
+
+            for file in files:
+                if id(file) not in archived:
+                    counters['matched'] += 1
+                    yield file, archive_files
+
+
+class TextMatches(object):
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, file, archive_files):
+        for path in file.paths:
+            print('{0.size: >13}\t{0.hash}\t{1}\t{2}'.format(
+                file, path, archive_files[0].path), file=self.output)
+
+    def close(self, matched, matched_size):
+        print('# {0} incoming files ({1}) already in the archive'.format(
+            matched, humanfriendly.format_size(matched_size, binary=True)),
+            file=self.output)
+
+
+class CSVMatches(object):
+    # a row for each path to each copy in the archive
+    columns = ('path', 'size', 'checksum', 'archive_path')
+
+    def __init__(self, output):
+        self.writer = csv.writer(output)
+        self.writer.writerow(self.columns)
+
+    def write(self, file, archive_files):
+        for path in file.paths:
+            for archive_file in archive_files:
+                for archive_path in archive_file.paths:
+                    self.writer.writerow((path, file.size, file.hash,
+                                          archive_path))
+
+    def close(self, matched, matched_size):
+        pass
+
+
+class JSONLinesMatches(object):
+    # an object per incoming path
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, file, archive_files):
+        archive_paths = [archive_path for archive_file in archive_files
+                         for archive_path in archive_file.paths]
+        for path in file.paths:
+            self.output.write(json.dumps({
+                'path': path,
+                'size': file.size,
+                'checksum': file.hash,
+                'archive_paths': archive_paths,
+            }) + '\n')
+
+    def close(self, matched, matched_size):
+        pass
+
+
+MATCH_FORMATS = {
+    'text': TextMatches,
+    'csv': CSVMatches,
+    'jsonl': JSONLinesMatches,
+}
+
+
+def write_matches(matches, writer):
+    matched = 0
+    matched_size = 0
+    for file, archive_files in matches:
+        matched += 1
+        matched_size += file.size
+        writer.write(file, archive_files)
+
+    writer.close(matched, matched_size)
+    return matched, matched_size
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import time
+
+import dedupe.db
+import dedupe.filesystem
+
+logger = logging.getLogger(__name__)
+
+# seconds between checkpoints. each one costs a commit, so this is the most
+# work an interrupted run can lose.
+CHECKPOINT_INTERVAL = 30
+
+
+def _path_range(directory):
+    # every path beneath the directory sorts between "directory/" and
+    # "directory0"
+    prefix = os.path.join(directory, '')
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _outermost(directories):
+    # a directory beneath another in the frontier is scanned along with it
+    outermost = []
+    for directory in sorted(directories):
+        if outermost and directory.startswith(os.path.join(outermost[-1],
+                                                           '')):
+            continue
+        outermost.append(directory)
+    return outermost
+
+
+class Checkpoint(object):
+    # saves the progress of a scan to the database as it goes: the files the
+    # walk has found and the directories it has yet to scan, and the digests
+    # of files as they are hashed. a scan started with resume set carries on
+    # from the last checkpoint, and one started without it discards any
+    # earlier walk.
+    #
+    # digests are saved with the files they belong to, so they are reused by
+    # any later scan whether or not it resumes.
+    #
+    # given max_unsaved, a checkpoint is also due whenever that many files
+    # have been found since the last, which bounds how many the walk holds.
+    def __init__(self, into, resume=False, interval=CHECKPOINT_INTERVAL,
+                 max_unsaved=None, memory_limit=None, algorithm=None):
+        self.db = dedupe.db.connect(into, memory_limit=memory_limit)
+        if interval is None:
+            interval = CHECKPOINT_INTERVAL
+        self.interval = interval
+        self.algorithm = algorithm
+        self.max_unsaved = max_unsaved
+        self.last_saved = time.perf_counter()
+        self.checkpoints = 0
+
+        # files hashed since the last checkpoint
+        self._hashed = []
+
+        if not resume:
+            self.clear()
+
+    def due(self, unsaved=0):
+        if self.max_unsaved is not None and unsaved >= self.max_unsaved:
+            return True
+        return time.perf_counter() - self.last_saved >= self.interval
+
+    def _saved(self):
+        self.db.commit()
+        self.last_saved = time.perf_counter()
+        self.checkpoints += 1
+
+    def save_walk(self, root, files, frontier):
+        dedupe.db.save_walked_files(files, self.db)
+        self.db.execute(dedupe.db.walks.insert().prefix_with('OR REPLACE'),
+                        {'root': root, 'frontier': json.dumps(frontier)})
+        self._saved()
+        logger.debug('Checkpoint of "{0}": {1} directories left'.format(
+            root, len(frontier)))
+
+    def restore_walk(self, root):
+        # the files found under root and the directories left to scan, or
+        # None if root's walk wasn't checkpointed
+        frontier = self.db.execute(
+            dedupe.db.walks.select().where(dedupe.db.walks.c.root == root))\
+            .fetchone()
+        if frontier is None:
+            return None
+
+        # files beneath the frontier will be found again, unless they've
+        # since been removed
+        table = dedupe.db.walked_files
+        frontier = _outermost(json.loads(frontier.frontier))
+        for directory in frontier:
+            low, high = _path_range(directory)
+            self.db.execute(table.delete().where(table.c.path >= low)
+                                          .where(table.c.path < high))
+        self.db.commit()
+
+        return self._restored_files(root), frontier
+
+    def _restored_files(self, root):
+        # rebuilt one at a time, as they may be too many to hold at once
+        table = dedupe.db.walked_files
+        low, high = _path_range(root)
+        rows = self.db.execute(table.select().where(table.c.path >= low)
+                                             .where(table.c.path < high))
+        for row in rows:
+            yield dedupe.filesystem.File.restore(
+                row.path, row.bytesize, row.mtime, row.ctime, row.inode,
+                row.device, row.blocks, row.hard_linked)
+
+    def hashed(self, files):
+        self._hashed.extend(files)
+        if self.due():
+            self.save_digests()
+
+    def save_digests(self):
+        dedupe.db.save_digests(self._hashed, self.db, self.algorithm)
+        self._hashed = []
+        self._saved()
+
+    def clear(self):
+        dedupe.db.clear_walk(self.db)
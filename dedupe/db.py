@@ -1,89 +1,668 @@
+import collections
+import functools
 import os
 
-import progressbar
+import dedupe.hashing
+import dedupe.utils
 from sqlalchemy import BigInteger
 from sqlalchemy import Binary
+from sqlalchemy import Boolean
+from sqlalchemy import bindparam
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
 from sqlalchemy import Column
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import MetaData
 from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import Text
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def insert_files(filesizes, into):
+# rows sent to sqlite per executemany() call
+BATCH_SIZE = 20000
+
+# sqlite's page cache, in KiB
+PAGE_CACHE_SIZE = 256 * 1024
+
+# sizes looked up per query by files_of_sizes(), well within sqlite's limit
+# on the number of parameters
+SIZES_PER_QUERY = 500
+
+# files found by the current scan are staged here, so that they can be merged
+# into the files table by a handful of set-based statements rather than a
+# query per file
+staged_files = Table(
+    'staged_files', MetaData(),
+    Column('path', String, primary_key=True),
+    Column('bytesize', Integer, nullable=False),
+    Column('mtime', BigInteger),
+    Column('ctime', BigInteger),
+    Column('inode', BigInteger),
+    Column('device', BigInteger),
+    Column('blocks', BigInteger),
+    prefixes=['TEMPORARY'],
+)
+
+_signature_columns = ('bytesize', 'mtime', 'ctime', 'inode', 'device')
+
+# columns merged from a scan into the files table
+_merged_columns = _signature_columns + ('blocks',)
+
+# progress of a scan, saved as it goes so that an interrupted scan can be
+# resumed. every path found by the walk so far, and for each directory being
+# walked, the directories yet to be scanned. an empty frontier means the walk
+# of that directory finished.
+walked_files = Table(
+    'walked_files', Base.metadata,
+    Column('path', String, primary_key=True),
+    Column('bytesize', Integer, nullable=False),
+    Column('mtime', BigInteger),
+    Column('ctime', BigInteger),
+    Column('inode', BigInteger),
+    Column('device', BigInteger),
+    Column('blocks', BigInteger),
+    Column('hard_linked', Boolean),
+)
+
+walks = Table(
+    'walks', Base.metadata,
+    Column('root', String, primary_key=True),
+    Column('frontier', Text, nullable=False),
+)
+
+# a database scanned as one shard of files spread over several hosts: the
+# name it goes by once merged with the others, and the sizes a merge found
+# it shares with other shards, whose files it has yet to hash in full
+shard = Table(
+    'shard', Base.metadata,
+    Column('name', String, primary_key=True),
+)
+
+requested_sizes = Table(
+    'requested_sizes', Base.metadata,
+    Column('bytesize', Integer, primary_key=True),
+)
+
+# the statements that merge the files found by a scan, held in the staged
+# table, into the files table
+def _select_reusable_digests(staged):
+    return text("""
+        SELECT files.path, files.checksum, files.first_block,
+               files.last_block, files.chunks, files.bytesize,
+               files.algorithm, files.verified
+        FROM {staged} JOIN files ON files.path = {staged}.path
+        WHERE (files.checksum IS NOT NULL OR files.first_block IS NOT NULL)
+          AND files.algorithm IN (:algorithm, :large_file_algorithm)
+          AND {unchanged}
+    """.format(staged=staged.name, unchanged=' AND '.join(
+        'files.{0} = {1}.{0}'.format(column, staged.name)
+        for column in _signature_columns)))
+
+
+# new files are inserted, and files whose stat signature changed have their
+# stale digests cleared. unchanged rows are left untouched, unless they were
+# recorded before their allocated blocks were.
+def _merge_staged_files(staged):
+    changed = ' OR '.join('files.{0} IS NOT excluded.{0}'.format(column)
+                          for column in _signature_columns)
+    return text("""
+        INSERT INTO files (path, {columns})
+        SELECT path, {columns} FROM {staged} WHERE true
+        ON CONFLICT (path) DO UPDATE SET
+            {assignments},
+            checksum = CASE WHEN {changed} THEN NULL ELSE files.checksum END,
+            first_block = CASE WHEN {changed} THEN NULL
+                               ELSE files.first_block END,
+            last_block = CASE WHEN {changed} THEN NULL
+                              ELSE files.last_block END,
+            chunks = CASE WHEN {changed} THEN NULL ELSE files.chunks END,
+            algorithm = CASE WHEN {changed} THEN NULL
+                             ELSE files.algorithm END,
+            verified = CASE WHEN {changed} THEN NULL ELSE files.verified END
+        WHERE {changed} OR files.blocks IS NOT excluded.blocks
+    """.format(
+        staged=staged.name,
+        columns=', '.join(_merged_columns),
+        assignments=', '.join('{0} = excluded.{0}'.format(column)
+                              for column in _merged_columns),
+        changed=changed))
+
+
+def _within(within, negate=False):
+    # a condition matching paths beneath any of the directories, or given
+    # negate, paths beneath none of them, and its parameters
+    if not within:
+        return '', {}
+
+    conditions = []
+    parameters = {}
+    for i, directory in enumerate(within):
+        prefix = os.path.join(directory, '')
+        conditions.append('(path >= :low{0} AND path < :high{0})'.format(i))
+        parameters['low{}'.format(i)] = prefix
+        parameters['high{}'.format(i)] = prefix[:-1] + chr(
+            ord(prefix[-1]) + 1)
+    return ' AND {0}({1})'.format('NOT ' if negate else '',
+                                  ' OR '.join(conditions)), parameters
+
+
+# each set of identical files, largest savings first. rows are first narrowed
+# to one per inode, so that hard links to the same file count once. rows
+# recorded before inodes were stand for an inode each. savings
+# are what every inode but the preserved one, that of the first path,
+# occupies. in an aggregate query with a single MIN(), sqlite takes bare
+# columns from the row holding the minimum, so "blocks" is the preserved
+# inode's. checksums are only compared with those of the same algorithm.
+_select_duplicate_groups = """
+    WITH inodes AS (
+        SELECT bytesize, checksum, algorithm, MIN(path) AS path,
+               MAX(COALESCE(blocks, (bytesize + 511) / 512)) AS blocks
+        FROM files
+        WHERE checksum IS NOT NULL{within}
+        GROUP BY bytesize, checksum, algorithm, COALESCE(device, -1),
+                 COALESCE(inode, path))
+    SELECT bytesize, checksum, algorithm,
+           (SUM(blocks) - blocks) * 512 AS savings, MIN(path)
+    FROM inodes
+    GROUP BY bytesize, checksum, algorithm
+    HAVING COUNT(*) > 1
+    ORDER BY savings DESC, bytesize DESC, checksum
+"""
+
+_select_duplicate_group = """
+    SELECT path, bytesize, mtime, ctime, inode, device,
+           COALESCE(blocks, (bytesize + 511) / 512) AS blocks, checksum
+    FROM files
+    WHERE bytesize = :bytesize AND checksum = :checksum
+      AND algorithm IS :algorithm{within}
+    ORDER BY path
+"""
+
+
+# every file of the given sizes, in order of size. sqlite looks up each size
+# in the index on size and checksum, rather than scanning the table.
+_select_files_of_sizes = """
+    SELECT path, bytesize, mtime, ctime, inode, device,
+           COALESCE(blocks, (bytesize + 511) / 512) AS blocks, checksum,
+           first_block, last_block, chunks, algorithm, verified
+    FROM files
+    WHERE bytesize IN ({sizes}){condition}
+    ORDER BY bytesize, path
+"""
+
+# every file, in order of path, for a snapshot of the table
+_select_all_files = """
+    SELECT path, bytesize, mtime, ctime, inode, device,
+           COALESCE(blocks, (bytesize + 511) / 512) AS blocks, checksum,
+           algorithm
+    FROM files
+    ORDER BY path
+"""
+
+# the sizes shared by more than one of the files found by the walk, and how
+# many files have each, in order of size
+_select_partition_sizes = text("""
+    SELECT bytesize, COUNT(*) FROM walked_files
+    WHERE bytesize > :after
+    GROUP BY bytesize HAVING COUNT(*) > 1
+    ORDER BY bytesize
+    LIMIT :limit
+""")
+
+_select_partitioned_files = text("""
+    SELECT walked_files.*, files.checksum, files.first_block,
+           files.last_block, files.chunks, files.algorithm, files.verified
+    FROM walked_files JOIN files ON files.path = walked_files.path
+    WHERE walked_files.bytesize IN (
+        SELECT bytesize FROM walked_files
+        WHERE bytesize BETWEEN :low AND :high
+        GROUP BY bytesize HAVING COUNT(*) > 1)
+    ORDER BY walked_files.bytesize, walked_files.path
+""")
+
+_index_walked_sizes = text("""
+    CREATE INDEX IF NOT EXISTS walked_files_bytesize
+    ON walked_files (bytesize)
+""")
+
+
+_delete_file = text('DELETE FROM files WHERE path = :path')
+
+
+def _delete_missing_files(staged):
+    return text("""
+        DELETE FROM files
+        WHERE path >= :low AND path < :high
+          AND path NOT IN (SELECT path FROM {staged})
+    """.format(staged=staged.name))
+
+
+def connect(into, memory_limit=None):
     db_filepath = os.path.abspath(into)
-    logger.debug('.'*80)
-    logger.debug('Adding file and bytesizes to database')
-
     engine = create_engine('sqlite:///{}'.format(db_filepath), echo=False)
+    event.listen(engine, 'connect', functools.partial(
+        _tune_connection, memory_limit=memory_limit))
+
     if not os.path.exists(into):
         logger.debug("{} doesn't exist, and will be initialized".format(into))
-        Base.metadata.create_all(engine)
+
+    else:
+        _upgrade_schema(engine)
+
+    # creates only the tables that are missing
+    Base.metadata.create_all(engine)
 
     Session = sessionmaker(bind=engine)
-    session = Session()
+    return Session()
 
-    file_count = sum([len(files_matching_size)
-                      for files_matching_size in filesizes.values()])
-    bar = progressbar.ProgressBar(max_value=file_count)
 
-    i = 0
-    for filesize, files_matching_size in filesizes.items():
-        logger.debug('Adding {0}-byte files ({1} files)'.format(
-            filesize,
-            len(files_matching_size)))
+def _tune_connection(dbapi_connection, connection_record, memory_limit=None):
+    cursor = dbapi_connection.cursor()
+    # with a write-ahead log, commits append to the log rather than rewrite
+    # pages in place, and need only be synced at checkpoints
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    if memory_limit is None:
+        cursor.execute('PRAGMA cache_size=-{}'.format(PAGE_CACHE_SIZE))
+        cursor.execute('PRAGMA temp_store=MEMORY')
+
+    else:
+        # a quarter of the limit goes to sqlite, and sorts and temporary
+        # tables that outgrow it spill to disk
+        cursor.execute('PRAGMA cache_size=-{}'.format(
+            min(PAGE_CACHE_SIZE, max(memory_limit // 4 // 1024, 1024))))
+        cursor.execute('PRAGMA temp_store=FILE')
+    cursor.close()
+
+
+def _count_paths(partitions):
+    return sum(len(file.links) + 1 if file.links else 1
+               for files in partitions.values()
+               for file in files)
 
-        for file in files_matching_size:
-            possibly_non_existent_record = session.query(FileInformation)\
-                                                  .filter_by(path=file.path)\
-                                                  .first()
 
-            if possibly_non_existent_record is None:
-                session.add(FileInformation(path=file.path, bytesize=filesize))
+def _batches(iterable, size=BATCH_SIZE):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
 
-            else:
-                if possibly_non_existent_record.bytesize != filesize:
-                    possibly_non_existent_record.bytesize = filesize
+    if batch:
+        yield batch
 
-            if i % 2000 == 0:
-                session.commit()
 
+def insert_files(filesizes, into, prune_within=None, counters=None,
+                 checkpoint=None, algorithm=None):
+    logger.debug('.'*80)
+    logger.debug('Adding file and bytesizes to database')
+
+    if algorithm is None:
+        algorithm = dedupe.hashing.DEFAULT_ALGORITHM
+
+    if checkpoint is not None:
+        session = checkpoint.db
+    else:
+        session = connect(into)
+    connection = session.connection()
+
+    if checkpoint is not None:
+        # the walk already wrote every path it found to the database as it
+        # went, so they're merged from there rather than sent again
+        staged = walked_files
+        i = session.query(walked_files).count()
+
+    else:
+        staged = staged_files
+        staged_files.create(connection)
+        bar = dedupe.utils.progress_bar(_count_paths(filesizes))
+        rows = _staged_rows(file for files_matching_size in filesizes.values()
+                            for file in files_matching_size)
+
+        i = 0
+        insert = staged_files.insert().prefix_with('OR IGNORE')
+        for batch in _batches(rows):
+            connection.execute(insert, batch)
+
+            i += len(batch)
             bar.update(i)
-            i += 1
 
+    if counters is None:
+        counters = collections.Counter()
+    counters['rows_staged'] += i
+
+    # files held only on disk read their digests back when they're hashed
+    if filesizes is not None:
+        reused_checksums = _reuse_digests(
+            (file for files_matching_size in filesizes.values()
+             for file in files_matching_size), connection, staged, algorithm)
+        logger.info('Reusing {} checksums from a previous scan'.format(
+            reused_checksums))
+        counters['checksums_reused'] += reused_checksums
+
+    result = connection.execute(_merge_staged_files(staged))
+    logger.debug('{} rows inserted or updated'.format(result.rowcount))
+    counters['rows_written'] += result.rowcount
+
+    if prune_within is not None:
+        counters['rows_pruned'] += prune_missing_files(within=prune_within,
+                                                       db=session,
+                                                       staged=staged)
+
+    if staged is staged_files:
+        staged_files.drop(connection)
     session.commit()
     return session
 
 
-def update_with_checksums(partitions, db):
+def _staged_rows(files):
+    # every hard link to a file is recorded as a row of its own, so rows
+    # sharing a device and inode make up a set of hard links
+    return (dict(zip(('path',) + _merged_columns,
+                     (path,) + file.signature + (file.allocated // 512,)))
+            for file in files
+            for path in file.paths)
+
+
+def _reuse_digests(files, connection, staged, algorithm):
+    # files unchanged since they were last hashed needn't be hashed again
+    files_by_path = dict((path, file) for file in files
+                         for path in file.paths)
+    reused_checksums = 0
+    for path, checksum, first_block, last_block, chunks, bytesize, \
+            row_algorithm, verified in connection.execute(
+                _select_reusable_digests(staged),
+                {'algorithm': algorithm.name_for(0),
+                 'large_file_algorithm': algorithm.name}):
+        # digests of files hashed as trees are only reused for files large
+        # enough to have been hashed as trees again
+        if row_algorithm != algorithm.name_for(bytesize):
+            continue
+
+        file = files_by_path[path]
+        file.hash = checksum
+        file.first_block = first_block
+        file.last_block = last_block
+        file.chunks = chunks
+        file.verified = verified
+        if checksum is not None:
+            reused_checksums += 1
+
+    return reused_checksums
+
+
+def update_files(files, db, removed=(), removed_within=(), counters=None,
+                 algorithm=None):
+    # applies changes to a handful of files without a scan, as when a watch
+    # reports them. the removed paths, and every path beneath the removed
+    # directories, are deleted first. the files are then merged into the
+    # files table just as insert_files() merges those found by a scan, and
+    # reuse the digests of those unchanged.
+    if counters is None:
+        counters = collections.Counter()
+    if algorithm is None:
+        algorithm = dedupe.hashing.DEFAULT_ALGORITHM
+
+    connection = db.connection()
+    for batch in _batches({'path': path} for path in removed):
+        counters['rows_removed'] += connection.execute(
+            _delete_file, batch).rowcount
+
+    for directory in removed_within:
+        condition, parameters = _within([directory])
+        counters['rows_removed'] += connection.execute(
+            text('DELETE FROM files WHERE true' + condition),
+            parameters).rowcount
+
+    staged_files.create(connection)
+    insert = staged_files.insert().prefix_with('OR IGNORE')
+    for batch in _batches(_staged_rows(files)):
+        connection.execute(insert, batch)
+        counters['rows_staged'] += len(batch)
+    counters['checksums_reused'] += _reuse_digests(files, connection,
+                                                   staged_files, algorithm)
+    counters['rows_written'] += connection.execute(
+        _merge_staged_files(staged_files)).rowcount
+    staged_files.drop(connection)
+    db.commit()
 
-    file_count = sum([len(files_with_checksum)
-                      for files_with_checksum in partitions.values()])
 
-    bar = progressbar.ProgressBar(max_value=file_count)
+def prune_missing_files(within, db, staged=staged_files):
+    # remove records of files beneath the scanned directories that weren't
+    # found by this scan, i.e. files that have been deleted or renamed. must
+    # be called while the scan's files are still staged.
+    pruned = 0
+    for directory in within:
+        # every path beneath the directory sorts between "directory/" and
+        # "directory0", which lets sqlite scan just that range of the index
+        prefix = os.path.join(directory, '')
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        result = db.execute(_delete_missing_files(staged),
+                            {'low': prefix, 'high': upper_bound})
+        pruned += result.rowcount
+
+    logger.info('Pruned {} records of missing files'.format(pruned))
+    return pruned
+
+
+def _digest_rows(files, algorithm=None):
+    # files eliminated by a prefilter stage are never fully hashed, but their
+    # first-block digest is still worth keeping
+    if algorithm is None:
+        algorithm = dedupe.hashing.DEFAULT_ALGORITHM
+
+    return ({'_path': path, 'checksum': f.hash,
+             'first_block': f.first_block, 'last_block': f.last_block,
+             'chunks': f.chunks, 'algorithm': algorithm.name_for(f.size),
+             'verified': f.verified}
+            for f in files
+            if f.hash is not None or f.first_block is not None
+            for path in f.paths)
+
+
+def update_with_checksums(partitions, db, counters=None, algorithm=None):
+
+    bar = dedupe.utils.progress_bar(_count_paths(partitions))
+
+    rows = _digest_rows((f for files in partitions.values() for f in files),
+                        algorithm)
+
     i = 0
-    for checksum, files in partitions.items():
-        for f in files:
-            current_record = db.query(FileInformation) \
-                               .filter_by(path=f.path) \
-                               .first()
-            current_record.checksum = checksum
+    for batch in _batches(rows):
+        db.execute(_update_digests(), batch)
 
-            bar.update(i)
-            i += 1
+        i += len(batch)
+        bar.update(i)
+
+    db.commit()
+
+    if counters is not None:
+        counters['rows_written'] += i
+
+
+def save_walked_files(files, db):
+    # a directory interrupted part way through its scan may be scanned again,
+    # and its files found again
+    insert = walked_files.insert().prefix_with('OR REPLACE')
+    rows = ({'path': f.path, 'bytesize': f.size, 'mtime': f.mtime,
+             'ctime': f.ctime, 'inode': f.inode, 'device': f.device,
+             'blocks': f.allocated // 512, 'hard_linked': f.links is not None}
+            for f in files)
+    for batch in _batches(rows):
+        db.execute(insert, batch)
 
-            if i % 2000 == 0:
-                db.commit()
 
+def save_digests(files, db, algorithm=None):
+    for batch in _batches(_digest_rows(files, algorithm)):
+        db.execute(_update_digests(), batch)
+
+
+def walked_partitions(db, max_files):
+    # rows of the files found by the walk that share their size with
+    # another, a few sizes at a time, so that only those being partitioned
+    # are held in memory. each batch holds rows for no more than max_files
+    # files, unless a single size has more.
+    db.execute(_index_walked_sizes)
+    db.commit()
+
+    after = -1
+    while True:
+        sizes = db.execute(_select_partition_sizes,
+                           {'after': after, 'limit': max(max_files // 2, 1)})\
+            .fetchall()
+        if not sizes:
+            return
+
+        held = 0
+        for i, (bytesize, count) in enumerate(sizes):
+            if i > 0 and held + count > max_files:
+                break
+            held += count
+            after = bytesize
+
+        yield db.execute(_select_partitioned_files,
+                         {'low': sizes[0][0], 'high': after}).fetchall()
+
+
+def clear_walk(db):
+    db.execute(walked_files.delete())
+    db.execute(walks.delete())
+    db.execute('DROP INDEX IF EXISTS walked_files_bytesize')
     db.commit()
 
 
+def duplicate_groups(db, within=None):
+    # each set of identical files beneath the directories, or in the whole
+    # database, largest savings first, as (savings, rows of its files). the
+    # rows are tuples of (path, bytesize, mtime, ctime, inode, device,
+    # blocks, checksum).
+    condition, parameters = _within(within)
+
+    # a query per set is run on the sqlite connection directly, as going
+    # through sqlalchemy costs several times as much as the query itself
+    connection = db.connection().connection
+    groups = connection.execute(
+        _select_duplicate_groups.format(within=condition), parameters)
+    select_group = _select_duplicate_group.format(within=condition)
+    for bytesize, checksum, algorithm, savings, _ in groups:
+        group_parameters = dict(parameters, bytesize=bytesize,
+                                checksum=checksum, algorithm=algorithm)
+        yield savings, connection.execute(select_group,
+                                          group_parameters).fetchall()
+
+
+def files_of_sizes(db, sizes, outside=None, within=None):
+    # rows of the files of the given sizes that aren't beneath any of the
+    # outside directories, or given within, that are beneath one of those,
+    # as tuples of (path, bytesize, mtime, ctime, inode, device, blocks,
+    # checksum, first_block, last_block, chunks, algorithm, verified)
+    if within:
+        condition, parameters = _within(within)
+    else:
+        condition, parameters = _within(outside, negate=True)
+    parameters.update(('size{}'.format(i), size)
+                      for i, size in enumerate(sizes))
+    query = _select_files_of_sizes.format(
+        sizes=', '.join(':size{}'.format(i) for i in range(len(sizes))),
+        condition=condition)
+    return db.connection().connection.execute(query, parameters).fetchall()
+
+
+def all_files(db):
+    # rows of every file in order of path, as tuples of (path, bytesize,
+    # mtime, ctime, inode, device, blocks, checksum, algorithm), fetched as
+    # they're iterated over
+    return db.connection().connection.execute(_select_all_files)
+
+
+def size_counts(db):
+    # how many files there are of each size, as (bytesize, count) tuples
+    return db.execute(text("""
+        SELECT bytesize, COUNT(*) FROM files GROUP BY bytesize
+    """)).fetchall()
+
+
+def shard_name(db):
+    return db.execute(shard.select()).scalar()
+
+
+def set_shard_name(db, name):
+    db.execute(shard.delete())
+    db.execute(shard.insert(), {'name': name})
+    db.commit()
+
+
+def requests(db):
+    # the sizes a merge asked this shard to hash
+    return sorted(bytesize for bytesize, in db.execute(
+        requested_sizes.select()))
+
+
+def set_requests(db, sizes):
+    # replaces whatever was asked for before, as each merge works out
+    # afresh what is missing
+    db.execute(requested_sizes.delete())
+    for batch in _batches({'bytesize': bytesize} for bytesize in sizes):
+        db.execute(requested_sizes.insert(), batch)
+    db.commit()
+
+
+def _update_digests():
+    return FileInformation.__table__.update()\
+        .where(FileInformation.path == bindparam('_path'))\
+        .values(checksum=bindparam('checksum'),
+                first_block=bindparam('first_block'),
+                last_block=bindparam('last_block'),
+                chunks=bindparam('chunks'),
+                algorithm=bindparam('algorithm'),
+                verified=bindparam('verified'))
+
+
+def _upgrade_schema(engine):
+    # databases created by earlier versions lack some of the newer columns
+    # and indexes
+    inspector = inspect(engine)
+    existing_columns = set(column['name'] for column in
+                           inspector.get_columns(
+                               FileInformation.__tablename__))
+    existing_indexes = set(index['name'] for index in
+                           inspector.get_indexes(
+                               FileInformation.__tablename__))
+
+    for column in FileInformation.__table__.columns:
+        if column.name in existing_columns:
+            continue
+
+        logger.debug('Adding column "{}" to database'.format(column.name))
+        engine.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+            FileInformation.__tablename__, column.name,
+            column.type.compile(engine.dialect)))
+
+        # every digest recorded before the algorithm was is an xxh64 digest
+        if column.name == 'algorithm':
+            engine.execute(
+                "UPDATE files SET algorithm = 'xxh64'"
+                " WHERE checksum IS NOT NULL OR first_block IS NOT NULL")
+
+    for index in FileInformation.__table__.indexes:
+        if index.name in existing_indexes:
+            continue
+
+        logger.debug('Adding index "{}" to database'.format(index.name))
+        index.create(engine)
+
+
 class FileInformation(Base):
      __tablename__ = 'files'
 
@@ -92,6 +671,43 @@ class FileInformation(Base):
      checksum = Column(String)
      first_block = Column(Binary)
 
+     # the digest of the last block, for files large enough that it's read
+     # apart from the first
+     last_block = Column(Binary)
+
+     # the digests of each chunk of a large file hashed as a tree, one after
+     # another
+     chunks = Column(Binary)
+
+     # the hash algorithm of the checksum and first-block digest
+     algorithm = Column(String)
+
+     # the algorithm the file was verified with, once read a second time
+     # along with the files that share its checksum
+     verified = Column(String)
+
+     # modification and change times are in nanoseconds
+     mtime = Column(BigInteger)
+     ctime = Column(BigInteger)
+     inode = Column(BigInteger)
+     device = Column(BigInteger)
+
+     # allocated 512-byte blocks
+     blocks = Column(BigInteger)
+
+     # duplicates share a size and checksum, and reports look them up by both
+     __table_args__ = (Index('files_bytesize_checksum', 'bytesize',
+                             'checksum'),)
+
+     @property
+     def signature(self):
+         return self.bytesize, self.mtime, self.ctime, self.inode, self.device
+
+     @signature.setter
+     def signature(self, signature):
+         (self.bytesize, self.mtime, self.ctime,
+          self.inode, self.device) = signature
+
      def __repr__(self):
         return "<File(size={size}, path={path})>".format(
             size=self.bytesize, path=self.path
@@ -1,68 +1,866 @@
 import logging
 
 import collections
+import concurrent.futures
+import contextlib
+import itertools
+import os
 import pprint
 
 import progressbar
 
+import dedupe.hashing
+import dedupe.readers
+import dedupe.scheduler
+import dedupe.utils
+
 logger = logging.getLogger(__name__)
 
+BLOCK_SIZE = 4096
+
+# groups of at most this many files, each at least this large, are compared
+# with one another rather than hashed
+COMPARISON_MAX_GROUP_SIZE = 3
+COMPARISON_MIN_FILE_SIZE = 1024 * 1024
+
 
-def _load_first_block(path, bytes_to_read=4096):
+def _load_first_block(path, bytes_to_read=BLOCK_SIZE):
     with open(path, 'rb') as f:
         first_block = f.read(bytes_to_read)
     return first_block
 
-# TODO: this could probably be sped up by looking at the first k bytes of
-#  each file
+
+def _load_last_block(path, bytes_to_read=BLOCK_SIZE):
+    with open(path, 'rb') as f:
+        f.seek(-bytes_to_read, os.SEEK_END)
+        last_block = f.read(bytes_to_read)
+    return last_block
+
+
+class PrefilterStage(object):
+    # a stage splits a group of same-size files by some digest of their
+    # contents. files that end up alone in their group are dropped before the
+    # more expensive stages that follow have to read them.
+    name = None
+    final = False
+
+    def __init__(self, block_size=BLOCK_SIZE, algorithm=None):
+        if algorithm is None:
+            algorithm = dedupe.hashing.DEFAULT_ALGORITHM
+
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.files_examined = 0
+        self.files_eliminated = 0
+        self.files_read = 0
+        self.bytes_read = 0
+        self.bytes_avoided = 0
+
+    def applies_to(self, bytesize):
+        return True
+
+    def applies_to_group(self, group):
+        # checksums reused from a previous scan make the prefilter stages
+        # pointless
+        return self.final or any(file.hash is None for file in group)
+
+    def split(self, group):
+        digest_to_files = collections.defaultdict(list)
+        for file in group:
+            digest_to_files[self.key(file)].append(file)
+        return list(digest_to_files.values())
+
+    def unread(self, file, bytes_read):
+        # the bytes of an eliminated file that no stage had to read, given how
+        # many the stages up to this one read from each file
+        return max(file.size - bytes_read, 0)
+
+    def merge(self, other):
+        self.files_examined += other.files_examined
+        self.files_eliminated += other.files_eliminated
+        self.files_read += other.files_read
+        self.bytes_read += other.bytes_read
+        self.bytes_avoided += other.bytes_avoided
+
+    def bytes_to_read(self, bytesize):
+        raise NotImplementedError
+
+    def key(self, file):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<{0}(examined={1}, eliminated={2}, read={3}, avoided={4})>'\
+            .format(self.__class__.__name__, self.files_examined,
+                    self.files_eliminated, self.bytes_read, self.bytes_avoided)
+
+
+class FirstBlockStage(PrefilterStage):
+    name = 'first block'
+
+    def bytes_to_read(self, bytesize):
+        return min(bytesize, self.block_size)
+
+    def key(self, file):
+        if file.first_block is None:
+            block = _load_first_block(file.path, self.block_size)
+            hasher = self.algorithm.new()
+            hasher.update(block)
+            file.first_block = hasher.digest()
+
+            # a file no larger than one block has just been read in its
+            # entirety, so its first-block digest doubles as its checksum
+            if file.size <= self.block_size and file.hash is None:
+                file.hash = hasher.hexdigest()
+                file.chunks = self.algorithm.chunks(hasher)
+
+            self.files_read += 1
+            self.bytes_read += len(block)
+
+        return file.first_block
+
+
+class TailBlockStage(PrefilterStage):
+    name = 'tail block'
+
+    def applies_to(self, bytesize):
+        # for files of up to two blocks, reading the tail costs nearly as much
+        # as reading the whole file
+        return bytesize > 2 * self.block_size
+
+    def bytes_to_read(self, bytesize):
+        return self.block_size
+
+    def key(self, file):
+        if file.last_block is None:
+            block = _load_last_block(file.path, self.block_size)
+            self.files_read += 1
+            self.bytes_read += len(block)
+            hasher = self.algorithm.new()
+            hasher.update(block)
+            file.last_block = hasher.digest()
+        return file.last_block
+
+
+class ComparisonStage(PrefilterStage):
+    # reads the members of a small group side by side, a chunk at a time, and
+    # splits the group as soon as their contents diverge. a file left without
+    # company is dropped without being read to the end, which matters most
+    # for large files that differ only somewhere in the middle. files that
+    # stay together to the end have their checksum computed along the way,
+    # from the contents of just one of them.
+    name = 'comparison'
+
+    def __init__(self, block_size=BLOCK_SIZE,
+                 buffer_size=dedupe.readers.DEFAULT_BUFFER_SIZE,
+                 max_group_size=COMPARISON_MAX_GROUP_SIZE,
+                 min_file_size=COMPARISON_MIN_FILE_SIZE, algorithm=None):
+        super(ComparisonStage, self).__init__(block_size, algorithm)
+        self.buffer_size = buffer_size
+        self.max_group_size = max_group_size
+        self.min_file_size = min_file_size
+        self._bytes_compared = {}
+
+    def applies_to(self, bytesize):
+        # files hashed as trees of several chunks are compared by the chunk
+        # stage instead, which reads several ranges of each at once
+        if isinstance(self.algorithm, dedupe.hashing.TreeHash) \
+                and bytesize > self.algorithm.chunk_size:
+            return False
+        return bytesize >= self.min_file_size
+
+    def applies_to_group(self, group):
+        # in larger groups, each file that diverges still has to be read
+        # alongside the rest, and hashing is simpler. files already hashed
+        # take part through one of each checksum.
+        return (any(file.hash is None for file in group)
+                and len(self._participants(group)[0]) <= self.max_group_size)
+
+    def bytes_to_read(self, bytesize):
+        # varies with where the files diverge, and is accounted for by
+        # unread() instead
+        return 0
+
+    def unread(self, file, bytes_read):
+        bytes_read += self._bytes_compared.pop(id(file))
+        return max(file.size - bytes_read, 0)
+
+    def _participants(self, group):
+        # the files yet to be hashed, and one of the files of each checksum
+        # already known, to compare them with
+        participants = [file for file in group if file.hash is None]
+        hashed = collections.OrderedDict()
+        for file in group:
+            if file.hash is not None:
+                hashed.setdefault(file.hash, []).append(file)
+        participants.extend(files[0] for files in hashed.values())
+        return participants, hashed
+
+    def _read(self, handle, buffer):
+        # raw reads may return less than asked for before the end of a file,
+        # so the buffer is filled unless the file ends first
+        size = 0
+        with memoryview(buffer) as view:
+            while size < len(buffer):
+                read = handle.readinto(view[size:])
+                if not read:
+                    break
+                size += read
+        return size
+
+    def split(self, group):
+        self._bytes_compared.clear()
+        participants, hashed = self._participants(group)
+        self.files_read += len(participants)
+        resolved = []
+        with contextlib.ExitStack() as stack:
+            handles = dict((id(file), stack.enter_context(
+                               open(file.path, 'rb', buffering=0)))
+                           for file in participants)
+            buffers = dict((id(file), bytearray(self.buffer_size))
+                           for file in participants)
+
+            # files whose contents have been identical so far, along with a
+            # hasher that has consumed those contents and how many bytes it
+            # has consumed
+            unresolved = [(participants, self.algorithm.new(), 0)]
+            while unresolved:
+                still_unresolved = []
+                for files, hasher, offset in unresolved:
+                    # a list rather than a dict keyed by chunk, which would
+                    # hash every chunk just to compare two or three of them
+                    chunks = []
+                    for file in files:
+                        buffer = buffers[id(file)]
+                        size = self._read(handles[id(file)], buffer)
+                        chunk = memoryview(buffer)[:size]
+                        self.bytes_read += size
+                        for existing_chunk, matching_files in chunks:
+                            if existing_chunk == chunk:
+                                matching_files.append(file)
+                                break
+                        else:
+                            chunks.append((chunk, [file]))
+
+                    for chunk, matching_files in chunks:
+                        if len(matching_files) == 1:
+                            self._bytes_compared[id(matching_files[0])] = \
+                                offset + len(chunk)
+                            resolved.append(matching_files)
+                            continue
+
+                        if len(chunks) > 1:
+                            matching_hasher = hasher.copy()
+                        else:
+                            matching_hasher = hasher
+
+                        if not chunk:
+                            self._finish(matching_files, matching_hasher)
+                            resolved.append(matching_files)
+                            continue
+
+                        matching_hasher.update(chunk)
+                        still_unresolved.append((matching_files,
+                                                 matching_hasher,
+                                                 offset + len(chunk)))
+
+                unresolved = still_unresolved
+
+        # the files compared through one of their checksum rejoin it
+        siblings = dict((id(files[0]), files[1:]) for files in hashed.values())
+        return [files + [other for file in files
+                         for other in siblings.get(id(file), [])]
+                for files in resolved]
+
+    def _finish(self, files, hasher):
+        # files identical to the end take the checksum of any among them
+        # already hashed, or the one computed along the way
+        known = [file for file in files if file.hash is not None]
+        if known:
+            checksum, chunk_digests = known[0].hash, known[0].chunks
+        else:
+            checksum = hasher.hexdigest()
+            chunk_digests = self.algorithm.chunks(hasher)
+        for file in files:
+            if file.hash is None:
+                file.hash = checksum
+                file.chunks = chunk_digests
+
+
+class ChunkStage(PrefilterStage):
+    # large files hashed as trees keep the digests of their chunks. files of
+    # the same size that are yet to be hashed are hashed a few chunks at a
+    # time, as many as there are jobs, each read concurrently, and compared
+    # with those digests or with one another's. a file is dropped at the
+    # first chunks that match no other file's, rather than read to the end.
+    name = 'chunks'
+
+    def __init__(self, block_size=BLOCK_SIZE, reader=None, algorithm=None):
+        super(ChunkStage, self).__init__(block_size, algorithm)
+        self.reader = reader
+        self._bytes_compared = {}
+
+    def applies_to(self, bytesize):
+        return bytesize > self.algorithm.chunk_size
+
+    def applies_to_group(self, group):
+        # files already hashed can only be compared if their chunks are
+        # known
+        return (any(file.hash is None for file in group)
+                and all(file.hash is None or file.chunks is not None
+                        for file in group))
+
+    def bytes_to_read(self, bytesize):
+        # varies with where the files diverge, and is accounted for by
+        # unread() instead
+        return 0
+
+    def unread(self, file, bytes_read):
+        bytes_read += self._bytes_compared.pop(id(file), file.size)
+        return max(file.size - bytes_read, 0)
+
+    def split(self, group):
+        self._bytes_compared.clear()
+        algorithm = self.algorithm
+        offsets = algorithm.offsets(group[0].size)
+
+        # the digests of the chunks of each file, so far as they're known
+        chunk_digests = {}
+        for file in group:
+            if file.chunks is None:
+                self.files_read += 1
+                chunk_digests[id(file)] = []
+                continue
+
+            digest_size = len(file.chunks) // len(offsets)
+            chunk_digests[id(file)] = [
+                file.chunks[i:i + digest_size]
+                for i in range(0, len(file.chunks), digest_size)]
+
+        resolved = []
+        unresolved = [group]
+        window = algorithm.jobs
+        for start in range(0, len(offsets), window):
+            stop = min(start + window, len(offsets))
+            still_unresolved = []
+            for files in unresolved:
+                digest_to_files = collections.OrderedDict()
+                for file in files:
+                    if file.hash is None:
+                        chunk_digests[id(file)].extend(
+                            self.reader.hash_ranges(
+                                algorithm.algorithm, file.path,
+                                offsets[start:stop], algorithm.chunk_size,
+                                algorithm.jobs))
+                        self.bytes_read += min(
+                            offsets[stop - 1] + algorithm.chunk_size,
+                            file.size) - offsets[start]
+
+                    digest_to_files.setdefault(
+                        tuple(chunk_digests[id(file)][start:stop]),
+                        []).append(file)
+
+                for matching_files in digest_to_files.values():
+                    if len(matching_files) == 1:
+                        file, = matching_files
+                        if file.hash is None:
+                            self._bytes_compared[id(file)] = min(
+                                offsets[stop - 1] + algorithm.chunk_size,
+                                file.size)
+                        resolved.append(matching_files)
+
+                    elif all(file.hash is not None
+                             for file in matching_files):
+                        # nothing left to read
+                        resolved.append(matching_files)
+
+                    else:
+                        still_unresolved.append(matching_files)
+
+            unresolved = still_unresolved
+
+        # files that matched another to the end have their checksums
+        # computed from the digests of their chunks
+        for files in unresolved:
+            for file in files:
+                if file.hash is None:
+                    hasher = dedupe.hashing.TreeHasher(
+                        algorithm.algorithm, algorithm.chunk_size,
+                        chunk_digests[id(file)])
+                    file.hash = hasher.hexdigest()
+                    file.chunks = hasher.chunks()
+            resolved.append(files)
+
+        return resolved
+
+
+class ChecksumStage(PrefilterStage):
+    # with more than one job, the files of a group are hashed that many at a
+    # time, and then grouped by their checksums in their original order
+    name = 'checksum'
+    final = True
+
+    def __init__(self, block_size=BLOCK_SIZE, reader=None, algorithm=None,
+                 jobs=1):
+        super(ChecksumStage, self).__init__(block_size, algorithm)
+        self.reader = reader
+        self.jobs = jobs
+
+    def bytes_to_read(self, bytesize):
+        return bytesize
+
+    def split(self, group):
+        unhashed = [file for file in group if file.hash is None]
+        if self.jobs > 1 and len(unhashed) > 1:
+            for file in unhashed:
+                self.files_read += 1
+                self.bytes_read += file.size
+
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(self.jobs, len(unhashed))) as executor:
+                list(executor.map(
+                    lambda file: file.checksum(self.reader, self.algorithm),
+                    unhashed))
+
+        return super(ChecksumStage, self).split(group)
+
+    def key(self, file):
+        if file.hash is None:
+            self.files_read += 1
+            self.bytes_read += file.size
+        return file.checksum(self.reader, self.algorithm)
+
+
+class VerificationStage(PrefilterStage):
+    # reads files that share a checksum once more, with a second, usually
+    # cryptographic, algorithm. files that turn out to differ despite their
+    # checksums have the second digest appended to their checksum, so that
+    # they aren't taken for duplicates of one another here or in reports.
+    # files are marked as verified, and those verified by an earlier scan
+    # and unchanged since aren't read again, but for one of them to compare
+    # the rest with.
+    name = 'verification'
+    final = True
+
+    def __init__(self, block_size=BLOCK_SIZE, reader=None, algorithm=None):
+        super(VerificationStage, self).__init__(block_size, algorithm)
+        self.reader = reader
+
+    def applies_to_group(self, group):
+        return any(file.verified != self.algorithm.name for file in group)
+
+    def bytes_to_read(self, bytesize):
+        return bytesize
+
+    def split(self, group):
+        verified = [file for file in group
+                    if file.verified == self.algorithm.name]
+        unverified = [file for file in group
+                      if file.verified != self.algorithm.name]
+
+        # the verified file comes first, so that it and the rest of the
+        # verified files keep their checksum
+        digest_to_files = collections.OrderedDict()
+        for file in verified[:1] + unverified:
+            hasher = self.algorithm.new()
+            self.reader.update(hasher, file.path)
+            self.files_read += 1
+            self.bytes_read += file.size
+            digest_to_files.setdefault(hasher.hexdigest(), []).append(file)
+        if verified:
+            next(iter(digest_to_files.values())).extend(verified[1:])
+
+        if len(digest_to_files) > 1:
+            logger.warning('{0} files share the checksum {1} but differ by'
+                           ' {2}'.format(len(group), group[0].hash,
+                                         self.algorithm.name))
+            for digest, files in list(digest_to_files.items())[1:]:
+                for file in files:
+                    file.hash = '{0}+{1}'.format(file.hash, digest)
+
+        for file in group:
+            file.verified = self.algorithm.name
+        return list(digest_to_files.values())
+
+
+class PrefilterStatistics(object):
+    def __init__(self, block_size=BLOCK_SIZE, reader=None, algorithm=None,
+                 verification=None, device_limits=None, jobs=1):
+        if reader is None:
+            reader = dedupe.readers.DEFAULT_READER
+        if algorithm is None:
+            algorithm = dedupe.hashing.DEFAULT_ALGORITHM
+
+        self.block_size = block_size
+        self.reader = reader
+        self.algorithm = algorithm
+        self.verification = verification
+        # detected as devices are first read from when not given
+        self.device_limits = device_limits
+        self.stages = [
+            FirstBlockStage(block_size, algorithm),
+            TailBlockStage(block_size, algorithm),
+            ComparisonStage(block_size, buffer_size=reader.buffer_size,
+                            algorithm=algorithm),
+            ChecksumStage(block_size, reader, algorithm, jobs),
+        ]
+
+        # large files hashed as trees can be compared a few chunks at a time
+        # with those hashed by an earlier scan
+        if isinstance(algorithm, dedupe.hashing.TreeHash):
+            self.stages.insert(-1, ChunkStage(block_size, reader, algorithm))
+
+        # an optional second pass over the files found to be identical
+        if verification is not None:
+            self.stages.append(
+                VerificationStage(block_size, reader, verification))
+
+    @property
+    def bytes_read(self):
+        return sum(stage.bytes_read for stage in self.stages)
+
+    @property
+    def bytes_avoided(self):
+        return sum(stage.bytes_avoided for stage in self.stages)
+
+    def merge(self, other):
+        for stage, other_stage in zip(self.stages, other.stages):
+            stage.merge(other_stage)
+
+
 class DuplicatePartitioner(object):
-    def __init__(self, files, progress, index):
+    # narrows a group of same-size files down to groups of identical files in
+    # stages: by a digest of the first block, then by a digest of the last
+    # block, and only then by comparing or checksumming the entire file
+    def __init__(self, files, progress, index, statistics=None):
         assert len(files) > 1, 'Cannot partition a list of 1 file'
 
         self.files = files
+        self.bytesize = files[0].size
+        if statistics is None:
+            statistics = PrefilterStatistics()
+        self.statistics = statistics
         self.checksum_to_files = collections.defaultdict(list)
         self._compute_checksums(progress, index)
 
     def _compute_checksums(self, progress, index):
-        for file in self.files:
-            checksum = file.checksum()
-            self.checksum_to_files[checksum].append(file)
+        # bytes read from each file so far, used to tally what was avoided
+        # once a file is eliminated
+        bytes_read = 0
+        candidates = [self.files]
+        for stage in self.statistics.stages:
+            if not stage.applies_to(self.bytesize):
+                continue
+
+            bytes_read += stage.bytes_to_read(self.bytesize)
+            survivors = []
+            for group in candidates:
+                if not stage.applies_to_group(group):
+                    survivors.append(group)
+                    continue
+
+                stage.files_examined += len(group)
+
+                for files_matching_digest in stage.split(group):
+                    if len(files_matching_digest) > 1:
+                        survivors.append(files_matching_digest)
+                        continue
+
+                    file, = files_matching_digest
+                    stage.files_eliminated += 1
+                    stage.bytes_avoided += stage.unread(file, bytes_read)
+                    progress.update(index)
+                    index += 1
+
+            candidates = survivors
+            if not candidates:
+                break
+
+        for group in candidates:
+            for file in group:
+                self.checksum_to_files[file.hash].append(file)
+
+                progress.update(index)
+                index += 1
+
 
-            progress.update(index)
-            index += 1
+def _partition_group(files, block_size, reader, algorithm, verification,
+                     reads=1):
+    # runs within a worker, which may be another process holding copies of
+    # the files, so results refer to files by their position in the group.
+    # reads is how many reads the group was given at once: ranges of each
+    # file, for files hashed as trees of several chunks, or otherwise files
+    # hashed at once.
+    jobs = reads
+    if _reads_ranges(files, algorithm):
+        algorithm = _with_reads(algorithm, reads)
+        jobs = 1
+    statistics = PrefilterStatistics(block_size, reader, algorithm,
+                                     verification, jobs=jobs)
+    # never drawn, but given a width so that it doesn't look up the
+    # terminal's for every group
+    partitioner = DuplicatePartitioner(
+        files=files, progress=progressbar.NullBar(term_width=1), index=0,
+        statistics=statistics)
 
+    positions = dict((id(file), i) for i, file in enumerate(files))
+    groups = [(checksum, [positions[id(file)] for file in group])
+              for checksum, group in partitioner.checksum_to_files.items()]
+    digests = [(file.hash, file.first_block, file.last_block, file.chunks,
+                file.verified) for file in files]
+    return groups, digests, statistics
 
-def repartition(filesize_partitions):
+
+def _reads_ranges(files, algorithm):
+    # files hashed as trees of several chunks are read a few ranges at a time
+    return isinstance(algorithm, dedupe.hashing.TreeHash) \
+        and files[0].size > algorithm.chunk_size
+
+
+def _reads_at_once(files, block_size, algorithm, jobs):
+    # how many reads a group would make at once: as many ranges of each of
+    # its files as the algorithm reads at once, or as many of its files as
+    # there are jobs, unless they are all read with their first block
+    if _reads_ranges(files, algorithm):
+        return algorithm.jobs
+    if files[0].size > block_size:
+        return min(len(files), jobs)
+    return 1
+
+
+def _with_reads(algorithm, reads):
+    # the algorithm, reading no more than so many ranges of a file at once
+    if isinstance(algorithm, dedupe.hashing.TreeHash) \
+            and algorithm.jobs != reads:
+        return dedupe.hashing.TreeHash(algorithm.algorithm,
+                                       algorithm.chunk_size, jobs=reads)
+    return algorithm
+
+
+def _room(devices, device_limits, reading):
+    # how many more reads the devices can take, or None if any number
+    room = None
+    for device in devices:
+        limit = device_limits.limit(device)
+        if limit is not None:
+            room = limit - reading[device] if room is None \
+                else min(room, limit - reading[device])
+    return room
+
+
+def _partition_groups(queues, block_size, reader, algorithm, verification,
+                      jobs, use_processes, device_limits):
+    # yields the partitioning of each size group, along with its position,
+    # as workers finish them. a group is only started while each device its
+    # files are on is being read by fewer groups than the device's limit, so
+    # that a spinning disk is read by one worker at a time while the other
+    # workers read other devices. a group is taken from each queue in turn,
+    # so that every device is read at once. no more groups are started than
+    # there are workers, so that a group isn't left waiting behind others
+    # for a worker while its device sits idle. a group that reads a few
+    # ranges of its files, or a few of its files, at a time counts as that
+    # many reads, on its devices and among the workers, and is given fewer
+    # reads at once than it would make if fewer are to be had.
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+    queues = collections.OrderedDict(
+        (devices, collections.deque(queue))
+        for devices, queue in queues.items())
+    reading = collections.Counter()
+    running = {}
+
+    def reads_to_start(files, devices):
+        # 0 if the group can't be started yet
+        reads = min(_reads_at_once(files, block_size, algorithm, jobs),
+                    jobs - sum(group[3] for group in running.values()))
+        room = _room(devices, device_limits, reading)
+        if room is not None:
+            reads = min(reads, room)
+        return max(reads, 0)
+
+    with executor:
+        try:
+            while queues or running:
+                started = True
+                while started and len(running) < jobs:
+                    started = False
+                    for devices, queue in list(queues.items()):
+                        if len(running) >= jobs:
+                            break
+                        reads = reads_to_start(queue[0][1], devices)
+                        if not reads:
+                            continue
+
+                        index, files = queue.popleft()
+                        if not queue:
+                            del queues[devices]
+                        running[executor.submit(
+                            _partition_group, files, block_size, reader,
+                            algorithm, verification,
+                            reads)] = (index, files, devices, reads)
+                        for device in devices:
+                            reading[device] += reads
+                        started = True
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    index, files, devices, reads = running.pop(future)
+                    for device in devices:
+                        reading[device] -= reads
+                    yield index, files, future.result()
+
+        finally:
+            # groups not yet finished when hashing stops early are dropped,
+            # rather than hashed only to be thrown away
+            for future in running:
+                future.cancel()
+
+
+def _single_worker_reads(files, block_size, algorithm, device_limits):
+    # a lone worker reads as many ranges of a file at once as the algorithm
+    # does, unless the devices of the group's files can't take as many
+    room = _room(set(file.device for file in files), device_limits,
+                 collections.Counter())
+    reads = _reads_at_once(files, block_size, algorithm, 1)
+    if room is not None:
+        reads = max(min(reads, room), 1)
+    return reads
+
+
+def rank_by_potential_savings(filesize_partitions):
+    # the sizes whose files could free the most space if they all turned out
+    # to be identical come first
+    return collections.OrderedDict(sorted(
+        filesize_partitions.items(),
+        key=lambda item: item[1][0].allocated * (len(item[1]) - 1),
+        reverse=True))
+
+
+def repartition(filesize_partitions, statistics=None, jobs=1,
+                use_processes=False, checkpoint=None, target_savings=None,
+                found=None):
+    # when found is given, it is called with the savings and files of each
+    # set of identical files as soon as the set is found. hashing stops once
+    # the sets found would free target_savings.
     logger.debug('-'*80)
     logger.debug('Repartitioning by checksums')
 
     file_count = sum([len(files_matching_size)
                       for files_matching_size in filesize_partitions.values()])
-    bar = progressbar.ProgressBar(max_value=file_count)
+    bar = dedupe.utils.progress_bar(file_count)
 
-    repartitioned_files = collections.defaultdict(list)
+    if statistics is None:
+        statistics = PrefilterStatistics()
+    if statistics.device_limits is None:
+        statistics.device_limits = dedupe.scheduler.DeviceLimits()
+
+    # groups ranked by their potential savings are hashed in that order,
+    # and otherwise in the order their files lie on each device
+    queues = dedupe.scheduler.scheduled_order(
+        filesize_partitions, preserve_order=target_savings is not None)
+
+    if jobs > 1:
+        logger.debug('Hashing with {0} worker {1}'.format(
+            jobs, 'processes' if use_processes else 'threads'))
+        partitioned_groups = _partition_groups(
+            queues, block_size=statistics.block_size,
+            reader=statistics.reader, algorithm=statistics.algorithm,
+            verification=statistics.verification, jobs=jobs,
+            use_processes=use_processes,
+            device_limits=statistics.device_limits)
+
+    else:
+        # with one worker, ranked groups are hashed strictly in order
+        if target_savings is not None:
+            ordered_groups = enumerate(filesize_partitions.values())
+        else:
+            ordered_groups = itertools.chain.from_iterable(queues.values())
+        partitioned_groups = ((index, files, _partition_group(
+                                   files, statistics.block_size,
+                                   statistics.reader, statistics.algorithm,
+                                   statistics.verification,
+                                   _single_worker_reads(
+                                       files, statistics.block_size,
+                                       statistics.algorithm,
+                                       statistics.device_limits)))
+                              for index, files in ordered_groups)
+
+    # groups are finished in whatever order, and their sets are put back in
+    # the order the groups were given
+    partitioned_sets = {}
 
     i = 0
-    for bytesize, files in filesize_partitions.items():
-        repartitioned_files_of_same_size = DuplicatePartitioner(
-            files=files, progress=bar, index=i)
-        # todo: if two files of different sizes share the same hash,
-        # then this will overwrite one of the groups!
+    potential_savings_total = 0
+    try:
+        for index, files, (groups, digests, group_statistics) \
+                in partitioned_groups:
+            for file, (checksum, first_block, last_block, chunks,
+                       verified) in zip(files, digests):
+                file.hash = checksum
+                file.first_block = first_block
+                file.last_block = last_block
+                file.chunks = chunks
+                file.verified = verified
+
+            if checkpoint is not None:
+                checkpoint.hashed(files)
+
+            statistics.merge(group_statistics)
+
+            # keyed by size as well, as files of different sizes may share a
+            # checksum
+            partitioned_sets[index] = [
+                ((files[0].size, checksum),
+                 [files[position] for position in positions])
+                for checksum, positions in groups]
+            for _, files_of_set in partitioned_sets[index]:
+                if len(files_of_set) > 1:
+                    for f in files_of_set:
+                        f.sort_paths()
+                    duplicates = sorted(files_of_set, key=lambda f: f.path)
+                    potential_savings = sum(f.allocated
+                                            for f in duplicates[1:])
+                    potential_savings_total += potential_savings
+                    if found is not None:
+                        found(potential_savings, duplicates)
 
-        for checksum, files_matching_checksum in \
-            repartitioned_files_of_same_size.checksum_to_files.items():
+            i += len(files)
+            bar.update(i)
 
-            # TODO: this might merge files together with different file sizes
-            #repartitioned_files[(bytesize, checksum)].extend(
-            repartitioned_files[checksum].extend(
-                files_matching_checksum)
+            if target_savings is not None \
+                    and potential_savings_total >= target_savings:
+                logger.info('Stopped hashing once {0} of {1} files were'
+                            ' hashed, with {2} bytes in potential'
+                            ' savings'.format(i, file_count,
+                                              potential_savings_total))
+                break
 
-        i += len(files)
+    finally:
+        if jobs > 1:
+            partitioned_groups.close()
+
+        # whatever was hashed is kept, even if hashing was interrupted
+        if checkpoint is not None:
+            checkpoint.save_digests()
+
+    repartitioned_files = collections.defaultdict(list)
+    for index in sorted(partitioned_sets):
+        for key, files in partitioned_sets[index]:
+            repartitioned_files[key].extend(files)
 
     logger.debug('+' * 60)
-    logger.debug('New partitions:')
-    for block, files in repartitioned_files.items():
-        logger.debug(pprint.pformat(files))
-        logger.debug('.'*50)
+    logger.debug('Prefilter stages:')
+    for stage in statistics.stages:
+        logger.debug(stage)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('+' * 60)
+        logger.debug('New partitions:')
+        for block, files in repartitioned_files.items():
+            logger.debug(pprint.pformat(files))
+            logger.debug('.'*50)
 
     return repartitioned_files
@@ -0,0 +1,101 @@
+import collections
+import itertools
+import logging
+
+import dedupe.db
+import dedupe.duplicates
+import dedupe.filesystem
+import dedupe.hashing
+import dedupe.utils
+
+logger = logging.getLogger(__name__)
+
+# a rough upper bound on the memory held for each file while it is walked or
+# partitioned: the File itself, its name, its packed stat fields, and its
+# share of the lists and dicts holding it
+FILE_FOOTPRINT = 512
+
+
+def files_within(memory_limit):
+    # half of the limit goes to files, a quarter to sqlite's page cache, and
+    # the rest is left for everything else
+    return max(memory_limit // 2 // FILE_FOOTPRINT, 1)
+
+
+def spill_file_sizes(within, checkpoint, jobs=1, counters=None,
+                     walk_filter=None):
+    # walks like find_file_sizes(), but rather than collecting every file in
+    # memory, leaves them in the database as the checkpoint saves them. hard
+    # links are recognized once files are read back a size at a time.
+    if counters is None:
+        counters = collections.Counter()
+
+    for search_directory in within:
+        finder = dedupe.filesystem.ScandirFinder(
+            within=search_directory, jobs=jobs, counters=counters,
+            checkpoint=checkpoint, walk_filter=walk_filter)
+        for file in finder.files():
+            counters['paths'] += 1
+            counters['bytes'] += file.size
+
+    logger.info('Search complete.')
+
+
+def _files_from_rows(rows, counters, algorithm):
+    # rows of one size, ordered by path
+    def file_of_row(row):
+        file = dedupe.filesystem.File.restore(
+            row.path, row.bytesize, row.mtime, row.ctime, row.inode,
+            row.device, row.blocks, row.hard_linked)
+        # digests kept from a previous scan of the unchanged file, by the
+        # same algorithm
+        if row.algorithm == algorithm.name_for(row.bytesize):
+            file.hash = row.checksum
+            file.first_block = row.first_block
+            file.last_block = row.last_block
+            file.chunks = row.chunks
+            file.verified = row.verified
+        return file
+
+    return dedupe.filesystem.files_of_rows(rows, file_of_row, counters)
+
+
+def size_partitions(db, max_files, counters=None, algorithm=None):
+    # yields partitions of files by size, like find_file_sizes() and
+    # filter_singletons() together, in batches of no more than max_files
+    # files, unless a single size has more
+    if counters is None:
+        counters = collections.Counter()
+    if algorithm is None:
+        algorithm = dedupe.hashing.DEFAULT_ALGORITHM
+
+    for rows in dedupe.db.walked_partitions(db, max_files):
+        partitions = {}
+        for bytesize, rows_of_size in itertools.groupby(
+                rows, key=lambda row: row.bytesize):
+            partitions[bytesize] = _files_from_rows(rows_of_size, counters,
+                                                    algorithm)
+
+        counters['batches'] += 1
+        yield dedupe.utils.filter_singletons(partitions, counters=counters)
+
+
+def repartition(db, max_files, statistics=None, jobs=1, use_processes=False,
+                checkpoint=None, counters=None):
+    # repartitions each batch of sizes in turn. nothing is held on to
+    # afterwards, as the checkpoint saves digests as they're computed and
+    # reports are drawn from the database.
+    if counters is None:
+        counters = collections.Counter()
+    if statistics is None:
+        statistics = dedupe.duplicates.PrefilterStatistics()
+
+    for partitions in size_partitions(db, max_files, counters=counters,
+                                      algorithm=statistics.algorithm):
+        logger.debug('Partitioning a batch of {} sizes'.format(
+            len(partitions)))
+        repartitioned = dedupe.duplicates.repartition(
+            partitions, statistics=statistics, jobs=jobs,
+            use_processes=use_processes, checkpoint=checkpoint)
+        counters['duplicate_sets'] += len(
+            dedupe.utils.filter_singletons(repartitioned))
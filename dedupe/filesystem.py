@@ -1,13 +1,26 @@
 import os
 import logging
 import collections
+import concurrent.futures
+import fnmatch
 import pprint
-import xxhash
+import re
+import struct
+import sys
+
+import dedupe.hashing
+import dedupe.readers
 
 logger = logging.getLogger(__name__)
 
+# a file's modification time, change time, inode, device and allocated
+# 512-byte blocks, packed into one bytes object rather than held as five int
+# objects
+_stat_fields = struct.Struct('=qqQQq')
+
 
-def find_file_sizes(within):
+def find_file_sizes(within, jobs=1, counters=None, checkpoint=None,
+                    walk_filter=None):
     if isinstance(within, str):
         within = [within]
 
@@ -19,9 +32,16 @@ def find_file_sizes(within):
                          ' -- str or list of strs expected, but received'
                          ' {}'.format(type(within)))
 
+    # shared by every finder, so that hard links are recognized even when
+    # they're reached through different directories
+    inodes = {}
+
     found_files = collections.defaultdict(list)
     for search_directory in within:
-        finder = FileFinder(within=search_directory)
+        finder = ScandirFinder(within=search_directory, jobs=jobs,
+                               inodes=inodes, counters=counters,
+                               checkpoint=checkpoint,
+                               walk_filter=walk_filter)
         files_within_dir = finder.find()
 
         for filesize, files_matching_size in files_within_dir.items():
@@ -29,21 +49,109 @@ def find_file_sizes(within):
 
     logger.info('Search complete.')
 
-    for filesize in found_files:
-        logger.debug('Files of size {} bytes:'.format(filesize))
-        logger.debug(pprint.pformat(found_files[filesize]))
-        logger.debug('.'*40)
+    # formatting every file is costly, even if the result is discarded
+    if logger.isEnabledFor(logging.DEBUG):
+        for filesize in found_files:
+            logger.debug('Files of size {} bytes:'.format(filesize))
+            logger.debug(pprint.pformat(found_files[filesize]))
+            logger.debug('.'*40)
 
     return found_files
 
 
+def _compile_patterns(patterns):
+    # glob patterns containing a slash are matched against whole paths, and
+    # the rest against names alone. each kind is compiled into one regular
+    # expression, so that matching a name costs one call however many
+    # patterns there are.
+    def compile(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join(fnmatch.translate(pattern)
+                                   for pattern in patterns))
+
+    return (compile([pattern for pattern in patterns if '/' not in pattern]),
+            compile([pattern for pattern in patterns if '/' in pattern]))
+
+
+def _matches(compiled_patterns, name, path):
+    name_pattern, path_pattern = compiled_patterns
+    return ((name_pattern is not None and name_pattern.match(name))
+            or (path_pattern is not None and path_pattern.match(path)))
+
+
+class WalkFilter(object):
+    # decides as the walk goes which directories are descended into and
+    # which files are kept, so that nothing beneath a pruned directory is
+    # ever listed or stat'd. excluded names and paths prune directories and
+    # files alike. files are kept only if they match an included pattern,
+    # when any are given, and are within the size limits. with
+    # one_file_system set, directories on other devices than the one the
+    # walk started on are skipped.
+    def __init__(self, min_size=None, max_size=None, include=None,
+                 exclude=None, one_file_system=False):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.include = _compile_patterns(include or [])
+        self.exclude = _compile_patterns(exclude or [])
+        self.one_file_system = one_file_system
+
+    def descend(self, entry, device):
+        if _matches(self.exclude, entry.name, entry.path):
+            return False
+
+        if self.one_file_system:
+            try:
+                return entry.stat(follow_symlinks=False).st_dev == device
+            except OSError:
+                return False
+
+        return True
+
+    def keep_name(self, entry):
+        return self._keep(entry.name, entry.path)
+
+    def _keep(self, name, path):
+        if _matches(self.exclude, name, path):
+            return False
+
+        return self.include == (None, None) or bool(
+            _matches(self.include, name, path))
+
+    def keep_size(self, size):
+        if self.min_size is not None and size < self.min_size:
+            return False
+
+        return self.max_size is None or size <= self.max_size
+
+    def keep_file(self, path, size):
+        # for files looked at one at a time rather than found by a walk,
+        # whose directories the walk would have descended into
+        return (self._keep(os.path.basename(path), path)
+                and self.keep_size(size))
+
+
+# keeps every regular file
+NO_FILTER = WalkFilter()
+
+
 class FileFinder(object):
-    def __init__(self, within):
+    def __init__(self, within, inodes=None, counters=None):
         assert os.path.isdir(within), 'Directory not found: {}'.format(within)
 
         self.directory_tree_root = within
         self.filesizes_to_files = collections.defaultdict(list)
 
+        # (device, inode) -> file, for files with more than one link
+        if inodes is None:
+            inodes = {}
+        self.inodes = inodes
+
+        # tallies of what the walk has come across
+        if counters is None:
+            counters = collections.Counter()
+        self.counters = counters
+
     def _next_filepath(self):
         logger.info('-'*75)
         logger.info('Iterating through "{}"'.format(self.directory_tree_root))
@@ -55,33 +163,293 @@ class FileFinder(object):
 
                 yield path
 
-    def find(self):
+    def files(self):
+        # every file found, one at a time, with hard links unrecognized
+        return self._next_file()
+
+    def _next_file(self):
         for filepath in self._next_filepath():
-            file = File(path=filepath)
+            yield File(path=filepath)
+
+    def find(self):
+        for file in self._next_file():
+            # paths that are hard links to an already found file are recorded
+            # as links of that file, so that its contents are read only once
+            if file.links is not None:
+                inode = file.device, file.inode
+                linked_file = self.inodes.get(inode)
+                if linked_file is not None:
+                    logger.debug('{0: >15} -> "{1}" (hard link)'.format(
+                        file.size, file.path))
+                    linked_file.links.append(file.path)
+                    self.counters['hard_links'] += 1
+                    continue
+
+                self.inodes[inode] = file
+
             logger.debug('{0: >15} -> "{1}"'.format(file.size, file.path))
             self.filesizes_to_files[file.size]\
                 .append(file)
+            self.counters['files'] += 1
+            self.counters['bytes'] += file.size
 
         return self.filesizes_to_files
 
+
+class ScandirFinder(FileFinder):
+    # os.walk() followed by os.path.islink() and os.stat() costs several
+    # syscalls per file. os.scandir() tells symlinks and directories apart
+    # without any, leaving a single stat per file. directories are scanned
+    # concurrently, but their files are yielded in a fixed breadth-first
+    # order regardless of which scan finishes first.
+    #
+    # given a checkpoint, the files found and the directories yet to be
+    # scanned are saved every so often, and a walk that was interrupted
+    # carries on from where it was last saved.
+    #
+    # FIFOs, sockets and devices are always skipped, and whatever else
+    # walk_filter rules out is skipped before it is stat'd where possible.
+    def __init__(self, within, jobs=1, inodes=None, counters=None,
+                 checkpoint=None, walk_filter=None):
+        super(ScandirFinder, self).__init__(within=within, inodes=inodes,
+                                            counters=counters)
+        if walk_filter is None:
+            walk_filter = NO_FILTER
+
+        self.jobs = jobs
+        self.checkpoint = checkpoint
+        self.walk_filter = walk_filter
+        self.device = os.stat(within).st_dev
+
+    def _scan_directory(self, directory):
+        # runs in a worker thread, so rather than updating the counters
+        # itself, it returns what is to be counted
+        files = []
+        subdirectories = []
+        counts = collections.Counter(directories_scanned=1)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        continue
+
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.walk_filter.descend(entry, self.device):
+                            subdirectories.append(entry.path)
+                        else:
+                            counts['directories_pruned'] += 1
+                        continue
+
+                    # hashing a FIFO would block, and devices and sockets
+                    # hold nothing to deduplicate
+                    if not entry.is_file(follow_symlinks=False):
+                        counts['special_files_skipped'] += 1
+                        continue
+
+                    if not self.walk_filter.keep_name(entry):
+                        counts['files_pruned'] += 1
+                        continue
+
+                    counts['stat_calls'] += 1
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        # removed since the directory was listed
+                        continue
+
+                    if not self.walk_filter.keep_size(stat.st_size):
+                        counts['files_pruned'] += 1
+                        continue
+
+                    files.append(File(path=entry.path, stat=stat))
+
+        except OSError as e:
+            logger.warning('Skipping "{0}": {1}'.format(directory, e))
+            counts['unreadable_directories'] += 1
+
+        return files, subdirectories, counts
+
+    def _next_file(self):
+        logger.info('-'*75)
+        logger.info('Scanning "{}"'.format(self.directory_tree_root))
+
+        pending = collections.deque([self.directory_tree_root])
+        if self.checkpoint is not None:
+            restored = self.checkpoint.restore_walk(self.directory_tree_root)
+            if restored is not None:
+                files, frontier = restored
+                logger.info('Resuming with {} directories left to'
+                            ' scan'.format(len(frontier)))
+                pending = collections.deque(frontier)
+                for file in files:
+                    self.counters['files_restored'] += 1
+                    yield file
+
+        # files found since the last checkpoint
+        walked = []
+
+        max_in_flight = self.jobs * 4
+        in_flight = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs) as executor:
+            try:
+                while pending or in_flight:
+                    while pending and len(in_flight) < max_in_flight:
+                        directory = pending.popleft()
+                        in_flight.append((directory, executor.submit(
+                            self._scan_directory, directory)))
+
+                    # a directory leaves the frontier only once its files
+                    # and subdirectories are accounted for
+                    files, subdirectories, counts = in_flight[0][1].result()
+                    walked.extend(files)
+                    pending.extend(subdirectories)
+                    in_flight.popleft()
+
+                    self.counters.update(counts)
+                    if self.checkpoint is not None \
+                            and self.checkpoint.due(len(walked)):
+                        self._save(walked, in_flight, pending)
+                        walked = []
+
+                    for file in files:
+                        yield file
+
+            except (KeyboardInterrupt, GeneratorExit):
+                # interrupted, whether while scanning or while the files
+                # found were being consumed
+                self._save(walked, in_flight, pending)
+                raise
+
+        self._save(walked, in_flight, pending)
+
+    def _save(self, walked, in_flight, pending):
+        if self.checkpoint is None:
+            return
+
+        frontier = [directory for directory, _ in in_flight]
+        frontier.extend(pending)
+        self.checkpoint.save_walk(self.directory_tree_root, walked, frontier)
+
+
 class File(object):
-    def __init__(self, path):
-        self.path = path
-        self.size = self._get_size(path)
-        self.hasher = xxhash.xxh64()
+    # tens of millions of these may be held at once. slots spare each one a
+    # __dict__, and rather than its full path each file holds its name and a
+    # directory string shared with every other file in that directory.
+    __slots__ = ('directory', 'name', 'size', '_stat_fields', 'links',
+                 'hash', 'first_block', 'last_block', 'chunks', 'verified')
+
+    def __init__(self, path, stat=None):
+        directory, self.name = os.path.split(path)
+        self.directory = sys.intern(directory)
+        self._stat(path, stat)
         self.hash = None
+        self.first_block = None
+        self.last_block = None
+
+        # the digests of each chunk of a file hashed as a tree
+        self.chunks = None
+
+        # the algorithm the file was read with a second time, once its
+        # checksum was found to be shared
+        self.verified = None
+
+    @classmethod
+    def restore(cls, path, size, mtime, ctime, inode, device, blocks,
+                hard_linked):
+        # a file found by an interrupted scan, rebuilt without a stat
+        file = cls.__new__(cls)
+        directory, file.name = os.path.split(path)
+        file.directory = sys.intern(directory)
+        file.size = size
+        # rows recorded before some of these were have 0 in their place
+        file._stat_fields = _stat_fields.pack(mtime or 0, ctime or 0,
+                                              inode or 0, device or 0,
+                                              blocks)
+        file.links = [] if hard_linked else None
+        file.hash = None
+        file.first_block = None
+        file.last_block = None
+        file.chunks = None
+        file.verified = None
+        return file
 
-    def _get_size(self, path):
-        return os.path.getsize(path)
-
-    def checksum(self):
-        with open(self.path, 'rb') as f:
-            while True:
-                data = f.read(4096)
-                if not data:
-                    break
-                self.hasher.update(data)
-        self.hash = self.hasher.hexdigest()
+    def _stat(self, path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        self.size = stat.st_size
+        blocks = getattr(stat, 'st_blocks', (stat.st_size + 511) // 512)
+        self._stat_fields = _stat_fields.pack(stat.st_mtime_ns,
+                                              stat.st_ctime_ns,
+                                              stat.st_ino, stat.st_dev,
+                                              blocks)
+
+        # other paths to the same inode. only files with more than one link
+        # can have any, and only those pay for the list.
+        self.links = [] if stat.st_nlink > 1 else None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.name)
+
+    @property
+    def mtime(self):
+        return _stat_fields.unpack(self._stat_fields)[0]
+
+    @property
+    def ctime(self):
+        return _stat_fields.unpack(self._stat_fields)[1]
+
+    @property
+    def inode(self):
+        return _stat_fields.unpack(self._stat_fields)[2]
+
+    @property
+    def device(self):
+        return _stat_fields.unpack(self._stat_fields)[3]
+
+    @property
+    def allocated(self):
+        # bytes actually occupied on disk, which is what removing the file
+        # would free. sparse files occupy less than their size.
+        return _stat_fields.unpack(self._stat_fields)[4] * 512
+
+    @property
+    def paths(self):
+        if self.links:
+            return [self.path] + self.links
+        return [self.path]
+
+    def sort_paths(self):
+        # the first of its paths in order becomes its path, and the rest its
+        # links, as reports from the database have them
+        if self.links:
+            paths = sorted(self.paths)
+            directory, self.name = os.path.split(paths[0])
+            self.directory = sys.intern(directory)
+            self.links = paths[1:]
+
+    @property
+    def signature(self):
+        # if none of these have changed since the file was last hashed, then
+        # its contents are assumed to be unchanged as well
+        return (self.size,) + _stat_fields.unpack(self._stat_fields)[:4]
+
+    def checksum(self, reader=None, algorithm=None):
+        # already hashed, or reused from a previous scan
+        if self.hash is not None:
+            return self.hash
+
+        if reader is None:
+            reader = dedupe.readers.DEFAULT_READER
+        if algorithm is None:
+            algorithm = dedupe.hashing.DEFAULT_ALGORITHM
+
+        # the hasher is only created once a file needs hashing, as most files
+        # never do
+        hasher = algorithm.hash_file(reader, self.path, self.size)
+        self.hash = hasher.hexdigest()
+        self.chunks = algorithm.chunks(hasher)
         return self.hash
 
     def __str__(self):
@@ -96,3 +464,39 @@ class File(object):
 
     def __lt__(self, other):
         return self.path < other.path
+
+
+def files_of_rows(rows, file_of_row, counters=None):
+    # files rebuilt from rows of the files table in order of path, as tuples
+    # beginning (path, bytesize, mtime, ctime, inode, device). rows sharing a
+    # device and inode are hard links to one file, that of the first of them,
+    # which the paths of the rest become links of. rows recorded before
+    # inodes were stand for an inode each. file_of_row builds the file of a
+    # row, or returns None to leave it out, in which case the next row of
+    # its inode is tried in its place.
+    if counters is None:
+        counters = collections.Counter()
+
+    files = []
+    inodes = {}
+    for row in rows:
+        path, inode, device = row[0], row[4], row[5]
+        key = (device, inode) if inode is not None else path
+        linked_file = inodes.get(key)
+        if linked_file is not None:
+            linked_file.links.append(path)
+            counters['hard_links'] += 1
+            continue
+
+        file = file_of_row(row)
+        if file is None:
+            continue
+
+        file.links = []
+        inodes[key] = file
+        files.append(file)
+
+    for file in files:
+        if not file.links:
+            file.links = None
+    return files
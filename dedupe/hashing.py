@@ -0,0 +1,184 @@
+import hashlib
+import logging
+
+import xxhash
+
+logger = logging.getLogger(__name__)
+
+# the size of the ranges that large files are hashed in, when hashed as trees
+TREE_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class HashAlgorithm(object):
+    # makes the hashers that files are checksummed with. the name is recorded
+    # in the database with each digest, so that digests are only ever reused
+    # or compared under the algorithm that computed them.
+    name = None
+    cryptographic = False
+
+    def new(self):
+        raise NotImplementedError
+
+    def name_for(self, size):
+        # the name recorded with the digests of a file of the given size
+        return self.name
+
+    def hash_file(self, reader, path, size):
+        hasher = self.new()
+        reader.update(hasher, path)
+        return hasher
+
+    def chunks(self, hasher):
+        # the digests of the chunks a file was hashed in, for algorithms that
+        # hash files in chunks
+        return None
+
+    def __repr__(self):
+        return '<{}()>'.format(self.__class__.__name__)
+
+
+class XXH64(HashAlgorithm):
+    # 64 bits, and what every earlier version hashed with
+    name = 'xxh64'
+
+    def new(self):
+        return xxhash.xxh64()
+
+
+class XXH3_128(HashAlgorithm):
+    # faster than xxh64 on modern processors, and twice as wide
+    name = 'xxh3_128'
+
+    def new(self):
+        return xxhash.xxh3_128()
+
+
+class BLAKE2b(HashAlgorithm):
+    name = 'blake2b'
+    cryptographic = True
+
+    def new(self):
+        return hashlib.blake2b(digest_size=32)
+
+
+class BLAKE3(HashAlgorithm):
+    # an optional dependency
+    name = 'blake3'
+    cryptographic = True
+
+    def new(self):
+        import blake3
+        return blake3.blake3()
+
+
+class TreeHasher(object):
+    # hashes its input a chunk at a time, and then the digests of the chunks.
+    # input of no more than one chunk has the digest of that chunk, i.e. the
+    # digest the underlying algorithm gives it.
+    def __init__(self, algorithm, chunk_size, chunk_digests=None):
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.chunk_digests = list(chunk_digests or ())
+        self._hasher = algorithm.new()
+        self._filled = 0
+
+    def update(self, data):
+        with memoryview(data).cast('B') as view:
+            offset = 0
+            while offset < len(view):
+                length = min(len(view) - offset,
+                             self.chunk_size - self._filled)
+                with view[offset:offset + length] as piece:
+                    self._hasher.update(piece)
+                self._filled += length
+                offset += length
+
+                if self._filled == self.chunk_size:
+                    self.chunk_digests.append(self._hasher.digest())
+                    self._hasher = self.algorithm.new()
+                    self._filled = 0
+
+    def copy(self):
+        hasher = TreeHasher.__new__(TreeHasher)
+        hasher.algorithm = self.algorithm
+        hasher.chunk_size = self.chunk_size
+        hasher.chunk_digests = list(self.chunk_digests)
+        hasher._hasher = self._hasher.copy()
+        hasher._filled = self._filled
+        return hasher
+
+    def _all_chunk_digests(self):
+        if self._filled or not self.chunk_digests:
+            return self.chunk_digests + [self._hasher.digest()]
+        return self.chunk_digests
+
+    def chunks(self):
+        # the digests of every chunk, one after another, or None for input of
+        # a single chunk
+        chunk_digests = self._all_chunk_digests()
+        if len(chunk_digests) == 1:
+            return None
+        return b''.join(chunk_digests)
+
+    def digest(self):
+        chunk_digests = self._all_chunk_digests()
+        if len(chunk_digests) == 1:
+            return chunk_digests[0]
+
+        root = self.algorithm.new()
+        for chunk_digest in chunk_digests:
+            root.update(chunk_digest)
+        return root.digest()
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+class TreeHash(HashAlgorithm):
+    # hashes files larger than a chunk as trees of chunk digests, so that the
+    # chunks of a single large file can be read and hashed concurrently, and
+    # compared chunk by chunk with those of another file. smaller files have
+    # the same digests as they would under the algorithm itself, and keep its
+    # name, so that their digests are reused whether or not files are hashed
+    # as trees.
+    def __init__(self, algorithm, chunk_size=TREE_CHUNK_SIZE, jobs=1):
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.jobs = jobs
+        self.name = '{0}-tree{1}'.format(algorithm.name, chunk_size)
+        self.cryptographic = algorithm.cryptographic
+
+    def new(self):
+        return TreeHasher(self.algorithm, self.chunk_size)
+
+    def name_for(self, size):
+        if size > self.chunk_size:
+            return self.name
+        return self.algorithm.name
+
+    def offsets(self, size):
+        return range(0, size, self.chunk_size)
+
+    def hash_file(self, reader, path, size):
+        # the chunks are hashed by jobs threads at once, each reading its own
+        # range of the file
+        if self.jobs == 1 or size <= self.chunk_size:
+            return super(TreeHash, self).hash_file(reader, path, size)
+
+        return TreeHasher(self.algorithm, self.chunk_size,
+                          reader.hash_ranges(self.algorithm, path,
+                                             self.offsets(size),
+                                             self.chunk_size, self.jobs))
+
+    def chunks(self, hasher):
+        return hasher.chunks()
+
+    def __repr__(self):
+        return '<TreeHash({0!r}, chunk_size={1}, jobs={2})>'.format(
+            self.algorithm, self.chunk_size, self.jobs)
+
+
+ALGORITHMS = dict((algorithm.name, algorithm)
+                  for algorithm in (XXH64, XXH3_128, BLAKE2b, BLAKE3))
+
+DEFAULT_ALGORITHM = XXH64()
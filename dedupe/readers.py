@@ -0,0 +1,169 @@
+import concurrent.futures
+import logging
+import mmap
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# large enough to amortize the cost of each read, and a multiple of the block
+# size of any common device
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# smaller files aren't worth the cost of setting up and tearing down a mapping
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# each thread reuses one buffer for every file it reads
+_buffers = threading.local()
+
+
+def _advise(fd, advice):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+
+
+class Reader(object):
+    # feeds the contents of a file to a hasher. when drop_cache is set, the
+    # file's pages are evicted from the page cache once read, so that hashing
+    # a large tree doesn't push out everything else that was cached.
+    name = None
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, drop_cache=True):
+        self.buffer_size = buffer_size
+        self.drop_cache = drop_cache
+
+    def update(self, hasher, path):
+        with open(path, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+                _advise(fd, os.POSIX_FADV_SEQUENTIAL)
+
+            self._read(hasher, f)
+
+            if self.drop_cache and hasattr(os, 'POSIX_FADV_DONTNEED'):
+                _advise(fd, os.POSIX_FADV_DONTNEED)
+
+    def _read(self, hasher, f):
+        raise NotImplementedError
+
+    def _buffer(self):
+        buffer = getattr(_buffers, 'buffer', None)
+        if buffer is None or len(buffer) != self.buffer_size:
+            buffer = _buffers.buffer = bytearray(self.buffer_size)
+        return buffer
+
+    def hash_ranges(self, algorithm, path, offsets, length, jobs=1):
+        # the digests of the ranges of a file of the given length at each of
+        # the offsets, hashed by jobs threads at once. positional reads let
+        # every thread share one file descriptor.
+        with open(path, 'rb', buffering=0) as f:
+            fd = f.fileno()
+
+            def hash_range(offset):
+                hasher = algorithm.new()
+                self._read_range(hasher, fd, offset, length)
+                return hasher.digest()
+
+            if jobs == 1:
+                digests = [hash_range(offset) for offset in offsets]
+
+            else:
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=jobs) as executor:
+                    digests = list(executor.map(hash_range, offsets))
+
+            if self.drop_cache and hasattr(os, 'POSIX_FADV_DONTNEED'):
+                _advise(fd, os.POSIX_FADV_DONTNEED)
+
+        return digests
+
+    def _read_range(self, hasher, fd, offset, length):
+        buffer = self._buffer()
+        end = offset + length
+        with memoryview(buffer) as view:
+            while offset < end:
+                size = min(len(buffer), end - offset)
+                if hasattr(os, 'preadv'):
+                    with view[:size] as target:
+                        read = os.preadv(fd, [target], offset)
+                    if not read:
+                        break
+                    with view[:read] as data:
+                        hasher.update(data)
+
+                else:
+                    data = os.pread(fd, size, offset)
+                    read = len(data)
+                    if not read:
+                        break
+                    hasher.update(data)
+
+                offset += read
+
+    def __repr__(self):
+        return '<{0}(buffer_size={1}, drop_cache={2})>'.format(
+            self.__class__.__name__, self.buffer_size, self.drop_cache)
+
+
+class ChunkedReader(Reader):
+    # a new bytes object for every read
+    name = 'chunked'
+
+    def _read(self, hasher, f):
+        while True:
+            data = f.read(self.buffer_size)
+            if not data:
+                break
+            hasher.update(data)
+
+
+class ReadintoReader(Reader):
+    # reads into a buffer that is reused for every read of every file
+    name = 'readinto'
+
+    def _read(self, hasher, f):
+        buffer = self._buffer()
+        with memoryview(buffer) as view:
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                hasher.update(view[:read])
+
+
+class MmapReader(ReadintoReader):
+    # maps large files into memory, avoiding the copy into a buffer
+    name = 'mmap'
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, drop_cache=True,
+                 threshold=MMAP_THRESHOLD):
+        super(MmapReader, self).__init__(buffer_size=buffer_size,
+                                         drop_cache=drop_cache)
+        self.threshold = threshold
+
+    def _read(self, hasher, f):
+        size = os.fstat(f.fileno()).st_size
+        if size < max(self.threshold, 1):
+            return super(MmapReader, self)._read(hasher, f)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            if hasattr(mapping, 'madvise'):
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+            # hashed a slice at a time, as the hasher may hold the GIL for
+            # as long as it takes to consume what it is given
+            with memoryview(mapping) as view:
+                for offset in range(0, size, self.buffer_size):
+                    with view[offset:offset + self.buffer_size] as chunk:
+                        hasher.update(chunk)
+
+
+READERS = dict((reader.name, reader)
+               for reader in (ChunkedReader, ReadintoReader, MmapReader))
+
+DEFAULT_READER = ReadintoReader()
@@ -0,0 +1,214 @@
+import csv
+import json
+import logging
+
+import humanfriendly
+
+import dedupe.filesystem
+
+logger = logging.getLogger(__name__)
+
+
+def rank_by_savings(partitions):
+    partitions_sorted_by_size_reduction = []
+    for checksum, files in partitions.items():
+        # the first file is preserved. each of the others is a distinct inode
+        # whose allocated blocks are freed once all of its paths are replaced.
+        redundant_occupied_size = sum(f.allocated for f in files[1:])
+        partitions_sorted_by_size_reduction.append((redundant_occupied_size,
+                                                    files))
+
+    # ranked as the database ranks them: by savings, then by size, and then
+    # by checksum
+    partitions_sorted_by_size_reduction.sort(
+        key=lambda x: (-x[0], -x[1][0].size, x[1][0].hash))
+    return partitions_sorted_by_size_reduction
+
+
+def ranked_duplicates(db, within=None):
+    # like rank_by_savings(), but streamed from the database a set of
+    # identical files at a time, so that they needn't all be held at once.
+    # the files of each set are ordered by path, and the first is preserved.
+    import dedupe.db
+
+    def file_of_row(row):
+        path, bytesize, mtime, ctime, inode, device, blocks, checksum = row
+        file = dedupe.filesystem.File.restore(
+            path, bytesize, mtime, ctime, inode, device, blocks,
+            hard_linked=True)
+        file.hash = checksum
+        return file
+
+    for savings, rows in dedupe.db.duplicate_groups(db, within):
+        yield savings, dedupe.filesystem.files_of_rows(rows, file_of_row)
+
+
+class TextReport(object):
+    def __init__(self, output, prefilter_statistics=None):
+        self.output = output
+        self.prefilter_statistics = prefilter_statistics
+
+    def write(self, potential_savings, partition):
+        print('# {} in potential savings'.format(
+            humanfriendly.format_size(potential_savings, binary=True)),
+            file=self.output)
+        for f in partition:
+            print('{0.size: >13}\t{0.hash}\t{0.path}'.format(f),
+                  file=self.output)
+            for link in f.links or ():
+                print('{0: >13}\t{1.hash}\t{2}'.format('(hard link)', f,
+                                                       link),
+                      file=self.output)
+
+    def close(self, potential_savings_total):
+        print('# {} in total potential savings'.format(
+            humanfriendly.format_size(potential_savings_total, binary=True)),
+            file=self.output
+        )
+
+        if self.prefilter_statistics is not None:
+            for stage in self.prefilter_statistics.stages:
+                print('# {0} stage: {1} of {2} files eliminated, {3} read,'
+                      ' {4} not read'.format(
+                        stage.name, stage.files_eliminated,
+                        stage.files_examined,
+                        humanfriendly.format_size(stage.bytes_read,
+                                                  binary=True),
+                        humanfriendly.format_size(stage.bytes_avoided,
+                                                  binary=True)),
+                      file=self.output)
+
+
+class CSVReport(object):
+    # a row per path. rows of the same set share a set number, and the first
+    # path of the set is the one preserved.
+    columns = ('set', 'potential_savings', 'size', 'checksum', 'path',
+               'hard_link_to')
+
+    def __init__(self, output, prefilter_statistics=None):
+        self.writer = csv.writer(output)
+        self.writer.writerow(self.columns)
+        self.sets = 0
+
+    def write(self, potential_savings, partition):
+        self.sets += 1
+        for f in partition:
+            self.writer.writerow((self.sets, potential_savings, f.size,
+                                  f.hash, f.path, ''))
+            for link in f.links or ():
+                self.writer.writerow((self.sets, potential_savings, f.size,
+                                      f.hash, link, f.path))
+
+    def close(self, potential_savings_total):
+        pass
+
+
+class JSONLinesReport(object):
+    # an object per set of identical files
+    def __init__(self, output, prefilter_statistics=None):
+        self.output = output
+
+    def write(self, potential_savings, partition):
+        self.output.write(json.dumps({
+            'potential_savings': potential_savings,
+            'size': partition[0].size,
+            'checksum': partition[0].hash,
+            'files': [{'path': f.path, 'hard_links': f.links or []}
+                      for f in partition],
+        }) + '\n')
+
+    def close(self, potential_savings_total):
+        pass
+
+
+REPORT_FORMATS = {
+    'text': TextReport,
+    'csv': CSVReport,
+    'jsonl': JSONLinesReport,
+}
+
+
+class RemovalScript(object):
+    def __init__(self, script):
+        self.script = script
+        self.cumulative_potential_savings = 0
+
+    def write(self, potential_savings, partition):
+        self.cumulative_potential_savings += potential_savings
+
+        self.script.write('#'*120 + '\n')
+        self.script.write('# {} in potential savings\n'.format(
+            humanfriendly.format_size(potential_savings, binary=True)))
+        self.script.write('# {} in cumulative savings\n'.format(
+            humanfriendly.format_size(self.cumulative_potential_savings,
+                                      binary=True)))
+
+        for f in partition:
+            for path in f.paths:
+                self.script.write('# rm "{}"\n'.format(path))
+
+        self.script.write('\n')
+
+    def close(self, potential_savings_total):
+        pass
+
+
+class HardlinkScript(object):
+    def __init__(self, script):
+        self.script = script
+        self.cumulative_potential_savings = 0
+
+    def write(self, potential_savings, partition):
+        self.cumulative_potential_savings += potential_savings
+
+        preserved_file = partition[0]
+        self.script.write('#' * 80 + '\n')
+        self.script.write('# Preserving {}\n'.format(preserved_file.path))
+        self.script.write('# {} in potential savings\n'.format(
+            humanfriendly.format_size(potential_savings, binary=True)))
+        self.script.write('# {} in cumulative savings\n'.format(
+            humanfriendly.format_size(self.cumulative_potential_savings,
+                                      binary=True)))
+
+        for f in partition[1:]:
+            # remove destination file and create hard link. every path to
+            # the duplicate's inode must be replaced before its blocks are
+            # freed.
+            for path in f.paths:
+                self.script.write('ln --force "{preserved}"'
+                                  ' "{duplicate}"\n'.format(
+                                    preserved=preserved_file.path,
+                                    duplicate=path
+                                  ))
+
+    def close(self, potential_savings_total):
+        pass
+
+
+def write_all(partitions_sorted_by_size_reduction, writers):
+    # the report and scripts are written in a single pass over the sets of
+    # identical files, which may be streamed rather than held in memory
+    potential_savings_total = 0
+    for potential_savings, partition in partitions_sorted_by_size_reduction:
+        potential_savings_total += potential_savings
+        for writer in writers:
+            writer.write(potential_savings, partition)
+
+    for writer in writers:
+        writer.close(potential_savings_total)
+
+    return potential_savings_total
+
+
+def write_report(partitions_sorted_by_size_reduction, output,
+                 prefilter_statistics=None):
+    return write_all(partitions_sorted_by_size_reduction,
+                     [TextReport(output, prefilter_statistics)])
+
+
+def write_removal_script(partitions_sorted_by_size_reduction, script):
+    write_all(partitions_sorted_by_size_reduction, [RemovalScript(script)])
+
+
+def write_hardlink_script(partitions_sorted_by_size_reduction, script):
+    write_all(partitions_sorted_by_size_reduction, [HardlinkScript(script)])
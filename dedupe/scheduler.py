@@ -0,0 +1,65 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def rotational(device):
+    # whether the block device a file system is on spins, according to
+    # sysfs, or None if sysfs doesn't say, as for network and other virtual
+    # file systems. a partition's queue is that of the disk it's on.
+    block = '/sys/dev/block/{0}:{1}'.format(os.major(device),
+                                            os.minor(device))
+    for queue in (os.path.join(block, 'queue'),
+                  os.path.join(block, '..', 'queue')):
+        try:
+            with open(os.path.join(queue, 'rotational')) as f:
+                return f.read().strip() == '1'
+        except OSError:
+            continue
+
+    return None
+
+
+class DeviceLimits(object):
+    # how many groups of files on each device may be read at once: one for a
+    # spinning disk, whose head would otherwise seek back and forth between
+    # files, and no limit beyond the number of workers for solid state and
+    # other devices. limits can be configured for devices whose kind sysfs
+    # can't tell, such as arrays behind a network file system.
+    def __init__(self, configured=None):
+        self.configured = dict(configured or {})
+        self._detected = {}
+
+    def limit(self, device):
+        if device in self.configured:
+            return self.configured[device]
+
+        if device not in self._detected:
+            limit = 1 if rotational(device) else None
+            logger.debug('Device {0}:{1} is read {2}'.format(
+                os.major(device), os.minor(device),
+                'one group at a time' if limit else 'without a limit'))
+            self._detected[device] = limit
+        return self._detected[device]
+
+    def __repr__(self):
+        return '<DeviceLimits(configured={})>'.format(self.configured)
+
+
+def scheduled_order(filesize_partitions, preserve_order=False):
+    # the groups, along with their positions among those given, queued by
+    # the devices their files are on. within each queue, groups are ordered
+    # by inode, which on most file systems roughly follows where files lie
+    # on disk, so that a spinning disk is read more or less from one end to
+    # the other rather than back and forth.
+    queues = {}
+    for index, files in enumerate(filesize_partitions.values()):
+        devices = frozenset(file.device for file in files)
+        queues.setdefault(devices, []).append((index, files))
+
+    if not preserve_order:
+        for queue in queues.values():
+            queue.sort(key=lambda group: min(file.inode
+                                             for file in group[1]))
+    return queues
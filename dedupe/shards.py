@@ -0,0 +1,225 @@
+import collections
+import concurrent.futures
+import itertools
+import logging
+
+import dedupe.db
+import dedupe.duplicates
+import dedupe.filesystem
+import dedupe.hashing
+
+logger = logging.getLogger(__name__)
+
+
+def _shard_files(rows, algorithm, name=None):
+    # the files of one size in a shard, as the shard's database has them.
+    # once merged, their paths are qualified by the shard's name, so that
+    # paths on different hosts never clash.
+    def file_of_row(row):
+        path, bytesize, mtime, ctime, inode, device, blocks, checksum, \
+            first_block, last_block, chunks, row_algorithm, verified = row
+        file = dedupe.filesystem.File.restore(
+            path, bytesize, mtime, ctime, inode, device, blocks,
+            hard_linked=True)
+        if row_algorithm == algorithm.name_for(bytesize):
+            file.hash = checksum
+            file.first_block = first_block
+            file.last_block = last_block
+            file.chunks = chunks
+            file.verified = verified
+        return file
+
+    if name is not None:
+        rows = (('{0}:{1}'.format(name, row[0]),) + tuple(row[1:])
+                for row in rows)
+    return dedupe.filesystem.files_of_rows(rows, file_of_row)
+
+
+def _unhashed(files_of_shards, tail_block):
+    # the files of one size, by shard, that can't be told apart from a file
+    # of another shard without hashing them in full. a file whose first- and
+    # last-block digests are known needn't be, unless they're shared with a
+    # file of another shard, or another shard has files whose blocks were
+    # never read. files of the same shard were already compared by the
+    # shard's own scan.
+    def blocks(file):
+        if file.first_block is None \
+                or (tail_block and file.last_block is None):
+            return None
+        return file.first_block, file.last_block
+
+    unread = set()
+    shards_of_blocks = collections.defaultdict(set)
+    for name, files in files_of_shards.items():
+        for file in files:
+            if blocks(file) is None:
+                unread.add(name)
+            else:
+                shards_of_blocks[blocks(file)].add(name)
+
+    for name, files in files_of_shards.items():
+        for file in files:
+            if file.hash is not None:
+                continue
+
+            if blocks(file) is None \
+                    or (shards_of_blocks[blocks(file)] | unread) - {name}:
+                yield name, file
+
+
+def merge(shard_filepaths, algorithm=None, counters=None):
+    # the sets of identical files across every shard, keyed by size and
+    # checksum. shards are combined by size, and only sizes held by more
+    # than one shard are looked at beyond what each shard found itself. the
+    # sizes of files that must be hashed in full before they can be compared
+    # with those of other shards are written to the shards they're on, to be
+    # hashed by their next scans, and their files are left out until then.
+    if algorithm is None:
+        algorithm = dedupe.hashing.DEFAULT_ALGORITHM
+    if counters is None:
+        counters = collections.Counter()
+
+    shards = collections.OrderedDict()
+    for filepath in shard_filepaths:
+        db = dedupe.db.connect(filepath)
+        name = dedupe.db.shard_name(db)
+        if name is None:
+            raise ValueError('{} is not a shard, as it was not scanned with'
+                             ' --shard'.format(filepath))
+        if name in shards:
+            raise ValueError('{0} and another shard are both named'
+                             ' {1}'.format(filepath, name))
+        shards[name] = db
+
+    # the number of files of each size in all shards, and the shards that
+    # hold them
+    total = collections.Counter()
+    shards_of_size = collections.defaultdict(list)
+    for name, db in shards.items():
+        for bytesize, count in dedupe.db.size_counts(db):
+            total[bytesize] += count
+            shards_of_size[bytesize].append(name)
+    sizes = sorted(bytesize for bytesize, count in total.items() if count > 1)
+    counters['sizes_shared'] += sum(1 for bytesize in sizes
+                                    if len(shards_of_size[bytesize]) > 1)
+
+    tail = dedupe.duplicates.TailBlockStage(algorithm=algorithm)
+    duplicates = collections.defaultdict(list)
+    requests = collections.defaultdict(set)
+    for i in range(0, len(sizes), dedupe.db.SIZES_PER_QUERY):
+        batch = sizes[i:i + dedupe.db.SIZES_PER_QUERY]
+        files_of_size = collections.defaultdict(collections.OrderedDict)
+        for name, db in shards.items():
+            rows = dedupe.db.files_of_sizes(db, batch)
+            for bytesize, rows_of_size in itertools.groupby(
+                    rows, key=lambda row: row[1]):
+                files_of_size[bytesize][name] = _shard_files(
+                    rows_of_size, algorithm, name)
+
+        for bytesize, files_of_shards in files_of_size.items():
+            if len(files_of_shards) > 1:
+                for name, file in _unhashed(files_of_shards,
+                                            tail.applies_to(bytesize)):
+                    requests[name].add(bytesize)
+                    counters['files_requested'] += 1
+
+            for files in files_of_shards.values():
+                for file in files:
+                    if file.hash is not None:
+                        duplicates[(bytesize, file.hash)].append(file)
+
+    for name, db in shards.items():
+        dedupe.db.set_requests(db, sorted(requests[name]))
+        if requests[name]:
+            logger.warning('{0} has files of {1} sizes to hash before they'
+                           ' can be compared with other shards'.format(
+                               name, len(requests[name])))
+        counters['sizes_requested'] += len(requests[name])
+        db.close()
+
+    return duplicates
+
+
+def digest_blocks(db, statistics=None, jobs=1, counters=None):
+    # reads the first and last blocks of every file of the shard whose
+    # digests of them aren't known, whether or not the shard holds another
+    # file of its size, so that a merge can tell files of different shards
+    # apart by them before asking for any to be hashed in full. files no
+    # larger than a block are hashed in full along the way.
+    if statistics is None:
+        statistics = dedupe.duplicates.PrefilterStatistics()
+    if counters is None:
+        counters = collections.Counter()
+    algorithm = statistics.algorithm
+    tail = dedupe.duplicates.TailBlockStage(statistics.block_size, algorithm)
+
+    def digest(file):
+        # stages of its own, as they keep tallies
+        try:
+            dedupe.duplicates.FirstBlockStage(
+                statistics.block_size, algorithm).key(file)
+            if tail.applies_to(file.size):
+                dedupe.duplicates.TailBlockStage(
+                    statistics.block_size, algorithm).key(file)
+        except OSError as e:
+            # gone since the scan, and left for the next one
+            logger.warning('Not reading "{0}": {1}'.format(file.path, e))
+            counters['blocks_missing'] += 1
+            return None
+        return file
+
+    sizes = sorted(bytesize for bytesize, _ in dedupe.db.size_counts(db))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for i in range(0, len(sizes), dedupe.db.SIZES_PER_QUERY):
+            rows = dedupe.db.files_of_sizes(
+                db, sizes[i:i + dedupe.db.SIZES_PER_QUERY])
+            files = [file for bytesize, rows_of_size in itertools.groupby(
+                         rows, key=lambda row: row[1])
+                     for file in _shard_files(rows_of_size, algorithm)
+                     if file.first_block is None
+                     or (tail.applies_to(bytesize)
+                         and file.last_block is None)]
+
+            digested = [file for file in executor.map(digest, files)
+                        if file is not None]
+            counters['blocks_digested'] += len(digested)
+            dedupe.db.save_digests(digested, db, algorithm)
+    db.commit()
+
+
+def answer_requests(db, statistics=None, jobs=1, counters=None):
+    # hashes in full the files of the sizes a merge asked for, other than
+    # those already hashed
+    if statistics is None:
+        statistics = dedupe.duplicates.PrefilterStatistics()
+    if counters is None:
+        counters = collections.Counter()
+    algorithm = statistics.algorithm
+
+    def checksum(file):
+        try:
+            file.checksum(statistics.reader, algorithm)
+        except OSError as e:
+            # gone since the scan, and left for the next one
+            logger.warning('Not hashing "{0}": {1}'.format(file.path, e))
+            counters['requested_missing'] += 1
+            return None
+        return file
+
+    sizes = dedupe.db.requests(db)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for i in range(0, len(sizes), dedupe.db.SIZES_PER_QUERY):
+            rows = dedupe.db.files_of_sizes(
+                db, sizes[i:i + dedupe.db.SIZES_PER_QUERY])
+            files = [file for bytesize, rows_of_size in itertools.groupby(
+                         rows, key=lambda row: row[1])
+                     for file in _shard_files(rows_of_size, algorithm)
+                     if file.hash is None]
+
+            hashed = [file for file in executor.map(checksum, files)
+                      if file is not None]
+            counters['requested_hashed'] += len(hashed)
+            dedupe.db.save_digests(hashed, db, algorithm)
+
+    dedupe.db.set_requests(db, [])
+    counters['sizes_answered'] += len(sizes)
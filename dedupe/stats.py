@@ -0,0 +1,87 @@
+import collections
+import contextlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _cpu_time():
+    # includes the time of worker processes once they have been reaped
+    times = os.times()
+    return times.user + times.system + times.children_user \
+        + times.children_system
+
+
+class StageStatistics(object):
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.counters = collections.Counter()
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'counters': dict(self.counters),
+        }
+
+
+class Instrumentation(object):
+    # times each stage of a run and collects whatever each stage counts. when
+    # profile_directory is given, each stage is also run under cProfile and
+    # its profile written to <profile_directory>/<stage>.prof.
+    def __init__(self, profile_directory=None):
+        self.profile_directory = profile_directory
+        self.stages = []
+        self.started = time.time()
+
+        # counts of what happened across stages rather than within one
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage = StageStatistics(name)
+        self.stages.append(stage)
+
+        profile = None
+        if self.profile_directory is not None:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+
+        wall_start = time.perf_counter()
+        cpu_start = _cpu_time()
+        try:
+            yield stage.counters
+
+        finally:
+            stage.wall_time = time.perf_counter() - wall_start
+            stage.cpu_time = _cpu_time() - cpu_start
+
+            if profile is not None:
+                profile.disable()
+                os.makedirs(self.profile_directory, exist_ok=True)
+                profile.dump_stats(os.path.join(self.profile_directory,
+                                                '{}.prof'.format(name)))
+
+            logger.debug('{0} took {1:.3f}s wall, {2:.3f}s cpu'.format(
+                name, stage.wall_time, stage.cpu_time))
+
+    def as_dict(self):
+        return {
+            'started': self.started,
+            'wall_time': sum(stage.wall_time for stage in self.stages),
+            'cpu_time': sum(stage.cpu_time for stage in self.stages),
+            'stages': [stage.as_dict() for stage in self.stages],
+            'counters': dict(self.counters),
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+            f.write('\n')
@@ -0,0 +1,304 @@
+import array
+import bisect
+import json
+import logging
+import mmap
+import os
+import shutil
+
+import numpy
+
+import dedupe.db
+import dedupe.filesystem
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+# the numeric columns of the table. checksums and algorithms are held as
+# codes into lists of the distinct ones, or -1 where there are none.
+COLUMNS = ('size', 'mtime', 'ctime', 'inode', 'device', 'blocks', 'checksum',
+           'algorithm')
+
+# every file a snapshot is made of
+SNAPSHOT_FILES = frozenset(
+    [name + '.npy' for name in COLUMNS]
+    + [name + suffix for name in ('paths', 'checksums')
+       for suffix in ('.bin', '_offsets.npy')]
+    + ['snapshot.json'])
+
+
+def holds_only_snapshot_files(directory):
+    # a directory that a snapshot, or a snapshot being written, can replace
+    # without taking anything else with it
+    return (os.path.isdir(directory)
+            and set(os.listdir(directory)) <= SNAPSHOT_FILES)
+
+
+def is_snapshot(directory):
+    return (holds_only_snapshot_files(directory)
+            and os.path.exists(os.path.join(directory, 'snapshot.json')))
+
+
+class Strings(object):
+    # a sequence of strings held end to end in one bytes object, so that
+    # millions of them cost no more than their length and an offset each,
+    # and can be mapped into memory as they are
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, strings):
+        data = bytearray()
+        offsets = array.array('q', [0])
+        for string in strings:
+            data += os.fsencode(string)
+            offsets.append(len(data))
+        return cls(bytes(data), numpy.frombuffer(offsets, dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i:i + 2].tolist()
+        return os.fsdecode(self.data[start:end])
+
+    def take(self, indexes):
+        # the strings at each of the indexes, looking up their offsets all
+        # at once
+        data = self.data
+        return [os.fsdecode(data[start:end]) for start, end in zip(
+            self.offsets[indexes].tolist(),
+            self.offsets[indexes + 1].tolist())]
+
+    def save(self, directory, name):
+        with open(os.path.join(directory, name + '.bin'), 'wb') as f:
+            f.write(self.data)
+        numpy.save(os.path.join(directory, name + '_offsets.npy'),
+                   self.offsets)
+
+    @classmethod
+    def load(cls, directory, name):
+        with open(os.path.join(directory, name + '.bin'), 'rb') as f:
+            # an empty file can't be mapped
+            if os.fstat(f.fileno()).st_size:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = b''
+        return cls(data, _load_column(directory, name + '_offsets'))
+
+
+def _load_column(directory, name):
+    # mapped into memory, but as a plain array, as indexing numpy's memmap
+    # subclass costs several times as much
+    return numpy.load(os.path.join(directory, name + '.npy'),
+                      mmap_mode='r').view(numpy.ndarray)
+
+
+def _codes(values):
+    # codes for each of the values, numbered in the order of the distinct
+    # values, so that comparing codes compares the values. None is -1.
+    distinct = sorted(set(value for value in values if value is not None))
+    code_of = dict((value, code) for code, value in enumerate(distinct))
+    code_of[None] = -1
+    return (numpy.fromiter((code_of[value] for value in values),
+                           dtype=numpy.int64, count=len(values)),
+            distinct)
+
+
+class FileTable(object):
+    # the files table of the database held as columns, one numpy array
+    # each, in order of path. sets of identical files are found with a sort
+    # and a few passes over whole columns rather than by a query per set.
+    # saved as a snapshot, a directory of files that are mapped into memory
+    # when loaded, so that a later run needn't query sqlite row by row.
+    def __init__(self, columns, paths, checksums, algorithms):
+        self.columns = columns
+        self.paths = paths
+        self.checksums = checksums
+        self.algorithms = algorithms
+
+    @classmethod
+    def from_db(cls, db):
+        paths = []
+        checksums = []
+        algorithms = []
+        numbers = array.array('q')
+        for path, bytesize, mtime, ctime, inode, device, blocks, checksum, \
+                algorithm in dedupe.db.all_files(db):
+            paths.append(path)
+            checksums.append(checksum)
+            algorithms.append(algorithm)
+            # rows recorded before inodes were are given one of their own,
+            # which no real inode shares
+            if inode is None:
+                inode, device = -len(paths), -1
+            numbers.extend((bytesize, mtime or 0, ctime or 0, inode,
+                            device, blocks))
+
+        numbers = numpy.frombuffer(numbers, dtype=numpy.int64).reshape(-1, 6)
+        columns = dict((name, numpy.ascontiguousarray(numbers[:, i]))
+                       for i, name in enumerate(COLUMNS[:6]))
+        columns['checksum'], checksums = _codes(checksums)
+        columns['algorithm'], algorithms = _codes(algorithms)
+        return cls(columns, Strings.build(paths), Strings.build(checksums),
+                   algorithms)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def save(self, directory):
+        # written alongside and then moved into place, so that a snapshot
+        # being read is never one half written. only an earlier snapshot is
+        # replaced, never a directory of anything else.
+        if os.path.lexists(directory) and not is_snapshot(directory):
+            raise ValueError('{} exists, and is not a snapshot'.format(
+                directory))
+        partial = directory.rstrip(os.sep) + '.partial'
+        if os.path.lexists(partial):
+            if not holds_only_snapshot_files(partial):
+                raise ValueError('{} exists, and is not a partly written'
+                                 ' snapshot'.format(partial))
+            shutil.rmtree(partial)
+        os.makedirs(partial)
+
+        for name in COLUMNS:
+            numpy.save(os.path.join(partial, name + '.npy'),
+                       self.columns[name])
+        self.paths.save(partial, 'paths')
+        self.checksums.save(partial, 'checksums')
+        with open(os.path.join(partial, 'snapshot.json'), 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'files': len(self),
+                       'algorithms': self.algorithms}, f)
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(partial, directory)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'snapshot.json')) as f:
+            metadata = json.load(f)
+        if metadata['version'] != SNAPSHOT_VERSION:
+            raise ValueError('{0} is a snapshot of version {1}, but only'
+                             ' version {2} can be read'.format(
+                                 directory, metadata['version'],
+                                 SNAPSHOT_VERSION))
+
+        columns = dict((name, _load_column(directory, name))
+                       for name in COLUMNS)
+        return cls(columns, Strings.load(directory, 'paths'),
+                   Strings.load(directory, 'checksums'),
+                   metadata['algorithms'])
+
+    def within(self, directories):
+        # the rows of the files beneath any of the directories. paths are in
+        # order, so the files beneath each directory are a range of rows.
+        ranges = []
+        for directory in directories:
+            prefix = os.path.join(directory, '')
+            upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            ranges.append(numpy.arange(bisect.bisect_left(self.paths, prefix),
+                                       bisect.bisect_left(self.paths,
+                                                          upper_bound)))
+        if not ranges:
+            return numpy.arange(0)
+        return numpy.unique(numpy.concatenate(ranges))
+
+    def duplicate_groups(self, within=None):
+        # each set of identical files, largest savings first, as (savings,
+        # rows of its files in order of path), just as the database gives
+        # them. savings are what every inode but that of the first path
+        # occupies.
+        if within:
+            rows = self.within(within)
+        else:
+            rows = numpy.arange(len(self))
+        rows = rows[self.columns['checksum'][rows] >= 0]
+        if not len(rows):
+            return
+
+        # sorted by set, and within a set by inode. the sort is stable, and
+        # rows are in order of path, so each inode's first path comes first.
+        keys = [self.columns[name][rows]
+                for name in ('inode', 'device', 'algorithm', 'checksum',
+                             'size')]
+        order = numpy.lexsort(keys)
+        rows = rows[order]
+        inode, device, algorithm, checksum, size = [key[order]
+                                                     for key in keys]
+
+        def starts(*columns):
+            changed = numpy.zeros(len(rows), dtype=bool)
+            changed[:1] = True
+            for column in columns:
+                changed[1:] |= column[1:] != column[:-1]
+            return changed
+
+        set_starts = starts(size, checksum, algorithm)
+        inode_starts = starts(size, checksum, algorithm, device, inode)
+
+        # the first path of each inode, and the most blocks of any of its
+        # paths
+        inode_indexes = numpy.flatnonzero(inode_starts)
+        inode_rows = rows[inode_indexes]
+        inode_blocks = numpy.maximum.reduceat(self.columns['blocks'][rows],
+                                              inode_indexes)
+        inode_sets = numpy.cumsum(set_starts)[inode_indexes] - 1
+
+        # the inodes of each set in order of their first paths, so that the
+        # first of each set is the one preserved
+        inode_order = numpy.lexsort((inode_rows, inode_sets))
+        inode_blocks = inode_blocks[inode_order]
+        set_inode_starts = numpy.flatnonzero(numpy.diff(
+            inode_sets, prepend=-1))
+        inode_counts = numpy.diff(numpy.append(set_inode_starts,
+                                               len(inode_sets)))
+        savings = (numpy.add.reduceat(inode_blocks, set_inode_starts)
+                   - inode_blocks[set_inode_starts]) * 512
+
+        # sets of more than one inode, ranked by savings, then by size, and
+        # then by checksum
+        set_row_starts = numpy.flatnonzero(set_starts)
+        set_row_ends = numpy.append(set_row_starts[1:], len(rows))
+        duplicates = numpy.flatnonzero(inode_counts > 1)
+        ranked = duplicates[numpy.lexsort((
+            checksum[set_row_starts[duplicates]],
+            -size[set_row_starts[duplicates]],
+            -savings[duplicates]))]
+
+        for i in ranked.tolist():
+            yield (int(savings[i]),
+                   numpy.sort(rows[set_row_starts[i]:set_row_ends[i]]))
+
+    def files(self, rows):
+        # the files of a set, with the paths of each inode but its first as
+        # its links
+        columns = dict((name, self.columns[name][rows].tolist())
+                       for name in COLUMNS)
+        checksums = self.checksums.take(self.columns['checksum'][rows])
+        # as they were in the database, where there were no inodes
+        inodes = [inode if inode >= 0 else None
+                  for inode in columns['inode']]
+        devices = [device if inode is not None else None
+                   for inode, device in zip(inodes, columns['device'])]
+
+        def file_of_row(row):
+            file = dedupe.filesystem.File.restore(*row[:7],
+                                                  hard_linked=True)
+            file.hash = row[7]
+            return file
+
+        return dedupe.filesystem.files_of_rows(
+            zip(self.paths.take(rows), columns['size'], columns['mtime'],
+                columns['ctime'], inodes, devices, columns['blocks'],
+                checksums),
+            file_of_row)
+
+
+def ranked_duplicates(table, within=None):
+    # like dedupe.report.ranked_duplicates(), from a table rather than the
+    # database
+    for savings, rows in table.duplicate_groups(within):
+        yield savings, table.files(rows)
@@ -1,12 +1,13 @@
 import os
 import random
+import shutil
 import string
 import unittest
 import logging
 logger = logging.getLogger(__name__)
 print(__name__)
 import dedupe
-from src.filesystem import FileFinder
+from dedupe.filesystem import FileFinder
 
 
 class FileFinderTest(unittest.TestCase):
@@ -58,7 +59,8 @@ class FileFinderTest(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        pass
+        shutil.rmtree(FileFinderTest.single_sample_directory)
+        shutil.rmtree(FileFinderTest.twin_file_sample_directory)
 
     def test_finding_sample_file(self):
         finder = FileFinder(within=FileFinderTest.single_sample_directory)
@@ -76,7 +78,7 @@ class FileFinderTest(unittest.TestCase):
         # finder should only find one path in the specified directory
         found_file = finder.find()
         found_file_size = list(found_file.keys())[0]
-        found_file_path = list(found_file.values())[0][0]
+        found_file_path = list(found_file.values())[0][0].path
 
         self.assertEqual(found_file_path, FileFinderTest.sample_filepath)
         self.assertEqual(found_file_size,
@@ -0,0 +1,115 @@
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+from dedupe.apply import Deduplicator
+from dedupe.apply import Journal
+from dedupe.apply import rollback
+from dedupe.db import insert_files
+from dedupe.db import update_with_checksums
+from dedupe.duplicates import repartition
+from dedupe.filesystem import find_file_sizes
+from dedupe.report import ranked_duplicates
+from dedupe.report import write_all
+from dedupe.utils import filter_singletons
+
+
+class DeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_filepath = os.path.join(self.directory, 'dedupe.db')
+        self.journal_filepath = os.path.join(self.directory, 'journal')
+        self.tree = os.path.join(self.directory, 'tree')
+        os.makedirs(self.tree)
+
+        self.paths = [os.path.join(self.tree, name) for name in 'abcd']
+        for path in self.paths:
+            with open(path, 'wb') as f:
+                f.write(b'duplicate' * 1000)
+        os.chmod(self.paths[1], 0o600)
+
+        filesizes = find_file_sizes(self.tree)
+        self.db = insert_files(filesizes, into=self.db_filepath)
+        candidates = filter_singletons(filesizes)
+        repartition(candidates)
+        update_with_checksums(candidates, self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _apply(self, method):
+        counters = collections.Counter()
+        journal = Journal(self.journal_filepath)
+        write_all(ranked_duplicates(self.db),
+                  [Deduplicator(method, journal, jobs=2, counters=counters)])
+        journal.close()
+        return counters
+
+    def _inodes(self):
+        return [os.stat(path).st_ino for path in self.paths]
+
+    def test_hardlink_resume_and_rollback(self):
+        # changed since it was hashed, so it is left alone
+        changed = self.paths[3]
+        os.utime(changed, ns=(0, 10**9))
+
+        counters = self._apply('hardlink')
+        self.assertEqual(counters['replaced'], 2)
+        self.assertEqual(counters['skipped_changed'], 1)
+
+        inodes = self._inodes()
+        self.assertEqual(len(set(inodes[:3])), 1)
+        self.assertNotEqual(inodes[3], inodes[0])
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.tree)), list('abcd'))
+
+        # resumed, nothing is replaced twice
+        counters = self._apply('hardlink')
+        self.assertEqual(counters['already_replaced'], 2)
+        self.assertEqual(counters['replaced'], 0)
+
+        counters = rollback(self.journal_filepath)
+        self.assertEqual(counters['restored'], 2)
+        self.assertEqual(len(set(self._inodes())), 4)
+        self.assertEqual(os.stat(self.paths[1]).st_mode & 0o777, 0o600)
+        for path in self.paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'duplicate' * 1000)
+
+    def test_hard_links_are_rolled_back_as_such(self):
+        # a pair of paths that were hard links of one another beforehand
+        linked = os.path.join(self.tree, 'e')
+        os.link(self.paths[2], linked)
+        filesizes = find_file_sizes(self.tree)
+        self.db = insert_files(filesizes, into=self.db_filepath,
+                               prune_within=[self.tree])
+        candidates = filter_singletons(filesizes)
+        repartition(candidates)
+        update_with_checksums(candidates, self.db)
+
+        counters = self._apply('hardlink')
+        self.assertEqual(counters['replaced'], 4)
+        self.assertEqual(len(set(self._inodes())), 1)
+
+        counters = rollback(self.journal_filepath)
+        self.assertEqual(counters['restored'], 4)
+        inodes = self._inodes()
+        self.assertEqual(len(set(inodes)), 4)
+        self.assertEqual(os.stat(linked).st_ino, inodes[2])
+        self.assertEqual(os.stat(linked).st_nlink, 2)
+
+    def test_reflink(self):
+        counters = self._apply('reflink')
+        if counters['failed']:
+            # most filesystems other than btrfs and xfs can't clone files
+            self.skipTest('reflinks unsupported in {}'.format(self.directory))
+
+        self.assertEqual(counters['replaced'], 3)
+        self.assertEqual(len(set(self._inodes())), 4)
+        self.assertEqual(os.stat(self.paths[1]).st_mode & 0o777, 0o600)
+
+
+if __name__ == '__main__':
+    unittest.main()
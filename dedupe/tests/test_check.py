@@ -0,0 +1,64 @@
+import collections
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from dedupe.check import TextMatches
+from dedupe.check import find_matches
+from dedupe.check import write_matches
+from dedupe.db import FileInformation
+from dedupe.db import insert_files
+from dedupe.filesystem import find_file_sizes
+
+
+class CheckTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_filepath = os.path.join(self.directory, 'dedupe.db')
+        self.archive = os.path.join(self.directory, 'archive')
+        self.incoming = os.path.join(self.directory, 'incoming')
+        os.makedirs(self.archive)
+        os.makedirs(self.incoming)
+
+        # indexed, but never hashed, as no other archived file shares its size
+        self._write(self.archive, 'kept', b'kept' * 1000)
+        self._write(self.archive, 'other', b'other')
+        self.db = insert_files(find_file_sizes(self.archive),
+                               into=self.db_filepath)
+
+        self._write(self.incoming, 'copy', b'kept' * 1000)
+        self._write(self.incoming, 'new', b'new' * 1000)
+        self._write(self.incoming, 'differs', b'KEPT' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, directory, name, contents):
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(contents)
+
+    def test_incoming_copies_are_found(self):
+        counters = collections.Counter()
+        matches = find_matches(find_file_sizes(self.incoming), self.db,
+                               within=[self.incoming], counters=counters)
+        output = io.StringIO()
+        matched, _ = write_matches(matches, TextMatches(output))
+
+        self.assertEqual(matched, 1)
+        path, archive_path = output.getvalue().splitlines()[0].split('\t')[2:]
+        self.assertEqual(path, os.path.join(self.incoming, 'copy'))
+        self.assertEqual(archive_path, os.path.join(self.archive, 'kept'))
+
+        # only the archived file of a matching size was looked at, and its
+        # checksum is kept for the next check
+        self.assertEqual(counters['archive_candidates'], 1)
+        checksums = dict(self.db.query(FileInformation.path,
+                                       FileInformation.checksum))
+        self.assertIsNotNone(checksums[archive_path])
+        self.assertIsNone(checksums[os.path.join(self.archive, 'other')])
+
+
+if __name__ == '__main__':
+    unittest.main()
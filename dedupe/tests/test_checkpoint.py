@@ -0,0 +1,84 @@
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+from dedupe.checkpoint import Checkpoint
+from dedupe.db import FileInformation
+from dedupe.db import insert_files
+from dedupe.duplicates import repartition
+from dedupe.filesystem import ScandirFinder
+from dedupe.filesystem import find_file_sizes
+from dedupe.utils import filter_singletons
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_filepath = os.path.join(self.directory, 'dedupe.db')
+        self.tree = os.path.join(self.directory, 'tree')
+
+        self.paths = []
+        for directory in ('a', 'a/b', 'a/b/c', 'd', 'd/e'):
+            os.makedirs(os.path.join(self.tree, directory))
+            for name in ('x', 'y'):
+                path = os.path.join(self.tree, directory, name)
+                with open(path, 'wb') as f:
+                    f.write(name.encode())
+                self.paths.append(path)
+
+        os.link(self.paths[0], os.path.join(self.tree, 'd', 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _paths(self, filesizes):
+        return sorted(path for files in filesizes.values()
+                      for f in files for path in f.paths)
+
+    def test_interrupted_walk_resumes(self):
+        expected = self._paths(find_file_sizes(self.tree))
+
+        # checkpointed after every directory, and abandoned part way through
+        walk = ScandirFinder(self.tree, checkpoint=Checkpoint(
+            self.db_filepath, interval=0))._next_file()
+        for _ in range(5):
+            next(walk)
+        walk.close()
+
+        counters = collections.Counter()
+        checkpoint = Checkpoint(self.db_filepath, resume=True)
+        filesizes = find_file_sizes(self.tree, counters=counters,
+                                    checkpoint=checkpoint)
+        self.assertGreater(counters['files_restored'], 0)
+        self.assertEqual(self._paths(filesizes), expected)
+
+        db = insert_files(filesizes, into=self.db_filepath,
+                          checkpoint=checkpoint)
+        stored_paths = sorted(path for path, in db.query(FileInformation.path))
+        self.assertEqual(stored_paths, expected)
+
+    def test_new_scan_discards_walk(self):
+        find_file_sizes(self.tree, checkpoint=Checkpoint(self.db_filepath))
+
+        counters = collections.Counter()
+        find_file_sizes(self.tree, counters=counters,
+                        checkpoint=Checkpoint(self.db_filepath))
+        self.assertEqual(counters['files_restored'], 0)
+
+    def test_digests_are_saved_while_hashing(self):
+        checkpoint = Checkpoint(self.db_filepath)
+        filesizes = find_file_sizes(self.tree, checkpoint=checkpoint)
+        db = insert_files(filesizes, into=self.db_filepath,
+                          checkpoint=checkpoint)
+        repartition(filter_singletons(filesizes), checkpoint=checkpoint)
+
+        checksums = dict(db.query(FileInformation.path,
+                                  FileInformation.checksum))
+        for path in self.paths:
+            self.assertIsNotNone(checksums[path])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import dedupe.table
+
+from dedupe.db import FileInformation
+from dedupe.db import connect
+from dedupe.db import duplicate_groups
+from dedupe.db import insert_files
+from dedupe.db import update_with_checksums
+from dedupe.duplicates import PrefilterStatistics
+from dedupe.duplicates import repartition
+from dedupe.filesystem import find_file_sizes
+from dedupe.hashing import BLAKE2b
+from dedupe.hashing import TreeHash
+from dedupe.hashing import XXH3_128
+from dedupe.hashing import XXH64
+from dedupe.report import ranked_duplicates
+from dedupe.table import FileTable
+from dedupe.utils import filter_singletons
+
+
+class IncrementalScanTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_filepath = os.path.join(self.directory, 'dedupe.db')
+        self.tree = os.path.join(self.directory, 'tree')
+        os.makedirs(self.tree)
+
+        self.paths = [self._write(name, b'duplicate')
+                      for name in ('a', 'b', 'c')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.tree, name)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def _scan(self, algorithm=None):
+        filesizes = find_file_sizes(self.tree)
+        db = insert_files(filesizes, into=self.db_filepath,
+                          prune_within=[self.tree], algorithm=algorithm)
+        candidates = filter_singletons(filesizes)
+        repartition(candidates,
+                    statistics=PrefilterStatistics(algorithm=algorithm))
+        update_with_checksums(candidates, db, algorithm=algorithm)
+        return filesizes, db
+
+    def test_unchanged_files_reuse_checksums(self):
+        self._scan()
+
+        filesizes = find_file_sizes(self.tree)
+        insert_files(filesizes, into=self.db_filepath)
+        for files in filesizes.values():
+            for f in files:
+                self.assertIsNotNone(f.hash)
+
+    def test_modified_files_are_rehashed(self):
+        self._scan()
+
+        # same size, different contents and modification time
+        modified = self.paths[0]
+        self._write('a', b'different')
+        stat = os.stat(modified)
+        os.utime(modified, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        filesizes = find_file_sizes(self.tree)
+        insert_files(filesizes, into=self.db_filepath)
+        hashes = dict((f.path, f.hash) for files in filesizes.values()
+                      for f in files)
+        self.assertIsNone(hashes[modified])
+        self.assertIsNotNone(hashes[self.paths[1]])
+
+    def test_staged_files_are_merged_into_the_table(self):
+        _, db = self._scan()
+        before = dict(db.query(FileInformation.path, FileInformation.checksum))
+
+        modified = self.paths[0]
+        self._write('a', b'different')
+        stat = os.stat(modified)
+        os.utime(modified, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        added = self._write('d', b'new')
+
+        db = insert_files(find_file_sizes(self.tree), into=self.db_filepath,
+                          prune_within=[self.tree])
+        rows = dict((path, (mtime, checksum, algorithm))
+                    for path, mtime, checksum, algorithm in db.query(
+                        FileInformation.path, FileInformation.mtime,
+                        FileInformation.checksum, FileInformation.algorithm))
+
+        # the changed row takes the new signature and loses its stale
+        # digests, new files are inserted, and unchanged rows keep theirs
+        self.assertEqual(rows[modified],
+                         (os.stat(modified).st_mtime_ns, None, None))
+        self.assertEqual(rows[added][1:], (None, None))
+        for path in self.paths[1:]:
+            self.assertEqual(rows[path][1], before[path])
+            self.assertIsNotNone(rows[path][1])
+
+    def test_deleted_files_are_pruned(self):
+        self._scan()
+        os.remove(self.paths[0])
+
+        _, db = self._scan()
+        stored_paths = set(path for path, in db.query(FileInformation.path))
+        self.assertEqual(stored_paths, set(self.paths[1:]))
+
+    def _reused(self, algorithm=None):
+        filesizes = find_file_sizes(self.tree)
+        insert_files(filesizes, into=self.db_filepath, algorithm=algorithm)
+        return [f.hash for files in filesizes.values() for f in files]
+
+    def test_checksums_are_reused_by_the_same_algorithm_only(self):
+        self._scan(algorithm=XXH3_128())
+        self.assertEqual(self._reused(), [None] * 3)
+
+        hashes = self._reused(algorithm=XXH3_128())
+        self.assertEqual(len(set(hashes)), 1)
+        self.assertEqual(len(hashes[0]), 32)
+
+    def test_chunks_of_files_hashed_as_trees_are_reused(self):
+        # files larger than a chunk are hashed as trees
+        tree_hash = TreeHash(XXH64(), chunk_size=4)
+        self._scan(algorithm=tree_hash)
+        self.assertEqual(self._reused(), [None] * 3)
+
+        filesizes = find_file_sizes(self.tree)
+        insert_files(filesizes, into=self.db_filepath, algorithm=tree_hash)
+        files = [f for files in filesizes.values() for f in files]
+        self.assertEqual(len(set(f.hash for f in files)), 1)
+        self.assertEqual(len(files[0].chunks), 3 * 8)
+
+        # while files no larger than a chunk have their usual digests, and
+        # reuse them whether or not files are hashed as trees
+        self._scan()
+        expected = self._reused()
+        self.assertNotIn(None, expected)
+        self.assertEqual(
+            self._reused(algorithm=TreeHash(XXH64(), chunk_size=16)),
+            expected)
+
+    def test_verified_files_are_not_read_again(self):
+        def verification_reads():
+            filesizes = find_file_sizes(self.tree)
+            db = insert_files(filesizes, into=self.db_filepath,
+                              prune_within=[self.tree])
+            candidates = filter_singletons(filesizes)
+            statistics = PrefilterStatistics(verification=BLAKE2b())
+            repartition(candidates, statistics=statistics)
+            update_with_checksums(candidates, db)
+            return statistics.stages[-1].files_read
+
+        self.assertEqual(verification_reads(), 3)
+        self.assertEqual(verification_reads(), 0)
+
+        # a new copy is compared with one of those already verified
+        self._write('d', b'duplicate')
+        self.assertEqual(verification_reads(), 2)
+        self.assertEqual(verification_reads(), 0)
+
+    def test_checksums_from_before_algorithms_were_recorded(self):
+        self._scan()
+        db = sqlite3.connect(self.db_filepath)
+        db.execute('ALTER TABLE files DROP COLUMN algorithm')
+        db.close()
+
+        # they were all xxh64 checksums
+        connect(self.db_filepath)
+        self.assertNotIn(None, self._reused())
+
+    def test_duplicates_recorded_before_inodes_were(self):
+        # as a database created before any but the path, size, checksum and
+        # first-block digest were recorded
+        db = sqlite3.connect(self.db_filepath)
+        db.execute('CREATE TABLE files (path VARCHAR NOT NULL, bytesize'
+                   ' INTEGER NOT NULL, checksum VARCHAR, first_block BLOB,'
+                   ' PRIMARY KEY (path))')
+        db.executemany('INSERT INTO files VALUES (?, 4096, ?, NULL)',
+                       [(path, 'same') for path in self.paths])
+        db.commit()
+        db.close()
+
+        # each path is an inode of its own
+        groups = [(savings, [row[0] for row in rows]) for savings, rows
+                  in duplicate_groups(connect(self.db_filepath))]
+        self.assertEqual(groups, [(2 * 4096, self.paths)])
+
+        files, = [files for _, files
+                  in ranked_duplicates(connect(self.db_filepath))]
+        self.assertEqual([f.path for f in files], self.paths)
+        self.assertEqual([f.links for f in files], [None] * 3)
+
+        table = FileTable.from_db(connect(self.db_filepath))
+        (savings, files), = dedupe.table.ranked_duplicates(table)
+        self.assertEqual(savings, 2 * 4096)
+        self.assertEqual([(f.path, f.links) for f in files],
+                         [(path, None) for path in self.paths])
+
+
+if __name__ == '__main__':
+    unittest.main()
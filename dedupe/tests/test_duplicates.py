@@ -0,0 +1,480 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import xxhash
+
+from dedupe.duplicates import BLOCK_SIZE
+from dedupe.duplicates import COMPARISON_MIN_FILE_SIZE
+from dedupe.duplicates import PrefilterStatistics
+from dedupe.duplicates import rank_by_potential_savings
+from dedupe.duplicates import repartition
+from dedupe.filesystem import File
+from dedupe.filesystem import find_file_sizes
+from dedupe.hashing import BLAKE2b
+from dedupe.hashing import HashAlgorithm
+from dedupe.hashing import TreeHash
+from dedupe.hashing import XXH64
+from dedupe.readers import ReadintoReader
+from dedupe.scheduler import DeviceLimits
+from dedupe.scheduler import scheduled_order
+from dedupe.utils import filter_singletons
+
+
+class RepartitionTest(unittest.TestCase):
+    # large enough that the tail block stage applies
+    sample_filesize = BLOCK_SIZE * 8
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        contents = bytearray(os.urandom(self.sample_filesize))
+
+        self.twins = [self._write('twin1', contents),
+                      self._write('twin2', contents)]
+
+        head_differs = bytearray(contents)
+        head_differs[0] ^= 0xFF
+        self.head_differs = self._write('head_differs', head_differs)
+
+        tail_differs = bytearray(contents)
+        tail_differs[-1] ^= 0xFF
+        self.tail_differs = self._write('tail_differs', tail_differs)
+
+        # differs in the middle, so only a full checksum can tell them apart
+        middle_differs = bytearray(contents)
+        middle_differs[len(contents) // 2] ^= 0xFF
+        self.middle_differs = self._write('middle_differs', middle_differs)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def _repartition(self, **kwargs):
+        statistics = PrefilterStatistics()
+        candidates = filter_singletons(find_file_sizes(self.directory))
+        partitions = repartition(candidates, statistics=statistics, **kwargs)
+        return filter_singletons(partitions), statistics
+
+    def test_only_identical_files_are_grouped(self):
+        duplicates, _ = self._repartition()
+
+        self.assertEqual(len(duplicates), 1)
+        files = list(duplicates.values())[0]
+        self.assertEqual(sorted(f.path for f in files), sorted(self.twins))
+
+    def test_each_stage_eliminates_files(self):
+        _, statistics = self._repartition()
+        first_block, tail_block, comparison, checksum = statistics.stages
+
+        self.assertEqual(first_block.files_examined, 5)
+        self.assertEqual(first_block.files_eliminated, 1)
+        self.assertEqual(tail_block.files_eliminated, 1)
+        self.assertEqual(checksum.files_eliminated, 1)
+
+        # only the middle file and the twins were read in their entirety
+        self.assertEqual(checksum.bytes_read, 3 * self.sample_filesize)
+        self.assertEqual(statistics.bytes_avoided,
+                         (self.sample_filesize - BLOCK_SIZE)
+                         + (self.sample_filesize - 2 * BLOCK_SIZE))
+
+    def test_workers_agree_with_a_single_thread(self):
+        # several groups of differing sizes, so that workers finish out of
+        # order
+        for size in range(1, 20):
+            self._write('small{}a'.format(size), b'x' * size)
+            self._write('small{}b'.format(size), b'x' * size)
+
+        expected, expected_statistics = self._repartition()
+        for use_processes in (False, True):
+            duplicates, statistics = self._repartition(
+                jobs=3, use_processes=use_processes)
+
+            self.assertEqual(list(duplicates), list(expected))
+            for checksum, files in expected.items():
+                self.assertEqual([f.path for f in duplicates[checksum]],
+                                 [f.path for f in files])
+            self.assertEqual(statistics.bytes_read,
+                             expected_statistics.bytes_read)
+
+    def test_large_files_are_compared(self):
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+        contents = os.urandom(COMPARISON_MIN_FILE_SIZE * 3)
+        twins = [self._write('large1', contents),
+                 self._write('large2', contents)]
+
+        # diverges within the first chunk past the prefilter blocks
+        differs = bytearray(contents)
+        differs[BLOCK_SIZE * 2] ^= 0xFF
+        self._write('large3', differs)
+
+        duplicates, statistics = self._repartition()
+        comparison, checksum = statistics.stages[-2:]
+
+        files, = duplicates.values()
+        self.assertEqual(sorted(f.path for f in files), sorted(twins))
+        for f in files:
+            self.assertEqual(f.hash, xxhash.xxh64(contents).hexdigest())
+
+        self.assertEqual(comparison.files_eliminated, 1)
+        self.assertEqual(statistics.bytes_avoided,
+                         len(contents) - BLOCK_SIZE * 2
+                         - COMPARISON_MIN_FILE_SIZE)
+        self.assertEqual(checksum.bytes_read, 0)
+
+    def test_short_reads_are_compared_in_full(self):
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+        contents = os.urandom(COMPARISON_MIN_FILE_SIZE * 3)
+        twins = [self._write('large1', contents),
+                 self._write('large2', contents)]
+
+        # reads return at most a few bytes less than asked for, and by how
+        # much differs between the files
+        def short_open(path, mode='r', buffering=-1):
+            f = open(path, mode, buffering=buffering)
+            if buffering:
+                return f
+            return ShortReads(f, 2 if path == twins[0] else 3)
+
+        with mock.patch('dedupe.duplicates.open', short_open, create=True):
+            duplicates, statistics = self._repartition()
+
+        files, = duplicates.values()
+        self.assertEqual(sorted(f.path for f in files), sorted(twins))
+        for f in files:
+            self.assertEqual(f.hash, xxhash.xxh64(contents).hexdigest())
+        self.assertEqual(statistics.stages[-1].bytes_read, 0)
+
+    def test_hashed_files_are_compared_through_one_of_them(self):
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+        contents = os.urandom(COMPARISON_MIN_FILE_SIZE * 3)
+        for name in ('hashed1', 'hashed2', 'new'):
+            self._write(name, contents)
+        differs = bytearray(contents)
+        differs[BLOCK_SIZE * 2] ^= 0xFF
+        self._write('differs', differs)
+
+        # as though from a previous scan, which eliminated the differing
+        # file before hashing it
+        files = find_file_sizes(self.directory)[len(contents)]
+        checksum = xxhash.xxh64(contents).hexdigest()
+        for f in files:
+            if os.path.basename(f.path).startswith('hashed'):
+                f.hash = checksum
+
+        statistics = PrefilterStatistics()
+        duplicates = filter_singletons(repartition(
+            {len(contents): files}, statistics=statistics))
+        comparison, checksum_stage = statistics.stages[-2:]
+
+        files, = duplicates.values()
+        self.assertEqual(sorted(os.path.basename(f.path) for f in files),
+                         ['hashed1', 'hashed2', 'new'])
+        self.assertEqual(set(f.hash for f in files), set([checksum]))
+        self.assertEqual(comparison.files_eliminated, 1)
+        self.assertEqual(checksum_stage.bytes_read, 0)
+
+    def test_small_files_are_read_once(self):
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self._write('small1', b'duplicate')
+        self._write('small2', b'duplicate')
+
+        duplicates, statistics = self._repartition()
+
+        self.assertEqual(len(duplicates), 1)
+        self.assertEqual(statistics.stages[-1].bytes_read, 0)
+
+    def test_hashing_stops_once_target_savings_are_found(self):
+        # three small pairs, each freeing less than the twins
+        for size in (100, 200, 300):
+            self._write('small{}a'.format(size), os.urandom(1) * size)
+            self._write('small{}b'.format(size), os.urandom(1) * size)
+        twins_savings = os.stat(self.twins[0]).st_blocks * 512
+
+        for jobs in (1, 3):
+            found = []
+            candidates = rank_by_potential_savings(
+                filter_singletons(find_file_sizes(self.directory)))
+            self.assertEqual(list(candidates)[0], self.sample_filesize)
+
+            repartition(candidates, jobs=jobs, target_savings=twins_savings,
+                        found=lambda savings, files: found.append(
+                            (savings, [f.path for f in files])))
+
+            # the biggest payoff is found first, and nothing else is hashed
+            # other than what workers had already started on
+            self.assertEqual(found, [(twins_savings, sorted(self.twins))])
+            if jobs == 1:
+                self.assertTrue(all(f.hash is None
+                                    for files in list(candidates.values())[1:]
+                                    for f in files))
+
+    def test_colliding_checksums(self):
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        for name, contents in (('a1', b'a'), ('a2', b'a'), ('b1', b'b'),
+                               ('b2', b'b'), ('long1', b'aa'),
+                               ('long2', b'aa')):
+            self._write(name, contents)
+
+        # every file has the same checksum
+        class Colliding(HashAlgorithm):
+            name = 'colliding'
+
+            def new(self):
+                return CollidingHasher()
+
+        candidates = filter_singletons(find_file_sizes(self.directory))
+        statistics = PrefilterStatistics(algorithm=Colliding())
+        duplicates = filter_singletons(repartition(candidates,
+                                                   statistics=statistics))
+        # files of different sizes are kept apart, but not those of the same
+        # size, which can only be told apart by verification
+        self.assertEqual(sorted(len(files) for files in duplicates.values()),
+                         [2, 4])
+
+        candidates = filter_singletons(find_file_sizes(self.directory))
+        statistics = PrefilterStatistics(algorithm=Colliding(),
+                                         verification=BLAKE2b())
+        duplicates = filter_singletons(repartition(candidates,
+                                                   statistics=statistics))
+        self.assertEqual(sorted(sorted(os.path.basename(f.path)
+                                       for f in files)
+                                for files in duplicates.values()),
+                         [['a1', 'a2'], ['b1', 'b2'], ['long1', 'long2']])
+        self.assertEqual(len(set(f.hash for files in duplicates.values()
+                                 for f in files)), 2)
+
+    def _repartition_as_trees(self, files, jobs=1):
+        statistics = PrefilterStatistics(
+            algorithm=TreeHash(XXH64(), chunk_size=BLOCK_SIZE, jobs=jobs))
+        partitions = repartition({self.sample_filesize: files},
+                                 statistics=statistics)
+        return filter_singletons(partitions), statistics
+
+    def test_tree_hashes_agree_however_chunks_are_read(self):
+        expected = None
+        for jobs in (1, 3):
+            files = find_file_sizes(self.directory)[self.sample_filesize]
+            duplicates, _ = self._repartition_as_trees(files, jobs=jobs)
+
+            files, = duplicates.values()
+            self.assertEqual(sorted(f.path for f in files),
+                             sorted(self.twins))
+            if expected is None:
+                expected = files[0].hash, files[0].chunks
+            self.assertEqual((files[0].hash, files[0].chunks), expected)
+
+        # the root is the digest of the digests of the chunks
+        checksum, chunks = expected
+        self.assertEqual(len(chunks), 8 * 8)
+        self.assertEqual(checksum, xxhash.xxh64(chunks).hexdigest())
+
+    def test_large_files_are_compared_with_known_chunks(self):
+        # diverges in the sixth of eight chunks
+        with open(self.twins[0], 'rb') as f:
+            contents = f.read()
+        late_differs = bytearray(contents)
+        late_differs[BLOCK_SIZE * 5] ^= 0xFF
+        self._write('late_differs', late_differs)
+        self._write('twin3', contents)
+
+        files = find_file_sizes(self.directory)[self.sample_filesize]
+        known = [f for f in files if f.path in self.twins]
+        self._repartition_as_trees(known)
+
+        new = [f for f in files if os.path.basename(f.path)
+               in ('late_differs', 'twin3')]
+        duplicates, statistics = self._repartition_as_trees(known[:1] + new)
+        chunk, checksum = statistics.stages[-2:]
+
+        files, = duplicates.values()
+        self.assertEqual(sorted(os.path.basename(f.path) for f in files),
+                         ['twin1', 'twin3'])
+        self.assertEqual(files[0].hash, files[1].hash)
+
+        # the differing file was read only as far as the chunk that differs,
+        # and nothing was left for the checksum stage
+        self.assertEqual(chunk.files_eliminated, 1)
+        self.assertEqual(chunk.bytes_read, BLOCK_SIZE * (6 + 8))
+        self.assertEqual(checksum.bytes_read, 0)
+
+    def test_devices_are_read_within_their_limits(self):
+        for size in range(1, 6):
+            contents = os.urandom(self.sample_filesize + size)
+            self._write('big{}a'.format(size), contents)
+            self._write('big{}b'.format(size), contents)
+        device = os.stat(self.directory).st_dev
+
+        expected, _ = self._repartition()
+        for limit in (1, 2):
+            reader = RecordingReader()
+            statistics = PrefilterStatistics(
+                reader=reader, device_limits=DeviceLimits({device: limit}))
+            candidates = filter_singletons(find_file_sizes(self.directory))
+            duplicates = filter_singletons(repartition(
+                candidates, statistics=statistics, jobs=4))
+
+            self.assertEqual(list(duplicates), list(expected))
+            self.assertGreater(reader.most_reading, 0)
+            self.assertLessEqual(reader.most_reading, limit)
+
+    def test_files_of_a_group_are_hashed_at_once(self):
+        with open(self.twins[0], 'rb') as f:
+            contents = f.read()
+        for i in range(10):
+            self._write('copy{}'.format(i), contents)
+        device = os.stat(self.directory).st_dev
+
+        expected, _ = self._repartition()
+        for limit in (4, 2):
+            reader = RecordingReader()
+            statistics = PrefilterStatistics(
+                reader=reader, device_limits=DeviceLimits({device: limit}))
+            candidates = filter_singletons(find_file_sizes(self.directory))
+            duplicates = filter_singletons(repartition(
+                candidates, statistics=statistics, jobs=4))
+
+            self.assertEqual(
+                [sorted(f.path for f in files)
+                 for files in duplicates.values()],
+                [sorted(f.path for f in files)
+                 for files in expected.values()])
+            self.assertGreater(reader.most_reading, 1)
+            self.assertLessEqual(reader.most_reading, limit)
+
+    def test_ranges_of_a_pair_are_read_at_once(self):
+        # large enough to be compared a block at a time, were they not
+        # hashed as trees
+        size = COMPARISON_MIN_FILE_SIZE * 2
+        contents = os.urandom(size)
+        self._write('huge1', contents)
+        self._write('huge2', contents)
+        device = os.stat(self.directory).st_dev
+
+        algorithm = TreeHash(XXH64(), chunk_size=size // 8, jobs=4)
+        for limit, jobs in ((4, 1), (4, 4), (2, 4)):
+            reader = RecordingRangeReader()
+            statistics = PrefilterStatistics(
+                reader=reader, algorithm=algorithm,
+                device_limits=DeviceLimits({device: limit}))
+            duplicates = filter_singletons(repartition(
+                {size: find_file_sizes(self.directory)[size]},
+                statistics=statistics, jobs=jobs))
+
+            files, = duplicates.values()
+            self.assertEqual(len(files), 2)
+            self.assertGreater(reader.most_reading, 1)
+            self.assertLessEqual(reader.most_reading, limit)
+
+    def test_groups_are_queued_by_device_in_order_of_inode(self):
+        def group(*inodes_and_devices):
+            return [File.restore('/{0}/{1}'.format(device, inode), 1, 0, 0,
+                                 inode, device, 0, hard_linked=False)
+                    for inode, device in inodes_and_devices]
+
+        partitions = {1: group((30, 1), (5, 1)), 2: group((20, 1), (10, 1)),
+                      3: group((7, 2), (1, 2)), 4: group((2, 1), (40, 2))}
+        queues = scheduled_order(partitions)
+        self.assertEqual(
+            dict((devices, [index for index, _ in queue])
+                 for devices, queue in queues.items()),
+            {frozenset([1]): [0, 1], frozenset([2]): [2],
+             frozenset([1, 2]): [3]})
+
+        # unless their order was ranked
+        queues = scheduled_order(dict(reversed(list(partitions.items()))),
+                                 preserve_order=True)
+        self.assertEqual([index for index, _ in queues[frozenset([1])]],
+                         [2, 3])
+
+
+class RecordingReader(ReadintoReader):
+    # records the most files being read at once
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.reading = 0
+        self.most_reading = 0
+
+    def update(self, hasher, path):
+        with self.lock:
+            self.reading += 1
+            self.most_reading = max(self.most_reading, self.reading)
+        try:
+            time.sleep(0.01)
+            super().update(hasher, path)
+        finally:
+            with self.lock:
+                self.reading -= 1
+
+
+class RecordingRangeReader(ReadintoReader):
+    # records the most ranges of files being read at once
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.reading = 0
+        self.most_reading = 0
+
+    def _read_range(self, hasher, fd, offset, length):
+        with self.lock:
+            self.reading += 1
+            self.most_reading = max(self.most_reading, self.reading)
+        try:
+            time.sleep(0.01)
+            super()._read_range(hasher, fd, offset, length)
+        finally:
+            with self.lock:
+                self.reading -= 1
+
+
+class ShortReads(object):
+    # a raw file whose reads return less than asked for
+    def __init__(self, raw, shortfall):
+        self.raw = raw
+        self.shortfall = shortfall
+
+    def readinto(self, buffer):
+        with memoryview(buffer) as view:
+            return self.raw.readinto(
+                view[:max(len(view) - self.shortfall, 1)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.raw.close()
+
+
+class CollidingHasher(object):
+    def update(self, data):
+        pass
+
+    def digest(self):
+        return b'0' * 8
+
+    def hexdigest(self):
+        return '0' * 16
+
+    def copy(self):
+        return self
+
+
+if __name__ == '__main__':
+    unittest.main()
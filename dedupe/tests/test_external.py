@@ -0,0 +1,62 @@
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+from dedupe.checkpoint import Checkpoint
+from dedupe.db import insert_files
+from dedupe.duplicates import repartition
+from dedupe.external import repartition as repartition_out_of_core
+from dedupe.external import spill_file_sizes
+from dedupe.filesystem import find_file_sizes
+from dedupe.report import ranked_duplicates
+from dedupe.utils import filter_singletons
+
+
+class OutOfCoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_filepath = os.path.join(self.directory, 'dedupe.db')
+        self.tree = os.path.join(self.directory, 'tree')
+        os.makedirs(os.path.join(self.tree, 'sub'))
+
+        contents = [b'a', b'a', b'b', b'bb', b'bb', b'cc', b'ddd', b'ddd',
+                    b'ddd', b'eeee']
+        for i, data in enumerate(contents):
+            directory = self.tree if i % 2 else os.path.join(self.tree, 'sub')
+            with open(os.path.join(directory, str(i)), 'wb') as f:
+                f.write(data)
+
+        os.link(os.path.join(self.tree, 'sub', '0'),
+                os.path.join(self.tree, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _groups(self, partitions):
+        return sorted(sorted(path for f in files for path in f.paths)
+                      for files in partitions.values())
+
+    def test_same_duplicates_as_in_memory(self):
+        expected = repartition(filter_singletons(find_file_sizes(self.tree)))
+        expected = filter_singletons(expected)
+
+        # small enough that sizes are read back in several batches
+        counters = collections.Counter()
+        checkpoint = Checkpoint(self.db_filepath, max_unsaved=2)
+        spill_file_sizes([self.tree], checkpoint, counters=counters)
+        db = insert_files(None, into=self.db_filepath,
+                          prune_within=[self.tree], checkpoint=checkpoint)
+        repartition_out_of_core(db, max_files=2, checkpoint=checkpoint,
+                                counters=counters)
+        duplicates = dict(enumerate(
+            files for _, files in ranked_duplicates(db, [self.tree])))
+
+        self.assertGreater(counters['batches'], 1)
+        self.assertEqual(counters['hard_links'], 1)
+        self.assertEqual(self._groups(duplicates), self._groups(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
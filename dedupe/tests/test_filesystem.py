@@ -0,0 +1,218 @@
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from dedupe.filesystem import File
+from dedupe.filesystem import FileFinder
+from dedupe.filesystem import ScandirFinder
+from dedupe.filesystem import WalkFilter
+from dedupe.filesystem import find_file_sizes
+from dedupe.filesystem import files_of_rows
+
+
+class ScandirFinderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        for depth in range(4):
+            directory = os.path.join(self.directory,
+                                     *['level{}'.format(i)
+                                       for i in range(depth)])
+            os.makedirs(directory, exist_ok=True)
+            for i in range(depth + 2):
+                with open(os.path.join(directory, 'file{}'.format(i)),
+                          'w') as f:
+                    f.write('x' * i)
+
+        target = os.path.join(self.directory, 'file1')
+        os.symlink(target, os.path.join(self.directory, 'file_link'))
+        os.symlink(os.path.join(self.directory, 'level0'),
+                   os.path.join(self.directory, 'directory_link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _found(self, finder):
+        return sorted((size, f.path) for size, files in finder.find().items()
+                      for f in files)
+
+    def test_finds_what_os_walk_finds(self):
+        expected = self._found(FileFinder(within=self.directory))
+
+        for jobs in (1, 4):
+            found = self._found(ScandirFinder(within=self.directory,
+                                              jobs=jobs))
+            self.assertEqual(found, expected)
+
+    def test_order_does_not_depend_on_workers(self):
+        def paths(jobs):
+            finder = ScandirFinder(within=self.directory, jobs=jobs)
+            return [f.path for f in finder._next_file()]
+
+        self.assertEqual(paths(1), paths(4))
+
+    def test_stat_is_reused(self):
+        counters = collections.Counter()
+        finder = ScandirFinder(within=self.directory, counters=counters)
+
+        # each file is stat'd once, by its directory entry, and never again
+        with mock.patch('os.stat', wraps=os.stat) as stat, \
+                mock.patch('os.lstat', wraps=os.lstat) as lstat:
+            found = list(finder._next_file())
+        self.assertEqual(stat.call_count + lstat.call_count, 0)
+        self.assertEqual(counters['stat_calls'], len(found))
+
+        for f in found:
+            stat = os.stat(f.path)
+            self.assertEqual(f.signature,
+                             (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns,
+                              stat.st_ino, stat.st_dev))
+
+    def test_pruned_directories_are_not_descended(self):
+        counters = collections.Counter()
+        finder = ScandirFinder(within=self.directory, counters=counters,
+                               walk_filter=WalkFilter(exclude=['level1']))
+
+        self.assertEqual(len(self._found(finder)), 5)
+        self.assertEqual(counters['directories_pruned'], 1)
+        self.assertEqual(counters['directories_scanned'], 2)
+
+    def test_files_are_filtered_by_name_and_size(self):
+        counters = collections.Counter()
+        walk_filter = WalkFilter(include=['file*'], exclude=['*/level0/file*'],
+                                 min_size=2, max_size=3)
+        finder = ScandirFinder(within=self.directory, counters=counters,
+                               walk_filter=walk_filter)
+
+        self.assertEqual(
+            [os.path.relpath(path, self.directory)
+             for _, path in self._found(finder)],
+            ['level0/level1/file2', 'level0/level1/level2/file2',
+             'level0/level1/file3', 'level0/level1/level2/file3'])
+        # the three files directly beneath level0 were excluded before they
+        # were stat'd
+        self.assertEqual(counters['stat_calls'], 14 - 3)
+
+    def test_special_files_are_skipped(self):
+        os.mkfifo(os.path.join(self.directory, 'fifo'))
+        counters = collections.Counter()
+        finder = ScandirFinder(within=self.directory, counters=counters)
+
+        self.assertNotIn(os.path.join(self.directory, 'fifo'),
+                         [path for _, path in self._found(finder)])
+        self.assertEqual(counters['special_files_skipped'], 1)
+
+
+class FileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.directory, name)
+                      for name in ('a', 'b')]
+        for path in self.paths:
+            with open(path, 'wb') as f:
+                f.write(b'contents')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_path_round_trips(self):
+        file = File(self.paths[0])
+        self.assertEqual(file.path, self.paths[0])
+        self.assertEqual(file.name, 'a')
+
+        stat = os.stat(self.paths[0])
+        restored = File.restore(self.paths[0], stat.st_size,
+                                stat.st_mtime_ns, stat.st_ctime_ns,
+                                stat.st_ino, stat.st_dev, stat.st_blocks,
+                                hard_linked=False)
+        self.assertEqual(restored.path, self.paths[0])
+        self.assertEqual(restored.signature, file.signature)
+
+    def test_files_of_a_directory_share_its_string(self):
+        # splitting each path makes a new directory string, which is
+        # interned so that only one is kept
+        first, second = [File(path) for path in self.paths]
+        self.assertIs(first.directory, second.directory)
+
+    def test_records_are_slotted(self):
+        file = File(self.paths[0])
+        self.assertFalse(hasattr(file, '__dict__'))
+        with self.assertRaises(AttributeError):
+            file.hasher = None
+
+    def test_hasher_is_created_only_when_hashing(self):
+        algorithm = mock.Mock()
+        algorithm.hash_file.return_value.hexdigest.return_value = 'digest'
+        algorithm.chunks.return_value = None
+
+        file = File(self.paths[0])
+        self.assertEqual(file.checksum(algorithm=algorithm), 'digest')
+        self.assertEqual(algorithm.hash_file.call_count, 1)
+
+        # already hashed, or reused from a previous scan
+        self.assertEqual(file.checksum(algorithm=algorithm), 'digest')
+        reused = File(self.paths[1])
+        reused.hash = 'reused'
+        self.assertEqual(reused.checksum(algorithm=algorithm), 'reused')
+        self.assertEqual(algorithm.hash_file.call_count, 1)
+
+    def test_rows_of_hard_links_make_one_file(self):
+        rows = [('/a', 1, 0, 0, 7, 1), ('/b', 1, 0, 0, 8, 1),
+                ('/c', 1, 0, 0, 7, 1), ('/d', 1, 0, 0, 7, 2),
+                ('/e', 1, 0, 0, None, None), ('/f', 1, 0, 0, None, None),
+                ('/gone', 1, 0, 0, 9, 1), ('/g', 1, 0, 0, 9, 1)]
+
+        def file_of_row(row):
+            if row[0] == '/gone':
+                return None
+            return File.restore(*row, blocks=1, hard_linked=False)
+
+        counters = collections.Counter()
+        files = files_of_rows(rows, file_of_row, counters)
+        self.assertEqual([file.paths for file in files],
+                         [['/a', '/c'], ['/b'], ['/d'], ['/e'], ['/f'],
+                          ['/g']])
+        self.assertEqual([file.links for file in files[1:]], [None] * 5)
+        self.assertEqual(counters['hard_links'], 1)
+
+
+class HardLinkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.roots = [os.path.join(self.directory, root)
+                      for root in ('first', 'second')]
+        for root in self.roots:
+            os.makedirs(root)
+
+        self.original = os.path.join(self.roots[0], 'original')
+        with open(self.original, 'w') as f:
+            f.write('x' * 10000)
+
+        # one link in the same directory, another beneath a different root
+        self.links = [os.path.join(self.roots[0], 'link'),
+                      os.path.join(self.roots[1], 'link')]
+        for link in self.links:
+            os.link(self.original, link)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_links_are_collapsed_into_one_file(self):
+        found = find_file_sizes(self.roots)
+
+        files = found[10000]
+        self.assertEqual(len(files), 1)
+        self.assertEqual(sorted(files[0].paths),
+                         sorted([self.original] + self.links))
+
+    def test_allocated_size(self):
+        file, = find_file_sizes(self.roots)[10000]
+        self.assertEqual(file.allocated,
+                         os.stat(self.original).st_blocks * 512)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import xxhash
+
+from dedupe.readers import ChunkedReader
+from dedupe.readers import MmapReader
+from dedupe.readers import ReadintoReader
+
+
+class ReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, size):
+        path = os.path.join(self.directory, str(size))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_readers_agree(self):
+        readers = [ChunkedReader(buffer_size=4096),
+                   ReadintoReader(buffer_size=1000),
+                   # small enough that every non-empty file is mapped
+                   MmapReader(buffer_size=1000, threshold=1)]
+
+        for size in (0, 1, 999, 1000, 1001, 65536 + 7):
+            path = self._write(size)
+            with open(path, 'rb') as f:
+                expected = xxhash.xxh64(f.read()).hexdigest()
+
+            for reader in readers:
+                hasher = xxhash.xxh64()
+                reader.update(hasher, path)
+                self.assertEqual(hasher.hexdigest(), expected,
+                                 msg='{0} on {1} bytes'.format(reader, size))
+
+
+if __name__ == '__main__':
+    unittest.main()
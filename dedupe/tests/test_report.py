@@ -0,0 +1,125 @@
+import csv
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from dedupe.db import insert_files
+from dedupe.db import update_with_checksums
+from dedupe.duplicates import repartition
+from dedupe.filesystem import find_file_sizes
+from dedupe.report import CSVReport
+from dedupe.report import JSONLinesReport
+from dedupe.report import rank_by_savings
+from dedupe.report import ranked_duplicates
+from dedupe.report import write_all
+from dedupe.utils import filter_singletons
+
+
+class StreamedReportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_filepath = os.path.join(self.directory, 'dedupe.db')
+        self.tree = os.path.join(self.directory, 'tree')
+        os.makedirs(self.tree)
+
+        for name, size in (('a', 10000), ('b', 10000), ('c', 20000),
+                           ('d', 20000), ('e', 20000), ('f', 5)):
+            with open(os.path.join(self.tree, name), 'wb') as f:
+                f.write(b'x' * size)
+        os.link(os.path.join(self.tree, 'a'), os.path.join(self.tree, 'g'))
+
+        filesizes = find_file_sizes(self.tree)
+        self.db = insert_files(filesizes, into=self.db_filepath)
+        candidates = filter_singletons(filesizes)
+        self.duplicates = filter_singletons(repartition(candidates))
+        update_with_checksums(candidates, self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_sets_as_in_memory(self):
+        def sets(ranked):
+            return [(savings, sorted(path for f in files for path in f.paths))
+                    for savings, files in ranked]
+
+        streamed = sets(ranked_duplicates(self.db, within=[self.tree]))
+        self.assertEqual(streamed, sets(rank_by_savings(self.duplicates)))
+        self.assertEqual(
+            [paths for _, paths in streamed],
+            [[os.path.join(self.tree, name) for name in 'cde'],
+             [os.path.join(self.tree, name) for name in 'abg']])
+
+        # nothing is reported beneath other directories
+        self.assertEqual(list(ranked_duplicates(self.db, within=['/nowhere'])),
+                         [])
+
+    def test_formats(self):
+        csv_output = io.StringIO()
+        jsonl_output = io.StringIO()
+        write_all(ranked_duplicates(self.db),
+                  [CSVReport(csv_output), JSONLinesReport(jsonl_output)])
+
+        rows = list(csv.DictReader(io.StringIO(csv_output.getvalue())))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual([row['hard_link_to'] for row in rows
+                          if row['path'].endswith('g')],
+                         [os.path.join(self.tree, 'a')])
+
+        sets = [json.loads(line)
+                for line in jsonl_output.getvalue().splitlines()]
+        self.assertEqual([len(s['files']) for s in sets], [3, 2])
+        self.assertEqual(sets[1]['files'][0]['hard_links'],
+                         [os.path.join(self.tree, 'g')])
+
+
+class NoDatabaseReportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tree = os.path.join(self.directory, 'tree')
+        os.makedirs(self.tree)
+
+        # sets that free as many blocks as one another, of the same size and
+        # of different sizes, so that only the tie breakers rank them
+        for name, size, contents in (('a', 10000, b'x'), ('b', 10000, b'y'),
+                                     ('c', 9000, b'z'), ('d', 20000, b'w')):
+            for copy in ('1', '2'):
+                with open(os.path.join(self.tree, name + copy), 'wb') as f:
+                    f.write(contents * size)
+
+        # hard links beneath a directory, walked after the files beside it
+        # but first by path
+        os.makedirs(os.path.join(self.tree, '0'))
+        for name in ('a1', 'd2'):
+            os.link(os.path.join(self.tree, name),
+                    os.path.join(self.tree, '0', name))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _report(self, *arguments):
+        script = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))), 'dedupe.py')
+        return subprocess.run(
+            [sys.executable, script] + list(arguments) + [self.tree],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True).stdout.decode()
+
+    def test_same_report_as_from_the_database(self):
+        for report_format in ('text', 'csv', 'jsonl'):
+            from_db = self._report(
+                '--db', os.path.join(self.directory, 'dedupe.db'),
+                '-f', report_format)
+            self.assertEqual(self._report('--no-db', '-f', report_format),
+                             from_db)
+            for name in ('a1', 'a2', 'b1', 'b2', 'c1', 'c2', 'd1', 'd2',
+                         '0/a1', '0/d2'):
+                self.assertIn(os.path.join(self.tree, name), from_db)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dedupe.db import insert_files
+from dedupe.db import requests
+from dedupe.db import set_shard_name
+from dedupe.db import update_with_checksums
+from dedupe.duplicates import repartition
+from dedupe.filesystem import find_file_sizes
+from dedupe.shards import answer_requests
+from dedupe.shards import digest_blocks
+from dedupe.shards import merge
+from dedupe.utils import filter_singletons
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.shared = os.urandom(10000)
+
+        # directories standing in for hosts
+        self._write('a/shared', self.shared)
+        self._write('a/differs', b'a' * 20000)
+        self._write('b/shared', self.shared)
+        self._write('b/differs', b'b' * 20000)
+        self._write('b/local1', b'local' * 1000)
+        self._write('b/local2', b'local' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    def _scan(self, name):
+        # as a host would with --shard
+        shard = os.path.join(self.directory, name + '.db')
+        filesizes = find_file_sizes(os.path.join(self.directory, name))
+        db = insert_files(filesizes, into=shard)
+        candidates = filter_singletons(filesizes)
+        repartition(candidates)
+        update_with_checksums(candidates, db)
+        set_shard_name(db, 'host-' + name)
+        digest_blocks(db)
+        answer_requests(db)
+        return shard, db
+
+    def _merge(self, *shards):
+        duplicates = filter_singletons(merge(shards))
+        return sorted(sorted(f.path for f in files)
+                      for files in duplicates.values())
+
+    def test_shared_sizes_are_hashed_once_requested(self):
+        a, a_db = self._scan('a')
+        b, b_db = self._scan('b')
+
+        # only what each shard found itself, until the sizes they share
+        # have been hashed
+        local = ['host-b:' + os.path.join(self.directory, 'b', name)
+                 for name in ('local1', 'local2')]
+        self.assertEqual(self._merge(a, b), [local])
+        self.assertEqual(requests(a_db), [10000])
+        self.assertEqual(requests(b_db), [10000])
+
+        self._scan('a')
+        self._scan('b')
+        shared = ['host-{0}:{1}'.format(name, os.path.join(
+                      self.directory, name, 'shared'))
+                  for name in ('a', 'b')]
+        self.assertEqual(self._merge(a, b), [shared, local])
+        self.assertEqual(requests(a_db), [])
+
+    def test_first_blocks_that_differ_are_not_requested(self):
+        # each shard read the first blocks of its files of this size, and
+        # none is shared with the other shard
+        self._write('a/differs2', b'A' * 20000)
+        self._write('b/differs2', b'B' * 20000)
+        a, a_db = self._scan('a')
+        b, b_db = self._scan('b')
+
+        self._merge(a, b)
+        self.assertEqual(requests(a_db), [10000])
+        self.assertEqual(requests(b_db), [10000])
+
+    def test_sizes_of_one_file_per_shard_are_narrowed(self):
+        # sizes no shard holds more than one file of, whose files differ
+        # from the other shard's at the start and at the end
+        self._write('a/solo1', b'x' * 30000)
+        self._write('b/solo1', b'y' * 30000)
+        self._write('a/solo2', b'x' * 39999 + b'a')
+        self._write('b/solo2', b'x' * 39999 + b'b')
+        a, a_db = self._scan('a')
+        b, b_db = self._scan('b')
+
+        self._merge(a, b)
+        self.assertEqual(requests(a_db), [10000])
+        self.assertEqual(requests(b_db), [10000])
+
+    def test_shards_must_be_named(self):
+        shard = os.path.join(self.directory, 'unnamed.db')
+        insert_files(find_file_sizes(os.path.join(self.directory, 'a')),
+                     into=shard)
+        with self.assertRaises(ValueError):
+            merge([shard])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from dedupe.stats import Instrumentation
+from dedupe.utils import filter_singletons
+
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stages_are_timed_and_counted(self):
+        profile_directory = os.path.join(self.directory, 'profiles')
+        instrumentation = Instrumentation(profile_directory=profile_directory)
+
+        partitions = {1: ['a'], 2: ['b', 'c'], 3: ['d', 'e', 'f']}
+        with instrumentation.stage('size_filter') as counters:
+            filter_singletons(partitions, counters=counters)
+
+        stats_filepath = os.path.join(self.directory, 'stats.json')
+        instrumentation.write(stats_filepath)
+        with open(stats_filepath) as f:
+            stats = json.load(f)
+
+        stage, = stats['stages']
+        self.assertEqual(stage['stage'], 'size_filter')
+        self.assertGreaterEqual(stage['wall_time'], 0)
+        self.assertEqual(stage['counters'], {
+            'partitions_dropped': 1, 'files_dropped': 1,
+            'partitions_kept': 2, 'files_kept': 5,
+        })
+        self.assertTrue(os.path.exists(
+            os.path.join(profile_directory, 'size_filter.prof')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from dedupe.db import insert_files
+from dedupe.db import update_with_checksums
+from dedupe.duplicates import repartition
+from dedupe.filesystem import find_file_sizes
+from dedupe.report import ranked_duplicates
+from dedupe.utils import filter_singletons
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class FileTableTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_filepath = os.path.join(self.directory, 'dedupe.db')
+        self.tree = os.path.join(self.directory, 'tree')
+        os.makedirs(os.path.join(self.tree, 'sub'))
+
+        for name, contents in (('a', b'x' * 10000), ('b', b'x' * 10000),
+                               ('sub/c', b'y' * 20000),
+                               ('sub/d', b'y' * 20000),
+                               ('e', b'y' * 20000), ('f', b'z' * 5),
+                               ('g', b'y' * 10000)):
+            with open(os.path.join(self.tree, name), 'wb') as f:
+                f.write(contents)
+        os.link(os.path.join(self.tree, 'a'), os.path.join(self.tree, 'h'))
+
+        filesizes = find_file_sizes(self.tree)
+        self.db = insert_files(filesizes, into=self.db_filepath)
+        candidates = filter_singletons(filesizes)
+        repartition(candidates)
+        update_with_checksums(candidates, self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _sets(self, ranked):
+        return [(savings, [(f.path, f.links, f.hash, f.signature)
+                           for f in files])
+                for savings, files in ranked]
+
+    def test_snapshot_agrees_with_the_database(self):
+        from dedupe.table import FileTable
+        from dedupe.table import ranked_duplicates as ranked_from_table
+
+        snapshot = os.path.join(self.directory, 'snapshot')
+        FileTable.from_db(self.db).save(snapshot)
+        table = FileTable.load(snapshot)
+        self.assertEqual(len(table), 8)
+
+        for within in (None, [self.tree], [os.path.join(self.tree, 'sub')],
+                       ['/nowhere']):
+            expected = self._sets(ranked_duplicates(self.db, within=within))
+            self.assertEqual(
+                self._sets(ranked_from_table(table, within=within)),
+                expected)
+
+        # hard links are counted once, and sets are ranked by savings
+        expected = self._sets(ranked_duplicates(self.db))
+        self.assertEqual([len(files) for _, files in expected], [3, 2])
+        self.assertEqual(expected[1][1][0][1],
+                         [os.path.join(self.tree, 'h')])
+
+    def test_only_snapshots_are_replaced(self):
+        from dedupe.table import FileTable
+
+        snapshot = os.path.join(self.directory, 'snapshot')
+        FileTable.from_db(self.db).save(snapshot)
+        FileTable.from_db(self.db).save(snapshot)
+        self.assertEqual(len(FileTable.load(snapshot)), 8)
+
+        precious = os.path.join(self.directory, 'precious')
+        os.makedirs(precious)
+        notes = os.path.join(precious, 'notes.txt')
+        with open(notes, 'w') as f:
+            f.write('notes')
+        with self.assertRaises(ValueError):
+            FileTable.from_db(self.db).save(precious)
+
+        # nor does the command line get as far as trying
+        script = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))), 'dedupe.py')
+        result = subprocess.run(
+            [sys.executable, script, '--db', self.db_filepath,
+             '--report-only', '--write-snapshot', precious, self.tree],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn(b'not a snapshot', result.stderr)
+        self.assertEqual(os.listdir(precious), ['notes.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from dedupe.db import FileInformation
+from dedupe.db import duplicate_groups
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        from dedupe.watch import Watcher
+
+        self.directory = tempfile.mkdtemp()
+        self.db_filepath = os.path.join(self.directory, 'dedupe.db')
+        self.tree = os.path.join(self.directory, 'tree')
+        os.makedirs(os.path.join(self.tree, 'sub'))
+
+        self._write('original', b'duplicate' * 1000)
+        self._write('sub/unique', b'unique')
+
+        self.watcher = Watcher(within=[self.tree], into=self.db_filepath)
+        self.watcher.scan()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, contents):
+        with open(os.path.join(self.tree, name), 'wb') as f:
+            f.write(contents)
+
+    def _process_events(self):
+        return self.watcher.process_events(timeout=5, settle=0.1)
+
+    def _duplicates(self):
+        return [sorted(os.path.relpath(row[0], self.tree) for row in rows)
+                for _, rows in duplicate_groups(self.watcher.db)]
+
+    def _checksums(self):
+        return dict((os.path.relpath(path, self.tree), checksum)
+                    for path, checksum in self.watcher.db.query(
+                        FileInformation.path, FileInformation.checksum))
+
+    def test_changes_are_applied(self):
+        self.assertEqual(self._duplicates(), [])
+
+        self._write('sub/copy', b'duplicate' * 1000)
+        self.assertGreater(self._process_events(), 0)
+        self.assertEqual(self._duplicates(), [['original', 'sub/copy']])
+
+        # files the only ones of their size are never hashed
+        self.assertIsNone(self._checksums()['sub/unique'])
+
+        # a renamed directory takes its files along
+        os.rename(os.path.join(self.tree, 'sub'),
+                  os.path.join(self.tree, 'moved'))
+        self._process_events()
+        self.assertEqual(self._duplicates(), [['moved/copy', 'original']])
+        self.assertEqual(sorted(self._checksums()),
+                         ['moved/copy', 'moved/unique', 'original'])
+
+        # changed to differ, and then removed
+        self._write('moved/copy', b'DUPLICATE' * 1000)
+        self._process_events()
+        self.assertEqual(self._duplicates(), [])
+
+        os.remove(os.path.join(self.tree, 'moved', 'copy'))
+        self._process_events()
+        self.assertEqual(sorted(self._checksums()),
+                         ['moved/unique', 'original'])
+
+    def test_stale_rows_outside_the_watch_are_ignored(self):
+        from dedupe.db import insert_files
+        from dedupe.filesystem import find_file_sizes
+
+        # another tree scanned into the same database, one of whose files
+        # has since gone without the watcher hearing of it
+        other = os.path.join(self.directory, 'other')
+        os.makedirs(other)
+        stale = os.path.join(other, 'stale')
+        with open(stale, 'wb') as f:
+            f.write(b'copy' * 1000)
+        insert_files(find_file_sizes(other), into=self.db_filepath,
+                     prune_within=[other]).close()
+        os.remove(stale)
+
+        self._write('copy1', b'copy' * 1000)
+        self._write('copy2', b'copy' * 1000)
+        self._process_events()
+        self.assertEqual(self._duplicates(), [['copy1', 'copy2']])
+        self.assertEqual(self.watcher.counters['hashing_interrupted'], 0)
+
+    def test_excluded_files_are_skipped(self):
+        from dedupe.filesystem import WalkFilter
+
+        self.watcher.walk_filter = WalkFilter(exclude=['*.tmp'])
+        self._write('copy.tmp', b'duplicate' * 1000)
+        self._process_events()
+        self.assertNotIn('copy.tmp', self._checksums())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,22 +1,43 @@
 import logging
 import pprint
+import shutil
+
+import progressbar
 
 logger = logging.getLogger(__name__)
 
-def filter_singletons(partitions):
+
+def progress_bar(max_value):
+    # progressbar looks for the terminal's width itself by importing IPython
+    # if it is installed, which can take longer than a small scan. the width
+    # is given instead.
+    return progressbar.ProgressBar(
+        max_value=max_value, term_width=shutil.get_terminal_size().columns)
+
+
+def filter_singletons(partitions, counters=None):
     # identify filesizes that correspond to one or no files
     sizes_to_filter = filter(lambda key: len(partitions[key]) <= 1,
                              partitions)
 
     # delete these singleton filesizes from the set
     for size in list(sizes_to_filter):
+        if counters is not None:
+            counters['partitions_dropped'] += 1
+            counters['files_dropped'] += len(partitions[size])
         del partitions[size]
 
-    logger.debug('='*80)
-    logger.debug('Singleton filtering')
-    for key, values in partitions.items():
-        logger.debug('{0: >14} bytes | {1: >5} items'.format(
-            key, len(values)))
-        logger.debug(pprint.pformat(values))
+    if counters is not None:
+        counters['partitions_kept'] += len(partitions)
+        counters['files_kept'] += sum(len(files)
+                                      for files in partitions.values())
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('='*80)
+        logger.debug('Singleton filtering')
+        for key, values in partitions.items():
+            logger.debug('{0: >14} bytes | {1: >5} items'.format(
+                key, len(values)))
+            logger.debug(pprint.pformat(values))
 
     return partitions
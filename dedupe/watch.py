@@ -0,0 +1,389 @@
+import collections
+import ctypes
+import itertools
+import logging
+import os
+import select
+import stat
+import struct
+import time
+
+import dedupe.db
+import dedupe.duplicates
+import dedupe.filesystem
+import dedupe.utils
+
+logger = logging.getLogger(__name__)
+
+# events are applied once none have arrived for this many seconds, so that a
+# file being written is hashed once, after it is finished
+SETTLE_TIME = 1.0
+
+# but no longer than this many seconds after the first, however busy the
+# watched directories are
+MAX_DELAY = 10.0
+
+# the events and flags of inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+# files are looked at again once they have been written and closed rather
+# than on every write
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+              | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+# struct inotify_event, which is followed by a name of len bytes padded with
+# nulls
+_event = struct.Struct('iIII')
+
+READ_SIZE = 64 * 1024
+
+
+def _beneath(path, directories):
+    return any(path == directory
+               or path.startswith(os.path.join(directory, ''))
+               for directory in directories)
+
+
+class Inotify(object):
+    # watches directories through the inotify calls of the C library the
+    # interpreter is linked against, so that no module need be installed.
+    # inotify isn't recursive, and each directory is watched in its own
+    # right.
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        # watch descriptor -> directory
+        self.directories = {}
+
+    def add_watch(self, directory):
+        descriptor = self._add_watch(self.fd, os.fsencode(directory),
+                                     WATCH_MASK)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+        self.directories[descriptor] = directory
+
+    def remove_watches(self, directory):
+        # the directory and every directory beneath it
+        for descriptor, watched in list(self.directories.items()):
+            if _beneath(watched, [directory]):
+                self._rm_watch(self.fd, descriptor)
+                del self.directories[descriptor]
+
+    def read(self, timeout=None):
+        # the (mask, path) of each event to arrive within timeout seconds,
+        # or of none. the path of an overflow, when events were lost, is
+        # None.
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, _, length = _event.unpack_from(data,
+                                                                 offset)
+                offset += _event.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    events.append((mask, None))
+                    continue
+
+                # the watch is gone, whether removed or because its
+                # directory was
+                if mask & IN_IGNORED:
+                    self.directories.pop(descriptor, None)
+                    continue
+
+                directory = self.directories.get(descriptor)
+                if directory is None:
+                    continue
+
+                if name:
+                    events.append((mask, os.path.join(directory,
+                                                      os.fsdecode(name))))
+                else:
+                    events.append((mask, directory))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    # keeps the database current with the files beneath the watched
+    # directories. as files are created, changed, renamed and removed, only
+    # they are looked at again, and of them only those that share their size
+    # with another file are hashed. a file left the only one of its size
+    # isn't hashed again until another joins it. duplicates can be queried
+    # from the database at any time while the watch goes on, as with
+    # --report-only.
+    #
+    # directories are watched from the moment the watcher is made, so that
+    # changes made while they're first scanned aren't missed.
+    def __init__(self, within, into, statistics=None, walk_filter=None,
+                 jobs=1, counters=None):
+        if statistics is None:
+            statistics = dedupe.duplicates.PrefilterStatistics()
+        if walk_filter is None:
+            walk_filter = dedupe.filesystem.NO_FILTER
+        if counters is None:
+            counters = collections.Counter()
+
+        self.within = within
+        self.into = into
+        self.statistics = statistics
+        self.walk_filter = walk_filter
+        self.jobs = jobs
+        self.counters = counters
+        self.db = dedupe.db.connect(into)
+
+        self.inotify = Inotify()
+        for directory in within:
+            self._watch_tree(directory, os.stat(directory).st_dev)
+
+    def _watch_tree(self, root, device):
+        # the directories the walk would descend into
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            try:
+                self.inotify.add_watch(directory)
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if (entry.is_dir(follow_symlinks=False)
+                                and self.walk_filter.descend(entry, device)):
+                            pending.append(entry.path)
+
+            except OSError as e:
+                # most likely fs.inotify.max_user_watches has been reached
+                logger.warning('Not watching "{0}": {1}'.format(directory,
+                                                                 e))
+                self.counters['directories_unwatched'] += 1
+                continue
+
+            self.counters['directories_watched'] += 1
+
+    def scan(self):
+        # scans the watched directories in full, as when they're first
+        # watched, or once events have been lost
+        filesizes = dedupe.filesystem.find_file_sizes(
+            self.within, jobs=self.jobs, walk_filter=self.walk_filter)
+
+        self.db.close()
+        self.db = dedupe.db.insert_files(
+            filesizes, into=self.into, prune_within=self.within,
+            counters=self.counters, algorithm=self.statistics.algorithm)
+
+        candidates = dedupe.utils.filter_singletons(filesizes)
+        dedupe.duplicates.repartition(candidates, statistics=self.statistics,
+                                      jobs=self.jobs)
+        dedupe.db.update_with_checksums(candidates, self.db,
+                                        algorithm=self.statistics.algorithm)
+        self.counters['scans'] += 1
+
+    def run(self):
+        while True:
+            self.process_events()
+
+    def process_events(self, timeout=None, settle=SETTLE_TIME):
+        # waits up to timeout seconds for an event, and then gathers events
+        # until they settle. returns how many events were applied.
+        events = self.inotify.read(timeout)
+        if not events:
+            return 0
+
+        deadline = time.monotonic() + MAX_DELAY
+        while time.monotonic() < deadline:
+            more = self.inotify.read(settle)
+            if not more:
+                break
+            events.extend(more)
+
+        self.apply(events)
+        return len(events)
+
+    def apply(self, events):
+        self.counters['events'] += len(events)
+        self.counters['batches'] += 1
+
+        changed = set()
+        created_directories = set()
+        removed_directories = set()
+        for mask, path in events:
+            if mask & IN_Q_OVERFLOW:
+                # the kernel's queue filled up and events were lost, so
+                # nothing short of a scan will do
+                logger.warning('Events were lost, scanning again')
+                self.counters['overflows'] += 1
+                for directory in self.within:
+                    self._watch_tree(directory, os.stat(directory).st_dev)
+                self.scan()
+                return
+
+            if mask & IN_DELETE_SELF:
+                # a watched directory that was removed is dropped along with
+                # the event in its parent, unless it had none
+                if path in self.within:
+                    removed_directories.add(path)
+
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    created_directories.add(path)
+                    removed_directories.discard(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    removed_directories.add(path)
+                    created_directories.discard(path)
+
+            else:
+                changed.add(path)
+
+        for directory in removed_directories:
+            self.inotify.remove_watches(directory)
+
+        # the files of new directories, including those moved in, are found
+        # by walking them. whatever was beneath a directory of the same name
+        # before is dropped.
+        files = {}
+        for directory in created_directories:
+            try:
+                device = os.stat(os.path.dirname(directory)).st_dev
+                self._watch_tree(directory, device)
+                filesizes = dedupe.filesystem.find_file_sizes(
+                    directory, walk_filter=self.walk_filter)
+            except (OSError, AssertionError):
+                # already gone again
+                continue
+
+            for file in itertools.chain.from_iterable(filesizes.values()):
+                files[file.path] = file
+
+        removed = set()
+        for path in changed:
+            if path in files:
+                continue
+
+            try:
+                path_stat = os.lstat(path)
+            except OSError:
+                removed.add(path)
+                continue
+
+            # anything else, such as a symlink, is skipped just as the walk
+            # skips it
+            if not stat.S_ISREG(path_stat.st_mode) \
+                    or not self.walk_filter.keep_file(path,
+                                                      path_stat.st_size):
+                removed.add(path)
+                continue
+
+            files[path] = dedupe.filesystem.File(path, path_stat)
+
+        dedupe.db.update_files(
+            list(files.values()), self.db, removed=removed,
+            removed_within=removed_directories | created_directories,
+            counters=self.counters, algorithm=self.statistics.algorithm)
+        logger.info('{0} files changed, {1} removed'.format(len(files),
+                                                           len(removed)))
+
+        try:
+            self._rehash(set(file.size for file in files.values()))
+        except OSError as e:
+            # a file that went away before it could be hashed. its size will
+            # be looked at again along with the event that removed it.
+            logger.warning('Hashing interrupted: {}'.format(e))
+            self.counters['hashing_interrupted'] += 1
+
+    def _files_from_rows(self, rows):
+        # the files of one size as they are now. those changed since the
+        # database last saw them are taken without their stale digests, and
+        # those since removed or resized are left out, to be dealt with
+        # along with the events for them.
+        algorithm = self.statistics.algorithm
+
+        def file_of_row(row):
+            path, bytesize, mtime, ctime, inode, device, blocks, checksum, \
+                first_block, last_block, chunks, row_algorithm, verified = row
+            try:
+                path_stat = os.lstat(path)
+            except OSError:
+                self.counters['rehash_missing'] += 1
+                return None
+
+            file = dedupe.filesystem.File(path, path_stat)
+            if file.size != bytesize or not stat.S_ISREG(path_stat.st_mode):
+                self.counters['rehash_missing'] += 1
+                return None
+
+            if file.signature == (bytesize, mtime, ctime, inode, device) \
+                    and row_algorithm == algorithm.name_for(bytesize):
+                file.hash = checksum
+                file.first_block = first_block
+                file.last_block = last_block
+                file.chunks = chunks
+                file.verified = verified
+            return file
+
+        return dedupe.filesystem.files_of_rows(rows, file_of_row)
+
+    def _rehash(self, sizes):
+        # the sizes of the changed files, of which only those shared with
+        # another file beneath the watched directories need hashing. files
+        # hashed before aren't read again.
+        sizes = sorted(sizes)
+        partitions = {}
+        for i in range(0, len(sizes), dedupe.db.SIZES_PER_QUERY):
+            rows = dedupe.db.files_of_sizes(
+                self.db, sizes[i:i + dedupe.db.SIZES_PER_QUERY],
+                within=self.within)
+            for bytesize, rows_of_size in itertools.groupby(
+                    rows, key=lambda row: row[1]):
+                partitions[bytesize] = self._files_from_rows(rows_of_size)
+
+        candidates = dedupe.utils.filter_singletons(partitions)
+        if not candidates:
+            return
+
+        dedupe.duplicates.repartition(candidates, statistics=self.statistics,
+                                      jobs=self.jobs)
+        dedupe.db.save_digests(
+            itertools.chain.from_iterable(candidates.values()), self.db,
+            self.statistics.algorithm)
+        self.db.commit()
+        self.counters['sizes_rehashed'] += len(candidates)
+
+    def close(self):
+        self.inotify.close()
+        self.db.close()